@@ -0,0 +1,109 @@
+"""
+Compares the dict based router generation in crd_utils with building the nested pydantic models.
+
+    python benchmarks/bench_routes.py [systems] [services]
+"""
+import itertools
+import json
+import os
+import sys
+import time
+
+# the package is imported from the checkout this script is in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SERVICE_COUNT = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+os.environ.setdefault("POD_ID", "bench")
+os.environ.setdefault(
+    "SERVICES",
+    json.dumps(
+        {
+            f"service{i:02d}": {"type": "shared" if i == 0 else "account" if i == 1 else "default"}
+            for i in range(SERVICE_COUNT)
+        }
+    ),
+)
+
+from pod_consul_sidekick.config import ServiceType  # noqa: E402
+from pod_consul_sidekick.crd_utils import (  # noqa: E402
+    HEADER_SERVICE_NAME,
+    HEADER_SYSTEM_NAME,
+    generate_routes,
+    settings,
+)
+from pod_consul_sidekick.models import (  # noqa: E402
+    ConsulRoute,
+    ConsulRouteDestination,
+    ConsulRouteMatch,
+    ConsulRouteMatchHttp,
+    ConsulRouteMatchHttpHeader,
+    ConsulRouterSpec,
+)
+
+
+def construct_route(system: str, service: str) -> ConsulRoute:
+    # one validated route, as crd_utils built them before the dict templates
+    service_config = settings.SERVICES.get(service)
+    return ConsulRoute(
+        match=ConsulRouteMatch(
+            http=ConsulRouteMatchHttp(
+                header=[
+                    ConsulRouteMatchHttpHeader(name=HEADER_SYSTEM_NAME, exact=system),
+                    ConsulRouteMatchHttpHeader(name=HEADER_SERVICE_NAME, exact=service),
+                ]
+            )
+        ),
+        destination=ConsulRouteDestination(
+            service=f"{service}-{system}", requestTimeout=service_config.request_timeout
+        ),
+    )
+
+
+def generate_routes_models(accounts, services):
+    # the model based implementation generate_routes() replaced
+    routes = (
+        [
+            construct_route(system, service)
+            for system in sorted(itertools.chain.from_iterable(accounts.values()))
+            for service, service_details in sorted(services.items())
+            if service_details.type is ServiceType.default
+        ]
+        + [
+            construct_route(account, service)
+            for account in sorted(accounts.keys())
+            for service, service_details in sorted(services.items())
+            if service_details.type is ServiceType.shared
+        ]
+        + [
+            construct_route(account, service)
+            for account in sorted(accounts.keys())
+            for service, service_details in sorted(services.items())
+            if service_details.type is ServiceType.account
+        ]
+    )
+    return ConsulRouterSpec(routes=routes)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main() -> None:
+    systems = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    accounts = {f"account{i}": {f"system{i}-{j}" for j in range(5)} for i in range(systems // 5)}
+
+    reference, reference_time = timed(generate_routes_models, accounts, settings.SERVICES)
+    fast, fast_time = timed(generate_routes, accounts, settings.SERVICES)
+    reference_json = reference.json(by_alias=True, exclude_unset=True)
+    fast_json = fast.json(by_alias=True, exclude_unset=True)
+    assert fast_json == reference_json, "generate_routes() output differs from the model based implementation"
+
+    print(f"{systems} systems x {SERVICE_COUNT} services: {len(fast.routes)} routes, {len(fast_json)} bytes")
+    print(f"models:  {reference_time:8.3f}s")
+    print(f"dicts:   {fast_time:8.3f}s ({reference_time / fast_time:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+Benchmarks spec generation and reconcile planning on synthetic pods, and runs the whole reconcile loop against the
+in-memory fake Kubernetes API (fake_apiserver.py) to count the calls it makes.
+
+    python benchmarks/bench_suite.py [--sizes 10,100,1000,10000,50000] [--reconcile-max 1000]
+                                     [--output results.json] [--compare baseline.json]
+
+Every stage reports the best wall time of --repeat runs, the peak of the memory traced while it ran and the number
+of memory blocks still allocated when it returned (mostly its result). The reconcile runs main.main() in a
+subprocess per size, with a synthetic account lookup going through an initial, a changed and an unchanged state.
+The JSON written by --output can be passed to --compare on another commit.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+
+# the package is imported from the checkout this script is in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SERVICE_COUNT = int(os.environ.get("BENCH_SERVICES", "20"))
+SYSTEMS_PER_ACCOUNT = 5
+POD_ID = "bench"
+DEFAULT_SIZES = "10,100,1000,10000,50000"
+
+
+def synthetic_services(count: int) -> dict[str, dict[str, Any]]:
+    # one pod level service, two shared and two account services and the rest per system; every service calls the
+    # next two, so the intention graph has shared and per system destinations with both kinds of sources
+    types = ["pod", "shared", "shared", "account", "account"]
+    names = [f"service{i:02d}" for i in range(count)]
+    return {
+        name: {
+            "type": types[i] if i < len(types) else "default",
+            "upstreams": [names[j % count] for j in (i + 1, i + 2) if j % count and j % count != i],
+        }
+        for i, name in enumerate(names)
+    }
+
+
+os.environ.setdefault("POD_ID", POD_ID)
+os.environ.setdefault("SERVICES", json.dumps(synthetic_services(SERVICE_COUNT)))
+
+from pod_consul_sidekick.config import ServiceType  # noqa: E402
+from pod_consul_sidekick.crd_utils import construct_routes, generate_routes, settings  # noqa: E402
+from pod_consul_sidekick.crds import SharedServicesCRD, TenantServicesIntentCRD  # noqa: E402
+from pod_consul_sidekick.discovery import AccountsDiff  # noqa: E402
+from pod_consul_sidekick.hashing import spec_hash  # noqa: E402
+from pod_consul_sidekick.index import AccountIndex  # noqa: E402
+
+
+def synthetic_accounts(systems: int) -> dict[str, set[str]]:
+    accounts: dict[str, set[str]] = {}
+    for i in range(0, systems, SYSTEMS_PER_ACCOUNT):
+        account = f"account{i // SYSTEMS_PER_ACCOUNT:05d}"
+        accounts[account] = {f"system{j:06d}" for j in range(i, min(systems, i + SYSTEMS_PER_ACCOUNT))}
+    return accounts
+
+
+def changed_accounts(accounts: dict[str, set[str]], seed: int = 0) -> dict[str, set[str]]:
+    # about 1% churn: systems added and removed, one moved to another account, one account added and one removed
+    rng = random.Random(seed)
+    result = {account: set(systems) for account, systems in accounts.items()}
+    names = sorted(result)
+    count = max(1, len(names) // 100)
+    for account in rng.sample(names, min(count, len(names))):
+        result[account].add(f"{account}-new")
+    for account in rng.sample(names, min(count, len(names))):
+        if len(result[account]) > 1:
+            result[account].remove(min(result[account]))
+    if len(names) > 2:
+        source, target = rng.sample(names[1:], 2)
+        if len(result[source]) > 1:
+            result[target].add(result[source].pop())
+        del result[names[0]]
+    result["account-new"] = {"system-new"}
+    return result
+
+
+def measure(func: Callable[[Any], Any], setup: Callable[[], Any], repeat: int) -> dict[str, float]:
+    times = []
+    blocks = 0
+    for i in range(repeat):
+        argument = setup()
+        gc.collect()
+        before = sys.getallocatedblocks()
+        start = time.perf_counter()
+        result = func(argument)
+        times.append(time.perf_counter() - start)
+        if i == 0:
+            blocks = sys.getallocatedblocks() - before
+        del argument, result
+
+    argument = setup()
+    gc.collect()
+    tracemalloc.start()
+    result = func(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del argument, result
+    return {"seconds": min(times), "peak_bytes": peak, "allocated_blocks": blocks}
+
+
+def stages(systems: int, repeat: int) -> dict[str, dict[str, float]]:
+    services = settings.SERVICES
+    looked_up = synthetic_accounts(systems)
+    accounts = AccountIndex(looked_up)
+    changed = AccountIndex(changed_accounts(looked_up))
+    unchanged = AccountIndex(looked_up)
+    diff = AccountsDiff.between(accounts, changed)
+    all_systems = sorted(system for systems_ in accounts.values() for system in systems_)
+    default_services = sorted(name for name, service in services.items() if service.type is ServiceType.default)
+    shared = SharedServicesCRD(POD_ID, {k: v for k, v in services.items() if v.type is ServiceType.shared})
+    intents = TenantServicesIntentCRD(POD_ID, services)
+
+    def unused() -> None:
+        return None
+
+    def fresh() -> AccountIndex:
+        # a new index every time, like every changed lookup, so no name table is reused across runs
+        return AccountIndex(looked_up)
+
+    return {
+        "generate_routes": measure(lambda index: generate_routes(index, services), fresh, repeat),
+        "construct_routes": measure(lambda _: construct_routes(all_systems, default_services), unused, repeat),
+        "shared_services_specs": measure(lambda index: list(shared.specs(index)), fresh, repeat),
+        "tenant_intents_specs": measure(lambda index: list(intents.specs(index)), fresh, repeat),
+        "tenant_intents_names": measure(intents.names, fresh, repeat),
+        "compute_hash": measure(spec_hash, lambda: generate_routes(fresh(), services), repeat),
+        "index_accounts": measure(lambda _: AccountIndex(looked_up), unused, repeat),
+        "accounts_diff": measure(lambda _: AccountsDiff.between(accounts, changed), unused, repeat),
+        # a fresh index every time, so the memoized digest isn't compared
+        "accounts_unchanged": measure(lambda index: AccountsDiff.between(index, unchanged), fresh, repeat),
+        "plan_update": measure(
+            lambda _: (intents.stale_names(changed, diff), list(intents.specs(intents.affected(changed, diff)))),
+            unused,
+            repeat,
+        ),
+    }
+
+
+def reconcile(systems: int) -> dict[str, Any]:
+    # runs in a subprocess (see --reconcile-worker); KUBECONFIG is read when kubernetes is imported, so the parent
+    # points it at a file that is written once the fake API server knows its port
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fake_apiserver import FakeApiServer
+
+    from pod_consul_sidekick import main
+    from pod_consul_sidekick.change_sources import ChangeSource
+    from pod_consul_sidekick.discovery import Discovery
+    from pod_consul_sidekick.metrics import STAGE_SECONDS
+
+    api = FakeApiServer().start(configure_client=False)
+    api.add_secret("default", f"peering-token-{POD_ID}", {"data": "dG9rZW4="})
+    with open(os.environ["KUBECONFIG"], "w") as f:
+        json.dump(
+            {
+                "apiVersion": "v1",
+                "kind": "Config",
+                "clusters": [{"name": "fake", "cluster": {"server": api.host}}],
+                "users": [{"name": "fake", "user": {"token": "fake"}}],
+                "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake"}}],
+                "current-context": "fake",
+            },
+            f,
+        )
+
+    initial = synthetic_accounts(systems)
+    changed = changed_accounts(initial)
+    states = [("initial", initial), ("change", changed), ("steady", changed)]
+    phases: dict[str, Any] = {}
+    done = asyncio.Event()
+
+    class SyntheticDiscovery(Discovery):
+        def __init__(self) -> None:
+            self.index = 0
+            # reconciles the states looked up so far lead to; an unchanged state isn't reconciled again
+            self.reconciles = 0
+            self.started = time.perf_counter()
+            self.calls = api.calls.copy()
+            self.request_bytes = api.request_bytes
+
+        async def lookup(self) -> dict[str, set[str]]:
+            if self.index:
+                calls = api.calls - self.calls
+                phases[states[self.index - 1][0]] = {
+                    "seconds": time.perf_counter() - self.started,
+                    "calls": dict(sorted(calls.items())),
+                    "total_calls": calls.total(),
+                    "request_bytes": api.request_bytes - self.request_bytes,
+                }
+                self.started = time.perf_counter()
+                self.calls = api.calls.copy()
+                self.request_bytes = api.request_bytes
+            if self.index == len(states):
+                done.set()
+                await asyncio.Event().wait()
+            if not self.index or states[self.index][1] != states[self.index - 1][1]:
+                self.reconciles += 1
+            self.index += 1
+            return {account: set(systems_) for account, systems_ in states[self.index - 1][1].items()}
+
+    discovery = SyntheticDiscovery()
+
+    class Reconciled(ChangeSource):
+        # lookups don't wait for reconciles anymore, so the next state is only looked up once the last one is applied
+        name = "benchmark"
+
+        async def wait(self) -> str:
+            while STAGE_SECONDS.count(stage="reconcile") < discovery.reconciles:
+                await asyncio.sleep(0.001)
+            return "next state"
+
+    main.get_account = lambda settings: discovery
+    main.get_change_sources = lambda settings: [Reconciled()]
+
+    async def run() -> None:
+        task = asyncio.create_task(main.main())
+        await asyncio.wait([task, asyncio.create_task(done.wait())], return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            task.result()
+        task.cancel()
+
+    asyncio.run(run())
+    return {"objects": len(api.objects), "phases": phases}
+
+
+def run_reconcile(systems: int) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "KUBECONFIG": os.path.join(directory, "kubeconfig"),
+            "dry_run": "false",
+            "EVENT_DEBOUNCE": "0",
+            "RECONCILE_DEBOUNCE": "0",
+            "NAMESPACE": "default",
+        }
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--reconcile-worker", str(systems)],
+            env=env,
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any]) -> None:
+    print(f"\ncompared with {baseline.get('commit') or 'baseline'} (ratio > 1 means slower/bigger now)")
+    for size, result in results["sizes"].items():
+        base = baseline["sizes"].get(size)
+        if base is None:
+            continue
+        for stage, values in result["stages"].items():
+            old = base["stages"].get(stage)
+            if old:
+                ratios = [f"{key} {values[key] / old[key]:.2f}x" for key in ("seconds", "peak_bytes") if old.get(key)]
+                print(f"{size:>6} {stage:<24} {', '.join(ratios)}")
+        for phase, values in result.get("reconcile", {}).get("phases", {}).items():
+            old = base.get("reconcile", {}).get("phases", {}).get(phase)
+            if old:
+                print(
+                    f"{size:>6} reconcile {phase:<14} seconds {values['seconds'] / old['seconds']:.2f}x, "
+                    f"calls {old['total_calls']} -> {values['total_calls']}"
+                )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated numbers of systems")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--reconcile-max", type=int, default=1000, help="largest size reconciled against the fake API")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--reconcile-worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.reconcile_worker is not None:
+        # main() logs every CRD at INFO otherwise
+        logging.basicConfig(level=logging.WARNING)
+        result = reconcile(args.reconcile_worker)
+        print(json.dumps(result))
+        return
+
+    results: dict[str, Any] = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "services": SERVICE_COUNT,
+        "systems_per_account": SYSTEMS_PER_ACCOUNT,
+        "sizes": {},
+    }
+    for systems in map(int, args.sizes.split(",")):
+        result: dict[str, Any] = {"stages": stages(systems, args.repeat)}
+        for stage, values in result["stages"].items():
+            print(
+                f"{systems:>6} {stage:<24} {values['seconds']:9.4f}s {values['peak_bytes'] / 2**20:9.1f} MiB peak "
+                f"{values['allocated_blocks']:>10} blocks"
+            )
+        if systems <= args.reconcile_max:
+            result["reconcile"] = run_reconcile(systems)
+            for phase, values in result["reconcile"]["phases"].items():
+                print(
+                    f"{systems:>6} reconcile {phase:<14} {values['seconds']:9.4f}s {values['total_calls']:>6} calls "
+                    f"{values['request_bytes']:>10} bytes sent"
+                )
+        results["sizes"][str(systems)] = result
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
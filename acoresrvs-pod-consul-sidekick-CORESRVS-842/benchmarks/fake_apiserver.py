@@ -0,0 +1,381 @@
+"""
+Minimal in-memory stand-in for the Kubernetes API server, enough to run the sidekick against: namespaced custom
+objects (list with label/field selectors and limit/continue, watch, create, replace, merge/JSON/server-side apply
+patches, delete, deletecollection), which covers Leases too, and secrets and ConfigMaps. Every request is counted in
+FakeApiServer.calls.
+
+    python benchmarks/fake_apiserver.py [port]
+
+prints the address to point a kubeconfig at; from Python, FakeApiServer().start() also configures the kubernetes
+client to use it.
+"""
+import bisect
+import copy
+import json
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from operator import itemgetter
+from typing import Any, Optional
+from urllib.parse import parse_qs, urlparse
+
+CUSTOM_OBJECT_PATH = re.compile(r"^/apis/([^/]+)/([^/]+)/namespaces/([^/]+)/([^/]+)(?:/([^/]+))?$")
+CORE_PATH = re.compile(r"^/api/v1/namespaces/([^/]+)/(secrets|configmaps)(?:/([^/]+))?$")
+
+
+class PatchError(Exception):
+    pass
+
+
+def _selected(obj: dict[str, Any], label_selector: Optional[str], field_selector: Optional[str]) -> bool:
+    labels = obj["metadata"].get("labels") or {}
+    for requirement in filter(None, (label_selector or "").split(",")):
+        key, value = requirement.split("=", 1)
+        if labels.get(key) != value:
+            return False
+    for requirement in filter(None, (field_selector or "").split(",")):
+        key, value = requirement.split("=", 1)
+        if key != "metadata.name" or obj["metadata"]["name"] != value:
+            return False
+    return True
+
+
+def merge_patch(target: Any, patch: Any) -> Any:
+    # RFC 7386
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def json_patch(document: Any, operations: list[dict[str, Any]]) -> Any:
+    # RFC 6902, without move and copy
+    document = copy.deepcopy(document)
+    for operation in operations:
+        tokens = [token.replace("~1", "/").replace("~0", "~") for token in operation["path"].split("/")[1:]]
+        try:
+            parent = document
+            for token in tokens[:-1]:
+                parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+            last = tokens[-1]
+            if isinstance(parent, list):
+                index = len(parent) if last == "-" else int(last)
+                if index > len(parent) or (operation["op"] != "add" and index >= len(parent)):
+                    raise PatchError(f"index {index} out of range in {operation['path']}")
+
+            if operation["op"] == "test":
+                current = parent[index] if isinstance(parent, list) else parent[last]
+                if current != operation["value"]:
+                    raise PatchError(f"test of {operation['path']} failed")
+            elif operation["op"] == "add":
+                if isinstance(parent, list):
+                    parent.insert(index, copy.deepcopy(operation["value"]))
+                else:
+                    parent[last] = copy.deepcopy(operation["value"])
+            elif operation["op"] == "replace":
+                if isinstance(parent, list):
+                    parent[index] = copy.deepcopy(operation["value"])
+                else:
+                    if last not in parent:
+                        raise PatchError(f"{operation['path']} does not exist")
+                    parent[last] = copy.deepcopy(operation["value"])
+            elif operation["op"] == "remove":
+                del parent[index if isinstance(parent, list) else last]
+            else:
+                raise PatchError(f"unsupported operation {operation['op']}")
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            raise PatchError(f"unable to apply {operation}: {e!r}") from e
+    return document
+
+
+class _Server(ThreadingHTTPServer):
+    # the sidekick opens a connection per call from several concurrent stages
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeApiServer:
+    def __init__(self, port: int = 0) -> None:
+        self.calls: Counter[str] = Counter()
+        self.request_bytes = 0
+        self.objects: dict[tuple[str, str, str], dict[str, Any]] = {}
+        # (resourceVersion, plural, type, object)
+        self.events: list[tuple[int, str, str, dict[str, Any]]] = []
+        self.resource_version = 100
+        # calls (named as in `calls`) answered with a 500 instead, as many times as their count says
+        self.failing: Counter[str] = Counter()
+        self.condition = threading.Condition()
+        self.server = _Server(("127.0.0.1", port), _handler(self))
+
+    @property
+    def host(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self, configure_client: bool = True) -> "FakeApiServer":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if configure_client:
+            import kubernetes
+
+            configuration = kubernetes.client.Configuration()
+            configuration.host = self.host
+            kubernetes.client.Configuration.set_default(configuration)
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_secret(self, namespace: str, name: str, data: dict[str, str]) -> None:
+        with self.condition:
+            self._store(
+                ("secrets", namespace, name),
+                "ADDED",
+                {"metadata": {"name": name, "namespace": namespace}, "data": data},
+            )
+
+    def list(self, plural: str, namespace: str) -> list[dict[str, Any]]:
+        with self.condition:
+            return [
+                copy.deepcopy(obj) for (p, ns, _), obj in sorted(self.objects.items()) if (p, ns) == (plural, namespace)
+            ]
+
+    def _store(self, key: tuple[str, str, str], event_type: str, obj: dict[str, Any]) -> dict[str, Any]:
+        # called with the condition held
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        if event_type == "DELETED":
+            self.objects.pop(key, None)
+        else:
+            self.objects[key] = obj
+        self.events.append((self.resource_version, key[0], event_type, copy.deepcopy(obj)))
+        self.condition.notify_all()
+        return obj
+
+
+def _handler(api: FakeApiServer) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def _send(self, code: int, body: Any) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _status(self, code: int, reason: str, message: str = "") -> None:
+            self._send(
+                code, {"kind": "Status", "status": "Failure", "code": code, "reason": reason, "message": message}
+            )
+
+        def _failing(self, call: str) -> bool:
+            with api.condition:
+                if api.failing[call] <= 0:
+                    return False
+                api.failing[call] -= 1
+            self._status(500, "InternalError", "injected failure")
+            return True
+
+        def _body(self) -> Any:
+            length = int(self.headers.get("Content-Length") or 0)
+            api.request_bytes += length
+            return json.loads(self.rfile.read(length)) if length else None
+
+        def _route(self) -> tuple[Optional[str], str, Optional[str], dict[str, str]]:
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            match = CUSTOM_OBJECT_PATH.match(url.path)
+            if match:
+                return match.group(4), match.group(3), match.group(5), query
+            match = CORE_PATH.match(url.path)
+            if match:
+                return match.group(2), match.group(1), match.group(3), query
+            return None, "", None, query
+
+        def do_GET(self) -> None:
+            plural, namespace, name, query = self._route()
+            if plural is None:
+                return self._status(404, "NotFound")
+            if name:
+                api.calls[f"GET {plural}"] += 1
+                with api.condition:
+                    obj = copy.deepcopy(api.objects.get((plural, namespace, name)))
+                return self._send(200, obj) if obj else self._status(404, "NotFound")
+            if (query.get("watch") or "").lower() in ("true", "1"):
+                api.calls[f"WATCH {plural}"] += 1
+                return self._watch(plural, namespace, query)
+
+            api.calls[f"LIST {plural}"] += 1
+            with api.condition:
+                items = [
+                    copy.deepcopy(obj)
+                    for (p, ns, _), obj in sorted(api.objects.items())
+                    if (p, ns) == (plural, namespace)
+                    and _selected(obj, query.get("labelSelector"), query.get("fieldSelector"))
+                ]
+                resource_version = str(api.resource_version)
+            start, limit = int(query.get("continue") or 0), int(query.get("limit") or 0)
+            continue_ = ""
+            if limit:
+                continue_ = str(start + limit) if start + limit < len(items) else ""
+                items = items[start : start + limit]
+            if "PartialObjectMetadataList" in (self.headers.get("Accept") or ""):
+                items = [
+                    {"apiVersion": "meta.k8s.io/v1", "kind": "PartialObjectMetadata", "metadata": obj["metadata"]}
+                    for obj in items
+                ]
+                kind = "PartialObjectMetadataList"
+            else:
+                kind = "List"
+            self._send(
+                200,
+                {
+                    "apiVersion": "v1",
+                    "kind": kind,
+                    "metadata": {"resourceVersion": resource_version, "continue": continue_},
+                    "items": items,
+                },
+            )
+
+        def _watch(self, plural: str, namespace: str, query: dict[str, str]) -> None:
+            resource_version = int(query.get("resourceVersion") or api.resource_version)
+            deadline = time.monotonic() + float(query.get("timeoutSeconds") or 60)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                while time.monotonic() < deadline:
+                    with api.condition:
+                        # events are in resourceVersion order, so only the new ones are looked at
+                        new = api.events[bisect.bisect_right(api.events, resource_version, key=itemgetter(0)) :]
+                        events = [event for event in new if event[1] == plural]
+                        if not events:
+                            api.condition.wait(0.2)
+                            continue
+                    for resource_version, _, event_type, obj in events:
+                        if obj["metadata"].get("namespace", namespace) != namespace or not _selected(
+                            obj, query.get("labelSelector"), query.get("fieldSelector")
+                        ):
+                            continue
+                        line = (json.dumps({"type": event_type, "object": obj}) + "\n").encode()
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                        self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def do_POST(self) -> None:
+            plural, namespace, _, query = self._route()
+            body = self._body()
+            api.calls[f"POST {plural}"] += 1
+            if self._failing(f"POST {plural}"):
+                return
+            with api.condition:
+                key = (plural or "", namespace, body["metadata"]["name"])
+                if key in api.objects:
+                    return self._status(409, "AlreadyExists")
+                body["metadata"].update(namespace=namespace, generation=1)
+                if query.get("dryRun"):
+                    return self._send(201, body)
+                self._send(201, api._store(key, "ADDED", body))
+
+        def do_PATCH(self) -> None:
+            plural, namespace, name, query = self._route()
+            content_type = (self.headers.get("Content-Type") or "").split(";")[0]
+            body = self._body()
+            api.calls[f"PATCH {plural} {content_type}"] += 1
+            if self._failing(f"PATCH {plural} {content_type}"):
+                return
+            with api.condition:
+                key = (plural or "", namespace, name or "")
+                current = api.objects.get(key)
+                if content_type == "application/apply-patch+yaml":
+                    if not query.get("fieldManager"):
+                        return self._status(400, "BadRequest", "fieldManager is required for apply requests")
+                    # ownership isn't tracked: every applied field is simply taken over, like a forced apply
+                    obj = merge_patch(current or {}, body)
+                    obj["metadata"]["managedFields"] = [{"manager": query["fieldManager"], "operation": "Apply"}]
+                elif current is None:
+                    return self._status(404, "NotFound")
+                elif content_type == "application/json-patch+json":
+                    try:
+                        obj = json_patch(current, body)
+                    except PatchError as e:
+                        return self._status(422, "Invalid", str(e))
+                elif content_type == "application/merge-patch+json":
+                    obj = merge_patch(current, body)
+                else:
+                    return self._status(415, "UnsupportedMediaType", content_type)
+
+                obj["metadata"]["namespace"] = namespace
+                if obj == current:
+                    # no-op patches don't bump the resourceVersion
+                    return self._send(200, obj)
+                obj["metadata"]["generation"] = (current or {}).get("metadata", {}).get("generation", 0) + 1
+                if query.get("dryRun"):
+                    return self._send(200, obj)
+                self._send(200, api._store(key, "MODIFIED" if current else "ADDED", obj))
+
+        def do_PUT(self) -> None:
+            plural, namespace, name, query = self._route()
+            body = self._body()
+            api.calls[f"PUT {plural}"] += 1
+            with api.condition:
+                key = (plural or "", namespace, name or "")
+                current = api.objects.get(key)
+                if current is None:
+                    return self._status(404, "NotFound")
+                resource_version = body["metadata"].get("resourceVersion")
+                if resource_version and resource_version != current["metadata"]["resourceVersion"]:
+                    return self._status(409, "Conflict", "the object has been modified")
+                body["metadata"]["namespace"] = namespace
+                if query.get("dryRun"):
+                    return self._send(200, body)
+                self._send(200, api._store(key, "MODIFIED", body))
+
+        def do_DELETE(self) -> None:
+            plural, namespace, name, query = self._route()
+            call = f"DELETE {plural}" if name else f"DELETECOLLECTION {plural}"
+            api.calls[call] += 1
+            if self._failing(call):
+                return
+            with api.condition:
+                if name:
+                    obj = api.objects.get((plural or "", namespace, name))
+                    if obj is None:
+                        return self._status(404, "NotFound")
+                    if not query.get("dryRun"):
+                        api._store((plural or "", namespace, name), "DELETED", obj)
+                    return self._send(200, obj)
+
+                selected = [
+                    (key, obj)
+                    for key, obj in api.objects.items()
+                    if key[:2] == (plural, namespace)
+                    and _selected(obj, query.get("labelSelector"), query.get("fieldSelector"))
+                ]
+                if not query.get("dryRun"):
+                    for key, obj in selected:
+                        api._store(key, "DELETED", obj)
+                self._send(200, {"apiVersion": "v1", "kind": "List", "items": [obj for _, obj in selected]})
+
+    return Handler
+
+
+if __name__ == "__main__":
+    server = FakeApiServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8001)
+    print(f"Serving a fake Kubernetes API on {server.host}", flush=True)
+    server.server.serve_forever()
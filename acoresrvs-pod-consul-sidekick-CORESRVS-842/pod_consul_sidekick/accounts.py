@@ -1,12 +1,25 @@
 import asyncio
 import logging
-import random
+import time
 from collections import defaultdict
-from typing import AsyncGenerator, Final
+from contextlib import AsyncExitStack
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any, Final, NamedTuple, Optional, Sequence
 
 import aioboto3
 
-from .utils import tags2dict
+from .discovery import Discovery
+from .metrics import (
+    LOOKUP_BYTES,
+    LOOKUP_ITEMS,
+    LOOKUP_PAGES,
+    LOOKUP_SHARD_ERRORS,
+    LOOKUP_SHARD_SECONDS,
+    LOOKUP_SHARD_STALE,
+)
+
+if TYPE_CHECKING:
+    from types_aiobotocore_resourcegroupstaggingapi.type_defs import TagTypeDef
 
 log: Final = logging.getLogger(__name__)
 
@@ -14,53 +27,199 @@ ACCOUNT_TAG: Final = "teracloud:account"
 SYSTEM_TAG: Final = "teracloud:system"
 POD_ID_TAG: Final = "teracloud:pod:id"
 RESOURCES: Final = ["ec2:instance", "ecs:service"]
+ROLE_SESSION_NAME: Final = "pod-consul-sidekick"
+# assumed role credentials are renewed this long before they expire
+CREDENTIALS_MARGIN: Final = 5 * 60
+
+
+def account_and_system(tags: list["TagTypeDef"]) -> tuple[Optional[str], Optional[str]]:
+    # the only two tags looked at, without building a dict of all of them
+    account = system = None
+    for tag in tags:
+        key = tag["Key"]
+        if key == ACCOUNT_TAG:
+            account = tag["Value"]
+        elif key == SYSTEM_TAG:
+            system = tag["Value"]
+    return account, system
+
+
+class Shard(NamedTuple):
+    region: Optional[str]
+    role_arn: Optional[str]
+
+    def __str__(self) -> str:
+        return f"{self.region or 'default'}/{self.role_arn or 'default'}"
+
 
+class ShardStats:
+    def __init__(self) -> None:
+        self.lookups = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.resources = 0
+        self.response_bytes = 0
+        self.last_success: Optional[float] = None
+        # the last lookup failed, the shard's accounts are the previous result's or missing
+        self.stale = False
 
-class Accounts:
-    def __init__(self, pod_id: str) -> None:
+
+class ShardError(Exception):
+    pass
+
+
+class Accounts(Discovery):
+    def __init__(
+        self,
+        pod_id: str,
+        *,
+        regions: Sequence[str] = (),
+        role_arns: Sequence[str] = (),
+        concurrency: int = 4,
+        shard_timeout: Optional[float] = None,
+    ) -> None:
         self.session: Final = aioboto3.Session()
         self.pod_id: Final = pod_id
+        self.shards: Final = [
+            Shard(region, role_arn) for role_arn in [None, *role_arns] for region in (regions or [None])
+        ]
+        self.shard_timeout: Final = shard_timeout
+        self.stats: Final = {shard: ShardStats() for shard in self.shards}
 
-    async def lookup(self) -> dict[str, set[str]]:
+        self._semaphore: Final = asyncio.Semaphore(concurrency)
+        self._clients: dict[Shard, tuple[AsyncExitStack, Any, Optional[datetime]]] = {}
+        self._last_results: dict[Shard, dict[str, set[str]]] = {}
+
+    async def _assume_role(self, role_arn: str) -> dict[str, Any]:
+        async with self.session.client("sts") as sts:
+            response: Final = await sts.assume_role(RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME)
+        return response["Credentials"]
+
+    async def _client(self, shard: Shard) -> Any:
+        # clients are kept open between lookups, except when their assumed role credentials are about to expire
+        if shard in self._clients:
+            _, client, expiration = self._clients[shard]
+            if expiration is None or (expiration - datetime.now(timezone.utc)).total_seconds() > CREDENTIALS_MARGIN:
+                return client
+            await self._close_client(shard)
+
+        expiration = None
+        kwargs: dict[str, Any] = {"region_name": shard.region}
+        if shard.role_arn:
+            credentials = await self._assume_role(shard.role_arn)
+            kwargs.update(
+                aws_access_key_id=credentials["AccessKeyId"],
+                aws_secret_access_key=credentials["SecretAccessKey"],
+                aws_session_token=credentials["SessionToken"],
+            )
+            expiration = credentials["Expiration"]
+
+        exit_stack: Final = AsyncExitStack()
+        client = await exit_stack.enter_async_context(self.session.client("resourcegroupstaggingapi", **kwargs))
+        self._clients[shard] = exit_stack, client, expiration
+        return client
+
+    async def _close_client(self, shard: Shard) -> None:
+        exit_stack, _, _ = self._clients.pop(shard)
+        try:
+            await exit_stack.aclose()
+        except Exception as e:
+            log.debug("%s: error while closing client: %r", shard, e)
+
+    async def close(self) -> None:
+        for shard in list(self._clients):
+            await self._close_client(shard)
+
+    async def _lookup_shard(self, shard: Shard) -> dict[str, set[str]]:
+        # the tagging API can't aggregate, so every page is folded into accounts -> systems as it arrives
         accounts: defaultdict[str, set[str]] = defaultdict(set)
+        stats: Final = self.stats[shard]
+
+        tapi: Final = await self._client(shard)
+        get_resources: Final = tapi.get_paginator("get_resources")
+        async for page in get_resources.paginate(
+            ResourceTypeFilters=RESOURCES,
+            TagFilters=[
+                {"Key": POD_ID_TAG, "Values": [self.pod_id]},
+                {"Key": SYSTEM_TAG},
+            ],
+        ):
+            mappings = page["ResourceTagMappingList"]
+            size = int(page["ResponseMetadata"]["HTTPHeaders"].get("content-length", 0))
+            stats.resources += len(mappings)
+            stats.response_bytes += size
+            LOOKUP_PAGES.inc(cloud="aws")
+            LOOKUP_ITEMS.inc(len(mappings), cloud="aws")
+            LOOKUP_BYTES.inc(size, cloud="aws")
+            for tag_mapping_list in mappings:
+                account, system = account_and_system(tag_mapping_list["Tags"])
+                if not account:
+                    log.error(
+                        "%s (%s) does not contain an account",
+                        tag_mapping_list["ResourceARN"],
+                        system,
+                    )
+                    continue
 
-        async with self.session.client("resourcegroupstaggingapi") as tapi:
-            get_resources: Final = tapi.get_paginator("get_resources")
-            async for page in get_resources.paginate(
-                ResourceTypeFilters=RESOURCES,
-                TagFilters=[
-                    {"Key": POD_ID_TAG, "Values": [self.pod_id]},
-                    {"Key": SYSTEM_TAG},
-                ],
-            ):
-                for tag_mapping_list in page["ResourceTagMappingList"]:
-                    tags = tags2dict(tag_mapping_list["Tags"])
-                    account = tags.get(ACCOUNT_TAG)
-                    system = tags[SYSTEM_TAG]
-                    log.debug("%s: %s, %s", tag_mapping_list["ResourceARN"], account, system)
-                    if not account:
-                        log.error(
-                            "%s (%s) does not contain an account",
-                            tag_mapping_list["ResourceARN"],
-                            system,
-                        )
-                        continue
-
-                    accounts[account].add(system)
+                accounts[account].add(system)
 
         return accounts
 
-    async def monitor(self, sleep_time: float, sleep_splay: float) -> AsyncGenerator[dict[str, set[str]], None]:
-        old_accounts: dict[str, set[str]] = {}
-        while True:
-            new_accounts = await self.lookup()
+    async def _timed_lookup_shard(self, shard: Shard) -> Optional[dict[str, set[str]]]:
+        # None when the lookup failed and there is no previous result to fall back to
+        stats: Final = self.stats[shard]
+        async with self._semaphore:
+            start: Final = time.monotonic()
+            stats.lookups += 1
+            stats.resources = 0
+            stats.response_bytes = 0
+            try:
+                result = await asyncio.wait_for(self._lookup_shard(shard), self.shard_timeout)
+            except Exception as e:
+                stats.errors += 1
+                stats.stale = True
+                LOOKUP_SHARD_ERRORS.inc(shard=str(shard))
+                LOOKUP_SHARD_STALE.set(1, shard=str(shard))
+                # a half-used client may be in a bad state
+                if shard in self._clients:
+                    await self._close_client(shard)
+                if shard not in self._last_results:
+                    log.error("%s: lookup failed with no previous result, its accounts are missing: %r", shard, e)
+                    return None
+                log.warning("%s: lookup failed, reusing the previous result: %r", shard, e)
+                return self._last_results[shard]
+            finally:
+                stats.latency = time.monotonic() - start
+                LOOKUP_SHARD_SECONDS.observe(stats.latency, shard=str(shard))
 
-            if new_accounts != old_accounts:
-                yield new_accounts
-                old_accounts = new_accounts
-            else:
-                log.info("No change")
+        stats.last_success = time.time()
+        stats.stale = False
+        LOOKUP_SHARD_STALE.set(0, shard=str(shard))
+        self._last_results[shard] = result
+        log.info(
+            "%s: %d resources (%d bytes), %d accounts in %.2fs (%d errors so far)",
+            shard,
+            stats.resources,
+            stats.response_bytes,
+            len(result),
+            stats.latency,
+            stats.errors,
+        )
+        return result
 
-            # sleep_time = random.uniform(max(5.0, sleep_time - sleep_splay), sleep_time + sleep_splay)
-            log.info("Sleeping %.1f seconds", sleep_time)
-            await asyncio.sleep(sleep_time)
+    @property
+    def partial(self) -> bool:
+        return any(shard not in self._last_results for shard in self.shards)
+
+    async def lookup(self) -> dict[str, set[str]]:
+        accounts: defaultdict[str, set[str]] = defaultdict(set)
+
+        # the shards that answered are enough to go on with, unless none did
+        results: Final = await asyncio.gather(*map(self._timed_lookup_shard, self.shards))
+        if all(result is None for result in results):
+            raise ShardError("no shard could be looked up")
+        for result in results:
+            for account, systems in (result or {}).items():
+                accounts[account] |= systems
+
+        return accounts
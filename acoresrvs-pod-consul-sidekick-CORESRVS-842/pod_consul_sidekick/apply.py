@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import random
+import time
+from collections import Counter
+from enum import StrEnum, auto
+from typing import Awaitable, Callable, Final, Iterable, Mapping, Optional
+
+from kubernetes.client import ApiException
+
+log: Final = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES: Final = frozenset({409, 429})
+MAX_BACKOFF: Final = 30.0
+
+Operation = Callable[[], Awaitable["ApplyOutcome"]]
+
+
+class ApplyOutcome(StrEnum):
+    created = auto()
+    patched = auto()
+    unchanged = auto()
+    deleted = auto()
+    failed = auto()
+
+
+class ApplySummary:
+    def __init__(self, tag: str) -> None:
+        self.tag = tag
+        self.outcomes: Counter[ApplyOutcome] = Counter()
+        self.failures: dict[str, BaseException] = {}
+        self.started = time.monotonic()
+
+    def add(self, name: str, outcome: ApplyOutcome | BaseException, count: int = 1) -> None:
+        if isinstance(outcome, BaseException):
+            self.failures[name] = outcome
+            outcome = ApplyOutcome.failed
+        self.outcomes[outcome] += count
+
+    def log(self) -> None:
+        log.info(
+            "%s: %s in %.2fs",
+            self.tag,
+            ", ".join(f"{count} {outcome}" for outcome, count in sorted(self.outcomes.items())) or "nothing to do",
+            time.monotonic() - self.started,
+        )
+        for name, error in sorted(self.failures.items()):
+            log.error("%s: failed to apply %s: %s", self.tag, name, error)
+
+
+def is_retryable(error: BaseException) -> bool:
+    return isinstance(error, ApiException) and (error.status in RETRYABLE_STATUSES or (error.status or 0) >= 500)
+
+
+class ApplyEngine:
+    # runs the requests of a reconcile concurrently, a bounded number at a time, retrying transient failures
+    def __init__(self, concurrency: int = 16, retries: int = 5, backoff: float = 0.5) -> None:
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _delay(self, attempt: int, error: BaseException) -> float:
+        retry_after = error.headers.get("Retry-After") if isinstance(error, ApiException) and error.headers else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2**attempt))
+
+    async def run(self, name: str, operation: Operation) -> ApplyOutcome:
+        loop: Final = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                try:
+                    return await operation()
+                except Exception as e:
+                    if attempt >= self.retries or not is_retryable(e):
+                        raise
+                    error = e
+
+            delay = self._delay(attempt, error)
+            log.warning("Retrying %s in %.1fs (attempt %d/%d): %s", name, delay, attempt + 1, self.retries, error)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def run_all(
+        self, tag: str, operations: Iterable[tuple[str, Operation]], counts: Optional[Mapping[str, int]] = None
+    ) -> ApplySummary:
+        # counts: objects per operation for the ones acting on several at once
+        summary: Final = ApplySummary(tag)
+        names: Final[list[str]] = []
+        tasks: Final[list[asyncio.Task[ApplyOutcome]]] = []
+        for name, operation in operations:
+            names.append(name)
+            tasks.append(asyncio.create_task(self.run(name, operation)))
+
+        for name, result in zip(names, await asyncio.gather(*tasks, return_exceptions=True)):
+            summary.add(name, result, counts.get(name, 1) if counts else 1)
+
+        summary.log()
+        return summary
@@ -1,12 +1,15 @@
 import asyncio
 import logging
-import random
 from collections import defaultdict
-from typing import AsyncGenerator, Final
-from azure.mgmt.resourcegraph import ResourceGraphClient
-from azure.mgmt.resourcegraph.models import QueryRequest
-from .azure_library import ClientAssertionCredential
-from azure.identity import DefaultAzureCredential
+from typing import Any, Final, Optional, Sequence
+
+from azure.core.pipeline import PipelineResponse
+from azure.mgmt.resourcegraph.aio import ResourceGraphClient
+from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions, QueryResponse
+
+from .azure_library import AsyncClientAssertionCredential
+from .discovery import Discovery
+from .metrics import LOOKUP_BYTES, LOOKUP_ITEMS, LOOKUP_PAGES
 
 log: Final = logging.getLogger(__name__)
 
@@ -14,58 +17,95 @@ ACCOUNT_TAG: Final = "teracloud:account"
 SYSTEM_TAG: Final = "teracloud:system"
 POD_ID_TAG: Final = "teracloud:pod:id"
 RESOURCE_TYPE_FILTER: Final = "Microsoft.Compute/virtualMachines,Microsoft.ContainerInstance/containerGroups"
+PAGE_SIZE: Final = 1000
+
 
+def _with_size(
+    pipeline_response: PipelineResponse, deserialized: QueryResponse, headers: dict[str, Any]
+) -> tuple[QueryResponse, int]:
+    return deserialized, len(pipeline_response.http_response.body())
 
-class AzureAccounts:
-    def __init__(self, pod_id: str, subscription_id) -> None:
+
+class AzureAccounts(Discovery):
+    def __init__(
+        self, pod_id: str, subscription_id, *, subscription_ids: Sequence[str] = (), fan_out: bool = False
+    ) -> None:
         self.pod_id: Final = pod_id
         self.subscription_id: Final = subscription_id
+        self.subscription_ids: Final = list(dict.fromkeys(filter(None, [subscription_id, *subscription_ids])))
+        self.fan_out: Final = fan_out
 
-    async def lookup(self) -> dict[str, set[str]]:
-        accounts: defaultdict[str, set[str]] = defaultdict(set)
-        credential = ClientAssertionCredential()
-        client = ResourceGraphClient(credential)
+        self._credential: Optional[AsyncClientAssertionCredential] = None
+        self._client: Optional[ResourceGraphClient] = None
+
+    def _get_client(self) -> ResourceGraphClient:
+        # one client (and HTTP session) for the lifetime of the process, created on the running loop
+        if self._client is None:
+            self._credential = AsyncClientAssertionCredential()
+            self._client = ResourceGraphClient(self._credential)
+        return self._client
 
-        # Define the query to retrieve resources with multiple tags
-        query = f"""
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        if self._credential is not None:
+            await self._credential.close()
+            self._credential = None
+
+    def _query(self) -> str:
+        # aggregated by Resource Graph: one row per account with the set of its systems, instead of a whole record per
+        # resource; without an id column the rows are paged with skip, hence the order
+        return f"""
             where 
                 (type =~ 'microsoft.compute/virtualmachines' or type =~ 'microsoft.containerinstance/containergroups') and 
                 tags['{POD_ID_TAG}'] =~ '{self.pod_id}' and isnotnull(tags['{SYSTEM_TAG}'])
-               
+            | project account = tostring(tags['{ACCOUNT_TAG}']), system = tostring(tags['{SYSTEM_TAG}'])
+            | summarize systems = make_set(system) by account
+            | order by account asc
         """
-        log.info(f"query to fetch accounts: {query}")
-        # Execute the query and retrieve the results
-        request = QueryRequest(subscriptions=[self.subscription_id], query=query)
-        response = client.resources(request)
-        # Print the resource IDs and tags
-        for resource in response.data:
-            account = resource["tags"].get(ACCOUNT_TAG)
-            system = resource["tags"][SYSTEM_TAG]
-            if not account:
-                log.error(
-                    "%s (%s) does not contain an account",
-                    resource["id"],
-                    system,
-                )
+
+    async def _accounts(self, subscriptions: list[str]) -> list[dict]:
+        client: Final = self._get_client()
+        query: Final = self._query()
+        rows: Final[list[dict]] = []
+        pages = 0
+        received = 0
+        while True:
+            request = QueryRequest(
+                subscriptions=subscriptions,
+                query=query,
+                options=QueryRequestOptions(top=PAGE_SIZE, skip=len(rows)),
+            )
+            response, size = await client.resources(request, cls=_with_size)
+            pages += 1
+            received += size
+            LOOKUP_PAGES.inc(cloud="azure")
+            LOOKUP_ITEMS.inc(len(response.data), cloud="azure")
+            LOOKUP_BYTES.inc(size, cloud="azure")
+            rows.extend(response.data)
+            if not response.data or len(rows) >= response.total_records:
+                break
+
+        log.info(
+            "Fetched %d accounts (%d bytes) in %d page(s) from %s", len(rows), received, pages, ", ".join(subscriptions)
+        )
+        return rows
+
+    async def lookup(self) -> dict[str, set[str]]:
+        accounts: defaultdict[str, set[str]] = defaultdict(set)
+
+        log.info(f"query to fetch accounts: {self._query()}")
+        if self.fan_out and len(self.subscription_ids) > 1:
+            results = await asyncio.gather(*(self._accounts([subscription]) for subscription in self.subscription_ids))
+        else:
+            results = [await self._accounts(self.subscription_ids)]
+
+        for row in (row for result in results for row in result):
+            if not row["account"]:
+                log.error("Resources of systems %s do not contain an account", ", ".join(sorted(row["systems"])))
                 continue
 
-            accounts[account].add(system)
+            accounts[row["account"]].update(row["systems"])
         log.info(f"Total accounts: {accounts}")
         return accounts
-
-    async def monitor(self, sleep_time: float, sleep_splay: float) -> AsyncGenerator[dict[str, set[str]], None]:
-        old_accounts: dict[str, set[str]] = {}
-        while True:
-            new_accounts = await self.lookup()
-            log.info(f"Old Accounts :{old_accounts}")
-            log.info(f"New Accounts :{new_accounts}")
-
-            if new_accounts != old_accounts:
-                yield new_accounts
-                old_accounts = new_accounts
-            else:
-                log.info("No change")
-
-            # sleep_time = random.uniform(max(5.0, sleep_time - sleep_splay), sleep_time + sleep_splay)
-            log.info("Sleeping %.1f seconds", sleep_time)
-            await asyncio.sleep(sleep_time)
@@ -1,4 +1,7 @@
+import asyncio
+import logging
 import os
+import threading
 import time
 
 import requests
@@ -6,28 +9,156 @@ from azure.core.credentials import AccessToken
 from azure.identity import DefaultAzureCredential
 from msal import ConfidentialClientApplication
 
+log = logging.getLogger(__name__)
 
-class ClientAssertionCredential(object):
+# refresh tokens once this fraction of their lifetime has passed
+TOKEN_REFRESH_FRACTION = 0.75
+# never hand out a token closer than this to its expiry, even if the background refresh failed
+TOKEN_REFRESH_MARGIN = 5 * 60
+TOKEN_RETRY_SECONDS = 30
+
+
+class _Refresh(object):
+    # a token request in flight, shared by every caller asking for the same scopes meanwhile
     def __init__(self):
+        self._done = threading.Event()
+        self._token = None
+        self._error = None
+
+    def set(self, token=None, error=None):
+        self._token = token
+        self._error = error
+        self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._token
+
+
+class ClientAssertionCredential(object):
+    def __init__(self, refresh_fraction=TOKEN_REFRESH_FRACTION):
         azure_client_id = os.getenv("AZURE_CLIENT_ID", "")
         azure_tenant_id = os.getenv("AZURE_TENANT_ID", "")
         azure_authority_host = os.getenv("AZURE_AUTHORITY_HOST", "")
-        azure_federated_token_file = os.getenv("AZURE_FEDERATED_TOKEN_FILE", "")
+        self.federated_token_file = os.getenv("AZURE_FEDERATED_TOKEN_FILE", "")
+        self.refresh_fraction = refresh_fraction
+
+        # only held to look at or update the state below, never during a request
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._timers = {}
+        self._refreshing = {}
+        self._assertion = None
+        self._assertion_mtime = None
 
-        # read the projected service account token file
-        f = open(azure_federated_token_file, "rb")
-        # create a confidential client application
+        # create a confidential client application; the assertion is read lazily so a rotated
+        # projected service account token is picked up
         self.app = ConfidentialClientApplication(
             azure_client_id,
-            client_credential={"client_assertion": f.read().decode("utf-8")},
+            client_credential={"client_assertion": self._client_assertion},
             authority="{}{}".format(azure_authority_host, azure_tenant_id),
         )
 
-    def get_token(self, *scopes, **kwargs):
+    def _client_assertion(self):
+        # re-read the projected service account token file whenever kubelet rotates it
+        mtime = os.stat(self.federated_token_file).st_mtime_ns
+        if mtime != self._assertion_mtime:
+            with open(self.federated_token_file, "rb") as f:
+                assertion = f.read().decode("utf-8")
+            with self._lock:
+                self._assertion, self._assertion_mtime = assertion, mtime
+            log.info("Loaded federated token from %s", self.federated_token_file)
+        return self._assertion
+
+    def _acquire(self, scopes):
         # get the token using the application
-        token = self.app.acquire_token_for_client(scopes)
+        token = self.app.acquire_token_for_client(list(scopes))
         if "error" in token:
             raise Exception(token["error_description"])
-        expires_on = time.time() + token["expires_in"]
+        issued_on = time.time()
+        expires_on = issued_on + token["expires_in"]
         # return an access token with the token string and expiration time
-        return AccessToken(token["access_token"], int(expires_on))
+        return AccessToken(token["access_token"], int(expires_on)), issued_on
+
+    def _refresh(self, key):
+        # one request per set of scopes at a time; whoever asks while it's running waits for its outcome
+        with self._lock:
+            refresh = self._refreshing.get(key)
+            owner = refresh is None
+            if owner:
+                refresh = self._refreshing[key] = _Refresh()
+        if not owner:
+            return refresh.result()
+
+        try:
+            token, issued_on = self._acquire(key)
+        except Exception as e:
+            with self._lock:
+                del self._refreshing[key]
+            refresh.set(error=e)
+            log.warning("Unable to refresh token for %s, retrying in %ds: %s", ", ".join(key), TOKEN_RETRY_SECONDS, e)
+            self._schedule(key, TOKEN_RETRY_SECONDS)
+            raise
+
+        with self._lock:
+            self._tokens[key] = token
+            del self._refreshing[key]
+        refresh.set(token=token)
+        self._schedule(key, (token.expires_on - issued_on) * self.refresh_fraction)
+        return token
+
+    def _schedule(self, key, delay):
+        with self._lock:
+            if key in self._timers:
+                self._timers[key].cancel()
+            timer = threading.Timer(delay, self._background_refresh, args=(key,))
+            timer.daemon = True
+            self._timers[key] = timer
+            timer.start()
+
+    def _background_refresh(self, key):
+        try:
+            self._refresh(key)
+        except Exception:
+            pass
+
+    def cached_token(self, *scopes):
+        with self._lock:
+            token = self._tokens.get(frozenset(scopes))
+        if token is not None and token.expires_on - time.time() > TOKEN_REFRESH_MARGIN:
+            return token
+        return None
+
+    def get_token(self, *scopes, **kwargs):
+        token = self.cached_token(*scopes)
+        return token if token is not None else self._refresh(frozenset(scopes))
+
+    def close(self):
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+
+
+class AsyncClientAssertionCredential(object):
+    # async variant for the azure .aio clients; cached tokens are returned without leaving the event loop, which is
+    # never blocked by a token request
+    def __init__(self, credential=None):
+        self.credential = credential or ClientAssertionCredential()
+
+    async def get_token(self, *scopes, **kwargs):
+        token = self.credential.cached_token(*scopes)
+        if token is not None:
+            return token
+        return await asyncio.to_thread(self.credential.get_token, *scopes, **kwargs)
+
+    async def close(self):
+        self.credential.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
@@ -0,0 +1,211 @@
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import random
+from abc import ABCMeta, abstractmethod
+from typing import Any, Callable, Final, NamedTuple, Optional, Protocol
+
+import aioboto3
+
+log: Final = logging.getLogger(__name__)
+
+ACCOUNT_TAG: Final = "teracloud:account"
+SYSTEM_TAG: Final = "teracloud:system"
+POD_ID_TAG: Final = "teracloud:pod:id"
+
+MIN_SLEEP: Final = 5.0
+BACKOFF_FACTOR: Final = 1.5
+RECEIVE_WAIT_SECONDS: Final = 20
+RELEVANT_TAGS: Final = frozenset({ACCOUNT_TAG, SYSTEM_TAG, POD_ID_TAG})
+AWS_STATE_EVENTS: Final = frozenset({"EC2 Instance State-change Notification", "ECS Service Action"})
+AZURE_RESOURCE_EVENTS: Final = frozenset(
+    {"Microsoft.Resources.ResourceWriteSuccess", "Microsoft.Resources.ResourceDeleteSuccess"}
+)
+AZURE_RESOURCE_TYPES: Final = ("microsoft.compute/virtualmachines", "microsoft.containerinstance/containergroups")
+
+
+class ChangeSource(metaclass=ABCMeta):
+    name = "undefined"
+    # whether a trigger needs everything reconciled rather than just what changed in the accounts
+    full_reconcile = False
+
+    @abstractmethod
+    async def wait(self) -> str:
+        # returns (with a reason) once accounts may have changed
+        ...
+
+    def feedback(self, changed: bool) -> None:
+        pass
+
+
+class PollingSource(ChangeSource):
+    name = "poll"
+
+    def __init__(self, sleep_time: float, sleep_splay: float, max_sleep_time: Optional[float] = None) -> None:
+        self.sleep_time = sleep_time
+        self.sleep_splay = sleep_splay
+        self.max_sleep_time = max(sleep_time, max_sleep_time or sleep_time)
+        self._current = sleep_time
+
+    def feedback(self, changed: bool) -> None:
+        # adaptive backoff: idle pods scan less and less often, any change snaps back to the base interval
+        self._current = self.sleep_time if changed else min(self.max_sleep_time, self._current * BACKOFF_FACTOR)
+
+    async def wait(self) -> str:
+        low: Final = max(MIN_SLEEP, self._current - self.sleep_splay)
+        sleep_time: Final = random.uniform(low, max(low, self._current + self.sleep_splay))
+        log.info("Sleeping %.1f seconds", sleep_time)
+        await asyncio.sleep(sleep_time)
+        return "periodic resync"
+
+
+class QueueMessage(NamedTuple):
+    body: str
+    receipt: Any
+
+
+class MessageQueue(Protocol):
+    async def receive(self) -> list[QueueMessage]:
+        ...
+
+    async def ack(self, messages: list[QueueMessage]) -> None:
+        ...
+
+
+class LocalQueue:
+    # in-process stand-in for a cloud queue, e.g. in tests
+    def __init__(self) -> None:
+        self._queue: Final[asyncio.Queue[str]] = asyncio.Queue()
+        self.acked: Final[list[QueueMessage]] = []
+
+    def put(self, event: str | dict[str, Any]) -> None:
+        self._queue.put_nowait(event if isinstance(event, str) else json.dumps(event))
+
+    async def receive(self) -> list[QueueMessage]:
+        messages: Final = [QueueMessage(await self._queue.get(), None)]
+        while not self._queue.empty():
+            messages.append(QueueMessage(self._queue.get_nowait(), None))
+        return messages
+
+    async def ack(self, messages: list[QueueMessage]) -> None:
+        self.acked.extend(messages)
+
+
+class SQSQueue:
+    # SQS queue subscribed to an EventBridge rule
+    def __init__(self, queue_url: str, session: Optional[aioboto3.Session] = None) -> None:
+        self.queue_url = queue_url
+        self.session: Final = session or aioboto3.Session()
+
+    async def receive(self) -> list[QueueMessage]:
+        async with self.session.client("sqs") as sqs:
+            response: Final = await sqs.receive_message(
+                QueueUrl=self.queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=RECEIVE_WAIT_SECONDS
+            )
+        return [QueueMessage(message["Body"], message["ReceiptHandle"]) for message in response.get("Messages", [])]
+
+    async def ack(self, messages: list[QueueMessage]) -> None:
+        if not messages:
+            return
+        async with self.session.client("sqs") as sqs:
+            await sqs.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{"Id": str(i), "ReceiptHandle": message.receipt} for i, message in enumerate(messages)],
+            )
+
+
+class AzureStorageQueue:
+    # storage queue used as an Event Grid subscription endpoint
+    def __init__(self, queue_url: str, credential: Any) -> None:
+        # only imported by pods running on Azure
+        from azure.storage.queue.aio import QueueClient
+
+        self.client: Final = QueueClient.from_queue_url(queue_url, credential=credential)
+
+    async def receive(self) -> list[QueueMessage]:
+        messages: list[QueueMessage] = []
+        while not messages:
+            async for message in self.client.receive_messages(messages_per_page=32, max_messages=32):
+                messages.append(QueueMessage(message.content, message))
+            if not messages:
+                await asyncio.sleep(RECEIVE_WAIT_SECONDS)
+        return messages
+
+    async def ack(self, messages: list[QueueMessage]) -> None:
+        for message in messages:
+            await self.client.delete_message(message.receipt)
+
+
+def decode_event(body: str) -> Optional[dict[str, Any]]:
+    # Event Grid base64-encodes events delivered to storage queues
+    for candidate in (body, _b64decode(body)):
+        if candidate is None:
+            continue
+        try:
+            event = json.loads(candidate)
+        except ValueError:
+            continue
+        # Event Grid may batch events into a list; any other JSON isn't an event
+        if isinstance(event, list) and all(isinstance(item, dict) for item in event):
+            return {"events": event}
+        if isinstance(event, dict):
+            return event
+    return None
+
+
+def _b64decode(body: str) -> Optional[str]:
+    try:
+        return base64.b64decode(body, validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def is_aws_tag_event(event: dict[str, Any]) -> bool:
+    detail: Final = event.get("detail") or {}
+    if event.get("detail-type") == "Tag Change on Resource":
+        return bool(RELEVANT_TAGS & set(detail.get("changed-tag-keys", [])))
+    return event.get("detail-type") in AWS_STATE_EVENTS
+
+
+def is_azure_resource_event(event: dict[str, Any]) -> bool:
+    if "events" in event:
+        return any(map(is_azure_resource_event, event["events"]))
+    subject: Final = event.get("subject", "").lower()
+    return event.get("eventType") in AZURE_RESOURCE_EVENTS and any(kind in subject for kind in AZURE_RESOURCE_TYPES)
+
+
+class EventSource(ChangeSource):
+    name = "events"
+
+    def __init__(self, queue: MessageQueue, is_relevant: Callable[[dict[str, Any]], bool]) -> None:
+        self.queue = queue
+        self.is_relevant = is_relevant
+
+    async def wait(self) -> str:
+        while True:
+            try:
+                messages = await self.queue.receive()
+            except Exception:
+                log.exception("Unable to receive change events")
+                await asyncio.sleep(RECEIVE_WAIT_SECONDS)
+                continue
+
+            relevant = 0
+            for message in messages:
+                event = decode_event(message.body)
+                if event is None:
+                    log.warning("Ignoring undecodable change event: %.200s", message.body)
+                elif self.is_relevant(event):
+                    relevant += 1
+            # the lookup that follows is a full scan, so events are acknowledged before it runs; unacknowledged ones are
+            # only delivered again
+            try:
+                await self.queue.ack(messages)
+            except Exception:
+                log.exception("Unable to acknowledge change events")
+
+            if relevant:
+                return f"{relevant} change event(s)"
+            log.debug("Ignored %d irrelevant change event(s)", len(messages))
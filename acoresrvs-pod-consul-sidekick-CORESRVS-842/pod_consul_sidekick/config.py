@@ -35,14 +35,67 @@ class Settings(pydantic.BaseSettings):
     PEERINGACCEPTOR_RESOURCE_PLURAL = "peeringacceptors"
 
     ROUTER_NAME_SUFFIX: str = "tenant-services"
+    # partitions the tenant services router into this many independently hashed and patched shards (0 = off)
+    ROUTER_SHARDS: int = 0
     PEERING_TOKEN_NAME_SUFFIX: str = "peering"
 
     POD_ID: str
     SERVICES: dict[str, Service]
     SLEEP: float = 2 * 60
     SLEEP_SPLAY: float = 2 * 60 + 20
+    # upper bound of the adaptive polling backoff while nothing changes
+    SLEEP_MAX: float = 10 * 60
+    # queue receiving tag change events (SQS on AWS, storage queue fed by Event Grid on Azure)
+    EVENT_QUEUE_URL: Optional[str]
+    # with an event queue, polling is only a safety net
+    RESYNC: float = 15 * 60
+    EVENT_DEBOUNCE: float = 2.0
+    # states published while a burst of changes lasts are coalesced into one reconcile of the newest
+    RECONCILE_DEBOUNCE: float = 2.0
+    RECONCILE_MAX_DELAY: float = 30.0
+    # reconciles everything this often to correct drift (0 = never)
+    DRIFT_CORRECTION: float = 60 * 60
     CLOUD: str = "AWS"
+    # regions and roles (in addition to the default credentials) searched for accounts, one lookup per combination
+    AWS_REGIONS: List[str] = []
+    AWS_ROLE_ARNS: List[str] = []
+    AWS_CONCURRENCY: int = 4
+    AWS_SHARD_TIMEOUT: float = 60.0
+    # last reconciled state (not saved by dry runs), loaded on startup so a restart without changes doesn't reconcile
+    # everything again
+    SNAPSHOT_PATH: Optional[str]
+    SNAPSHOT_CONFIGMAP: Optional[str]
+    # write CRDs with server-side apply (field manager pod-consul-sidekick) instead of create/patch
+    SERVER_SIDE_APPLY: bool = False
+    # run several replicas: a Lease elected leader reconciles the pod level CRDs, per account CRDs are spread over all
+    LEADER_ELECTION: bool = False
+    # defaults to the hostname, i.e. the pod name
+    REPLICA_ID: Optional[str]
+    LEASE_DURATION: float = 15.0
+    # seconds to wait for Consul to write the peering token secret before giving up
+    PEERING_SECRET_TIMEOUT: float = 10 * 60
+    # serves Prometheus metrics on this port
+    METRICS_PORT: Optional[int]
+    # writes a folded stack profile to PROFILE_DIR for every reconcile cycle taking longer than this many seconds; the
+    # sampling profiler only runs when this is set
+    PROFILE_THRESHOLD: Optional[float]
+    PROFILE_DIR: str = "/tmp"
+    PROFILE_INTERVAL: float = 0.05
+    APPLY_CONCURRENCY: int = 16
+    APPLY_RETRIES: int = 5
+    APPLY_BACKOFF: float = 0.5
+    # seconds a stale CRD is kept in case its account comes back; deleted by the first reconcile after that
+    GC_GRACE: float = 0.0
+    # keep-alive connections to the API server shared by all CRD requests (watches have their own), and their timeouts
+    K8S_CONNECTIONS: int = 32
+    K8S_TIMEOUT: float = 30.0
+    K8S_CONNECT_TIMEOUT: float = 5.0
+    # objects per page when listing CRDs
+    K8S_LIST_PAGE_SIZE: int = 500
     SUBSCRIPTION_ID: Optional[str]
+    # additional subscriptions to look for accounts in, optionally queried concurrently
+    SUBSCRIPTION_IDS: List[str] = []
+    AZURE_FAN_OUT: bool = False
 
     class Config:
         env_nested_delimiter = "__"
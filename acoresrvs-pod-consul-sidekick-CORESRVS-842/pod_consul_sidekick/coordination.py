@@ -0,0 +1,167 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Final, Iterable, Optional
+
+import kubernetes
+from kubernetes.client import ApiException
+
+from .change_sources import ChangeSource
+from .k8s_client import api_client
+
+log: Final = logging.getLogger(__name__)
+
+MEMBER_LABEL: Final = "pod-consul-sidekick/member-of"
+# points per member on the hash ring; more points spread accounts more evenly
+RING_REPLICAS: Final = 64
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    # consistent hashing: when a member joins or leaves, only the keys of the neighbouring points move
+    def __init__(self, members: Iterable[str], replicas: int = RING_REPLICAS) -> None:
+        self.members: Final = tuple(sorted(set(members)))
+        points: Final = sorted((_point(f"{member}#{i}"), member) for member in self.members for i in range(replicas))
+        self._points: Final = [point for point, _ in points]
+        self._owners: Final = [member for _, member in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._points:
+            return None
+        return self._owners[bisect.bisect(self._points, _point(key)) % len(self._points)]
+
+
+class Coordinator(ChangeSource):
+    # Replicas of one pod's sidekick coordinate through Leases: one Lease elects the leader, which reconciles the pod
+    # level objects, and every replica renews a Lease of its own, labeled as a member. Per account objects are spread
+    # over the live members with a hash ring. Leadership or membership changes wake up the monitor loop with a full
+    # reconcile, so a replica picks up the accounts it just became responsible for.
+    name = "membership"
+    full_reconcile = True
+
+    def __init__(self, group: str, namespace: str, identity: str, *, lease_duration: float = 15.0) -> None:
+        self.group = group
+        self.namespace = namespace
+        self.identity = identity
+        self.lease_duration = lease_duration
+
+        self.leader_lease: Final = f"{group}-leader"
+        self.member_lease: Final = f"{group}-{identity}"
+        self.is_leader = False
+        self.ring = HashRing([identity])
+        self._changed: Final = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def owns(self, key: Optional[str]) -> bool:
+        # objects that can't be attributed to an account belong to the leader
+        if key is None:
+            return self.is_leader
+        return self.ring.owner(key) == self.identity
+
+    def _hold(self, api: kubernetes.client.CoordinationV1Api, name: str, labels: Optional[dict[str, str]]) -> bool:
+        # acquires or renews a Lease, unless someone else holds it and hasn't let it expire
+        now: Final = datetime.now(timezone.utc)
+        try:
+            lease = api.read_namespaced_lease(name, self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            lease = kubernetes.client.V1Lease(
+                metadata=kubernetes.client.V1ObjectMeta(name=name, namespace=self.namespace, labels=labels),
+                spec=kubernetes.client.V1LeaseSpec(
+                    holder_identity=self.identity,
+                    lease_duration_seconds=round(self.lease_duration),
+                    acquire_time=now,
+                    renew_time=now,
+                    lease_transitions=0,
+                ),
+            )
+            try:
+                api.create_namespaced_lease(self.namespace, lease)
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+                return False
+            return True
+
+        spec: Final = lease.spec
+        if spec.holder_identity != self.identity:
+            if not self._expired(spec, now):
+                return False
+            log.info("Taking over lease %s from %s", name, spec.holder_identity or "nobody")
+            spec.holder_identity = self.identity
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.renew_time = now
+        spec.lease_duration_seconds = round(self.lease_duration)
+        try:
+            # carries the resourceVersion that was read, so of two replicas racing for the lease only one wins
+            api.replace_namespaced_lease(name, self.namespace, lease)
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            return False
+        return True
+
+    def _expired(self, spec: kubernetes.client.V1LeaseSpec, now: datetime) -> bool:
+        if spec.renew_time is None:
+            return True
+        return spec.renew_time + timedelta(seconds=spec.lease_duration_seconds or self.lease_duration) < now
+
+    def _members(self, api: kubernetes.client.CoordinationV1Api) -> list[str]:
+        now: Final = datetime.now(timezone.utc)
+        members: Final[list[str]] = []
+        for lease in api.list_namespaced_lease(self.namespace, label_selector=f"{MEMBER_LABEL}={self.group}").items:
+            if not self._expired(lease.spec, now):
+                members.append(lease.spec.holder_identity)
+            elif self.is_leader and self._expired(lease.spec, now - timedelta(seconds=2 * self.lease_duration)):
+                # replicas don't get the chance to remove their own lease when their pod goes away
+                log.info("Removing lease %s of departed member %s", lease.metadata.name, lease.spec.holder_identity)
+                try:
+                    api.delete_namespaced_lease(lease.metadata.name, self.namespace)
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
+        return members
+
+    def _tick(self) -> tuple[bool, list[str]]:
+        api: Final = kubernetes.client.CoordinationV1Api(api_client())
+        self._hold(api, self.member_lease, {MEMBER_LABEL: self.group})
+        return self._hold(api, self.leader_lease, None), self._members(api)
+
+    async def _update(self) -> None:
+        try:
+            is_leader, members = await asyncio.to_thread(self._tick)
+        except Exception:
+            # without a renewal the lease runs out, so leadership can't be assumed any more
+            log.exception("Unable to renew leases")
+            is_leader, members = False, list(self.ring.members)
+
+        ring: Final = HashRing(members)
+        if is_leader != self.is_leader or ring.members != self.ring.members:
+            log.info(
+                "%s is %s; members: %s", self.identity, "the leader" if is_leader else "a follower", ", ".join(members)
+            )
+            self.is_leader, self.ring = is_leader, ring
+            self._changed.set()
+
+    async def _run(self) -> None:
+        # renewing three times per lease duration leaves room for a failed attempt or two
+        while True:
+            await asyncio.sleep(self.lease_duration / 3)
+            await self._update()
+
+    async def start(self) -> None:
+        await self._update()
+        self._changed.clear()
+        self._task = asyncio.create_task(self._run(), name="coordinator")
+
+    async def wait(self) -> str:
+        await self._changed.wait()
+        self._changed.clear()
+        return f"{'leader' if self.is_leader else 'follower'} of {len(self.ring.members)} member(s)"
@@ -1,17 +1,11 @@
-import itertools
-from typing import Final, Iterable, Sequence
+import zlib
+from typing import Any, Final, Iterable, Mapping, NamedTuple, Optional, Sequence
 
 from .config import Service, ServiceType, Settings
+from .index import AccountIndex
 from .models import (
-    ConsulRoute,
-    ConsulRouteDestination,
-    ConsulRouteMatch,
-    ConsulRouteMatchHttp,
-    ConsulRouteMatchHttpHeader,
     ConsulRouterSpec,
-    ConsulServiceIntentionDestination,
     ConsulServiceIntentionSpec,
-    ConsulSourceIntention,
     ConsulSourceIntentionAction,
     Secret,
     Peer,
@@ -24,56 +18,103 @@ HEADER_SERVICE_NAME: Final = "X-Service"
 settings: Final = Settings()
 
 
-def construct_route(system: str, service: str) -> ConsulRoute:
-    service_config = settings.SERVICES.get(service)
-    return ConsulRoute(
-        match=ConsulRouteMatch(
-            http=ConsulRouteMatchHttp(
-                header=[
-                    ConsulRouteMatchHttpHeader(name=HEADER_SYSTEM_NAME, exact=system),
-                    ConsulRouteMatchHttpHeader(name=HEADER_SERVICE_NAME, exact=service),
-                ]
-            )
-        ),
-        destination=ConsulRouteDestination(
-            service=f"{service}-{system}", requestTimeout=service_config.request_timeout
-        ),
-    )
+# Large router specs are built as plain dicts shaped exactly like
+# ConsulRoute.dict(by_alias=True, exclude_unset=True) and wrapped with ConsulRouterSpec.construct(), which skips
+# validating every nested model while serializing to the same JSON as the validated ConsulRoute models.
+class RouteTemplate(NamedTuple):
+    service: str
+    header: dict[str, str]
+    request_timeout: str
+
+    @classmethod
+    def for_service(cls, service: str) -> "RouteTemplate":
+        service_config = settings.SERVICES.get(service)
+        return cls(service, {"name": HEADER_SERVICE_NAME, "exact": service}, service_config.request_timeout)
+
+    @property
+    def prefix(self) -> str:
+        return f"{self.service}-"
+
+    def route(
+        self, system: str, system_header: Optional[dict[str, str]] = None, destination: Optional[str] = None
+    ) -> dict[str, Any]:
+        return {
+            "match": {"http": {"header": [system_header or system_match(system), self.header]}},
+            "destination": {"service": destination or self.prefix + system, "requestTimeout": self.request_timeout},
+        }
+
+
+def system_match(system: str) -> dict[str, str]:
+    return {"name": HEADER_SYSTEM_NAME, "exact": system}
 
 
-def construct_routes(systems: Sequence[str], services: Iterable[str]) -> ConsulRouterSpec:
-    return ConsulRouterSpec(
-        routes=[construct_route(system, service) for service in sorted(services) for system in sorted(systems)]
+def construct_routes(
+    systems: Sequence[str], services: Iterable[str], index: Optional[AccountIndex] = None
+) -> ConsulRouterSpec:
+    # destinations come from the index's name tables when there is one, shared with the pod router
+    tables: Final = index if index is not None else AccountIndex({})
+    system_headers: Final = [(system, system_match(system)) for system in sorted(systems)]
+    routes: Final[list[dict[str, Any]]] = []
+    for template in map(RouteTemplate.for_service, sorted(services)):
+        destinations = tables.names(template.prefix)
+        routes.extend(template.route(system, header, destinations[system]) for system, header in system_headers)
+    return ConsulRouterSpec.construct(routes=routes)
+
+
+def generate_routes(accounts: Mapping[str, Iterable[str]], services: dict[str, Service]) -> ConsulRouterSpec:
+    index: Final = AccountIndex.of(accounts)
+    templates: Final[dict[ServiceType, list[tuple[RouteTemplate, Mapping[str, str]]]]] = {
+        service_type: [] for service_type in (ServiceType.default, ServiceType.shared, ServiceType.account)
+    }
+    for service, service_details in sorted(services.items()):
+        if service_details.type in templates:
+            template = RouteTemplate.for_service(service)
+            templates[service_details.type].append((template, index.names(template.prefix)))
+
+    # the system/account header is the same for every service, so it's built once and shared
+    account_headers: Final = [(account, system_match(account)) for account in index]
+    routes = (
+        [
+            template.route(system, header, destinations[system])
+            for system, header in ((system, system_match(system)) for system in index.systems)
+            for template, destinations in templates[ServiceType.default]
+        ]
+        + [
+            template.route(account, header, destinations[account])
+            for account, header in account_headers
+            for template, destinations in templates[ServiceType.shared]
+        ]
+        + [
+            template.route(account, header, destinations[account])
+            for account, header in account_headers
+            for template, destinations in templates[ServiceType.account]
+        ]
     )
+    return ConsulRouterSpec.construct(routes=routes)
+
+
+def router_shard(account: str, shards: int) -> int:
+    # crc32 rather than hash() so an account stays in the same shard across restarts
+    return zlib.crc32(account.encode()) % shards
 
 
-def generate_routes(accounts: dict[str, Iterable[str]], services: dict[str, Service]) -> ConsulRouterSpec:
-    routes = [
-        construct_route(system, service)
-        for system in sorted(itertools.chain.from_iterable(accounts.values()))
-        for service, service_details in sorted(services.items())
-        if service_details.type is ServiceType.default
-    ] + [
-        construct_route(account, service)
-        for account in sorted(accounts.keys())
-        for service, service_details in sorted(services.items())
-        if service_details.type is ServiceType.shared
-    ] + [
-        construct_route(account, service)
-        for account in sorted(accounts.keys())
-        for service, service_details in sorted(services.items())
-        if service_details.type is ServiceType.account
-    ]
-    return ConsulRouterSpec(routes=routes)
+def generate_route_shards(
+    accounts: Mapping[str, Iterable[str]], services: dict[str, Service], shards: int
+) -> list[ConsulRouterSpec]:
+    # every route of an account (system, shared and account routes) lands in the same shard, so a changed account
+    # only changes its own shard
+    index: Final = AccountIndex.of(accounts)
+    partitions: Final[list[list[str]]] = [[] for _ in range(shards)]
+    for account in index:
+        partitions[router_shard(account, shards)].append(account)
+    return [generate_routes(index.select(partition), services) for partition in partitions]
 
 
 def construct_intent(destination: str, sources: Iterable[str]) -> ConsulServiceIntentionSpec:
-    source_intentions = [
-        ConsulSourceIntention(name=source, action=ConsulSourceIntentionAction.allow) for source in sources
-    ]
-    return ConsulServiceIntentionSpec(
-        destination=ConsulServiceIntentionDestination(name=destination),
-        sources=source_intentions,
+    # built like the router specs: plain dicts shaped like the validated models' exclude_unset output
+    return ConsulServiceIntentionSpec.construct(
+        destination={"name": destination},
+        sources=[{"name": source, "action": ConsulSourceIntentionAction.allow.value} for source in sources],
     )
 
 def generate_peeringacceptorspec(secret_name) -> PeeringAcceptorSpec:
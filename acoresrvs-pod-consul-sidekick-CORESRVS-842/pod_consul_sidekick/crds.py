@@ -1,11 +1,12 @@
-import itertools
 from abc import ABCMeta, abstractmethod
 from collections import defaultdict
 from operator import itemgetter
-from typing import Generator, Mapping, Sequence
+from typing import Final, Generator, Mapping, NamedTuple, Sequence
 
 from .config import Service, ServiceType
 from .crd_utils import construct_intent, construct_routes
+from .discovery import AccountsDiff
+from .index import AccountIndex
 from .models import ConsulRouterSpec, ConsulServiceIntentionSpec
 
 
@@ -30,6 +31,21 @@ class DefaultCRD(metaclass=ABCMeta):
     ) -> Generator[tuple[str, ConsulRouterSpec], None, None]:
         ...
 
+    def affected(self, accounts: Mapping[str, Sequence[str]], diff: AccountsDiff) -> AccountIndex:
+        # subset of accounts whose specs need to be regenerated after the diff
+        return AccountIndex.of(accounts).select(diff.added | diff.changed)
+
+    def stale_names(self, accounts: Mapping[str, Sequence[str]], diff: AccountsDiff) -> frozenset[str]:
+        # names that only belonged to removed accounts/systems; a system still listed under any account (one that moved
+        # between accounts, or is shared with an untouched one) keeps its names
+        index: Final = AccountIndex.of(accounts)
+        remaining: Final = index.select(
+            {account for account in diff.touched if account in index}.union(
+                *(index.accounts_of(system) for systems in diff.removed_systems.values() for system in systems)
+            )
+        )
+        return self.names(index.view(diff.removed_systems)) - self.names(remaining)
+
 
 class SharedServicesCRD(DefaultCRD):
     tag = "shared-services"
@@ -39,14 +55,26 @@ class SharedServicesCRD(DefaultCRD):
         return f"shared-{service}-{account}"
 
     def names(self, accounts: Mapping[str, Sequence[str]]) -> frozenset[str]:
+        index: Final = AccountIndex.of(accounts)
         return frozenset(
-            self._name(service, account) for account in accounts.keys() for service in self.services.keys()
+            index.names(self._name(service, ""))[account] for account in index for service in self.services.keys()
         )
 
     def specs(self, accounts: Mapping[str, Sequence[str]]) -> Generator[tuple[str, ConsulRouterSpec], None, None]:
-        for account, systems in sorted(accounts.items()):
+        index: Final = AccountIndex.of(accounts)
+        for account in index:
             for service, service_detail in sorted(self.services.items()):
-                yield self._name(service, account), construct_routes(systems, service_detail.upstreams)
+                yield index.names(self._name(service, ""))[account], construct_routes(
+                    index.ordered(account), service_detail.upstreams, index
+                )
+
+
+class _Intention(NamedTuple):
+    # one destination of the intention graph: its name is prefix + system (or + account when shared), and so is the
+    # name of each source, which is kept sorted together with whether it is named after the account
+    prefix: str
+    shared: bool
+    sources: tuple[tuple[str, bool], ...]
 
 
 class TenantServicesIntentCRD(DefaultCRD):
@@ -55,6 +83,11 @@ class TenantServicesIntentCRD(DefaultCRD):
     def __init__(self, pod_int: str, services: Mapping[str, Service]) -> None:
         super().__init__(pod_int, services)
         self.destinations = self._destinations_form_services()
+        self.graph: Final = self._compile()
+        # a shared destination lists the sources of every system of its account
+        self._account_wide: Final = any(
+            intention.shared and not all(shared for _, shared in intention.sources) for intention in self.graph
+        )
 
     @staticmethod
     def _name(service: str, account_system: str) -> str:
@@ -71,32 +104,61 @@ class TenantServicesIntentCRD(DefaultCRD):
     def _is_shared(self, service: str) -> bool:
         return service in self.services and self.services[service].type is ServiceType.shared
 
-    def names(self, accounts: Mapping[str, Sequence[str]]) -> frozenset[str]:
-        accs = accounts.keys()
-        systems = list(itertools.chain.from_iterable(accounts.values()))
+    def _compile(self) -> tuple[_Intention, ...]:
+        return tuple(
+            _Intention(
+                self._name(destination, ""),
+                self._is_shared(destination),
+                tuple((self._name(source, ""), self._is_shared(source)) for source in sorted(sources)),
+            )
+            for destination, sources in sorted(self.destinations.items(), key=itemgetter(0))
+        )
 
-        names: set[str] = set()
-        for destination_name in self.destinations.keys():
-            if self._is_shared(destination_name):
-                names.update(self._name(destination_name, account) for account in accs)
-            else:
-                names.update(self._name(destination_name, system) for system in systems)
+    def affected(self, accounts: Mapping[str, Sequence[str]], diff: AccountsDiff) -> Mapping[str, Sequence[str]]:
+        # intents of unshared destinations depend only on the system and the name of its account, so existing systems
+        # are left alone unless a shared destination has to list them
+        if self._account_wide:
+            return super().affected(accounts, diff)
+        return AccountIndex.of(accounts).view(diff.added_systems)
 
+    def names(self, accounts: Mapping[str, Sequence[str]]) -> frozenset[str]:
+        index: Final = AccountIndex.of(accounts)
+        names: Final[set[str]] = set()
+        for account, systems in index.ordered_items():
+            for intention in self.graph:
+                table = index.names(intention.prefix)
+                if intention.shared:
+                    names.add(table[account])
+                else:
+                    names.update(map(table.__getitem__, systems))
         return frozenset(names)
 
     def specs(
         self, accounts: Mapping[str, Sequence[str]]
     ) -> Generator[tuple[str, ConsulServiceIntentionSpec], None, None]:
-        for destination_name, source_services in sorted(self.destinations.items(), key=itemgetter(0)):
-            if self._is_shared(destination_name):
-                raise NotImplementedError("Not implemented yet")
-            else:
-                for account, systems in sorted(accounts.items(), key=itemgetter(0)):
-                    for system in sorted(systems):
-                        true_sources: list[str] = []
-                        for source in sorted(source_services):
-                            true_sources.append(self._name(source, account if self._is_shared(source) else system))
-
-                        yield self._name(destination_name, system), construct_intent(
-                            self._name(destination_name, system), true_sources
+        index: Final = AccountIndex.of(accounts)
+        tables: Final = {
+            prefix: index.names(prefix)
+            for intention in self.graph
+            for prefix in (intention.prefix, *(prefix for prefix, _ in intention.sources))
+        }
+        for account, systems in index.ordered_items():
+            for intention in self.graph:
+                table = tables[intention.prefix]
+                if intention.shared:
+                    name = table[account]
+                    sources = [
+                        source
+                        for prefix, shared in intention.sources
+                        for source in (
+                            [tables[prefix][account]] if shared else list(map(tables[prefix].__getitem__, systems))
+                        )
+                    ]
+                    yield name, construct_intent(name, sources)
+                else:
+                    for system in systems:
+                        name = table[system]
+                        yield name, construct_intent(
+                            name,
+                            [tables[prefix][account if shared else system] for prefix, shared in intention.sources],
                         )
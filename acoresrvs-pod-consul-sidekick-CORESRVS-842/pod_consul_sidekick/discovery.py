@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from abc import ABCMeta, abstractmethod
+from typing import AsyncGenerator, Awaitable, Final, Mapping, NamedTuple, Optional, Sequence, Set
+
+from .change_sources import ChangeSource, PollingSource
+from .index import AccountIndex
+from .metrics import STAGE_SECONDS
+
+log: Final = logging.getLogger(__name__)
+
+
+class AccountsDiff(NamedTuple):
+    added: frozenset[str]
+    removed: frozenset[str]
+    # accounts present before and after whose systems differ
+    changed: frozenset[str]
+    # per account systems that appeared/disappeared, including whole added/removed accounts
+    added_systems: Mapping[str, frozenset[str]]
+    removed_systems: Mapping[str, frozenset[str]]
+
+    @classmethod
+    def between(cls, old: Mapping[str, Set[str]], new: Mapping[str, Set[str]]) -> "AccountsDiff":
+        if isinstance(old, AccountIndex) and isinstance(new, AccountIndex) and old == new:
+            return cls(frozenset(), frozenset(), frozenset(), {}, {})
+        added_systems: Final[dict[str, frozenset[str]]] = {}
+        removed_systems: Final[dict[str, frozenset[str]]] = {}
+        for account in old.keys() | new.keys():
+            old_systems = old.get(account, frozenset())
+            new_systems = new.get(account, frozenset())
+            if old_systems == new_systems:
+                continue
+            if new_systems - old_systems:
+                added_systems[account] = frozenset(new_systems - old_systems)
+            if old_systems - new_systems:
+                removed_systems[account] = frozenset(old_systems - new_systems)
+
+        return cls(
+            added=frozenset(new.keys() - old.keys()),
+            removed=frozenset(old.keys() - new.keys()),
+            changed=frozenset(account for account in old.keys() & new.keys() if old[account] != new[account]),
+            added_systems=added_systems,
+            removed_systems=removed_systems,
+        )
+
+    @property
+    def touched(self) -> frozenset[str]:
+        return self.added | self.removed | self.changed
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.added)} added, {len(self.removed)} removed, {len(self.changed)} changed accounts; "
+            f"{sum(map(len, self.added_systems.values()))} added, "
+            f"{sum(map(len, self.removed_systems.values()))} removed systems"
+        )
+
+
+class AccountsUpdate(NamedTuple):
+    accounts: AccountIndex
+    # None requests a full reconcile (e.g. nothing is known about the previous state)
+    diff: Optional[AccountsDiff]
+    # some accounts may be missing rather than removed (e.g. a lookup shard never answered), so nothing is deleted
+    partial: bool = False
+
+
+class Discovery(metaclass=ABCMeta):
+    @abstractmethod
+    async def lookup(self) -> dict[str, set[str]]:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+    @property
+    def partial(self) -> bool:
+        # whether the last lookup is missing the accounts of a source that has never answered
+        return False
+
+    async def monitor(
+        self,
+        sleep_time: float,
+        sleep_splay: float,
+        *,
+        max_sleep_time: Optional[float] = None,
+        sources: Sequence[ChangeSource] = (),
+        debounce: float = 0.0,
+        initial: Optional[Mapping[str, Set[str]]] = None,
+        first_lookup: Optional[Awaitable[Mapping[str, Set[str]]]] = None,
+    ) -> AsyncGenerator[AccountsUpdate, None]:
+        # polling is always there as a safety net; event sources only make lookups happen sooner
+        poller: Final = PollingSource(sleep_time, sleep_splay, max_sleep_time)
+        waiters: Final[dict[ChangeSource, asyncio.Task[str]]] = {}
+        # with a known previous state (e.g. a snapshot) even the first update is incremental, and is always yielded
+        old_accounts: Optional[AccountIndex] = AccountIndex.of(initial) if initial is not None else None
+        first = initial is not None
+        full = False
+        try:
+            while True:
+                # the first lookup may have been started earlier, e.g. while the rest of the startup was going on
+                lookup = first_lookup if first_lookup is not None else self.lookup()
+                first_lookup = None
+                try:
+                    with STAGE_SECONDS.time(stage="lookup"):
+                        new_accounts = AccountIndex(await lookup)
+                except Exception:
+                    # retried on the next trigger; nothing is reconciled from a partial view
+                    log.exception("Unable to look up accounts")
+                    new_accounts = None
+
+                if new_accounts is None:
+                    poller.feedback(True)
+                elif self.partial:
+                    # the first complete lookup after this one reconciles everything again
+                    log.warning("Lookup found %d accounts, some are missing", len(new_accounts))
+                    full = True
+                    yield AccountsUpdate(new_accounts, None, partial=True)
+                    old_accounts = new_accounts
+                    poller.feedback(True)
+                elif old_accounts is None or full:
+                    log.info(
+                        "%s lookup found %d accounts", "Initial" if old_accounts is None else "Full", len(new_accounts)
+                    )
+                    full = False
+                    yield AccountsUpdate(new_accounts, None)
+                    old_accounts = new_accounts
+                    poller.feedback(True)
+                elif (diff := AccountsDiff.between(old_accounts, new_accounts)) or first:
+                    log.info("Accounts changed: %s", diff)
+                    first = False
+                    yield AccountsUpdate(new_accounts, diff)
+                    old_accounts = new_accounts
+                    poller.feedback(bool(diff))
+                else:
+                    log.info("No change")
+                    poller.feedback(False)
+
+                # the safety net timer restarts after every lookup, event sources keep listening in between
+                if (timer := waiters.pop(poller, None)) is not None:
+                    timer.cancel()
+                for source in (poller, *sources):
+                    if source not in waiters:
+                        waiters[source] = asyncio.create_task(source.wait(), name=f"change-source-{source.name}")
+
+                done, _ = await asyncio.wait(waiters.values(), return_when=asyncio.FIRST_COMPLETED)
+                for source, waiter in list(waiters.items()):
+                    if waiter in done:
+                        del waiters[source]
+                        full = full or source.full_reconcile
+                        log.info("Looking up accounts (%s: %s)", source.name, waiter.result())
+
+                if debounce and waiters.get(poller) is not None:
+                    # let a burst of events settle before scanning
+                    await asyncio.sleep(debounce)
+        finally:
+            for waiter in waiters.values():
+                waiter.cancel()
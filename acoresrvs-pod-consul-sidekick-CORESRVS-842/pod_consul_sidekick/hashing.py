@@ -0,0 +1,74 @@
+import hashlib
+from json import JSONEncoder
+from typing import Any, Final, Iterator
+
+import pydantic
+
+# sha256 is fed in chunks of about this size instead of per token
+BUFFER_SIZE: Final = 64 * 1024
+
+# same settings as json.dumps() (and so pydantic's .json()) uses
+_encoder: Final = JSONEncoder()
+
+
+def json_chunks(value: Any) -> Iterator[str]:
+    # yields the same text as value.json(by_alias=True, exclude_unset=True) for the spec models, or json.dumps() for
+    # plain data, without building the dict tree or the whole string: models and lists are walked here, everything
+    # below them (e.g. a single route) is encoded in one go by the C encoder
+    if isinstance(value, pydantic.BaseModel):
+        fields: Final = value.__fields__
+        fields_set: Final = value.__fields_set__
+        yield "{"
+        first = True
+        for name, field_value in value.__dict__.items():
+            if name not in fields_set:
+                continue
+            if not first:
+                yield ", "
+            first = False
+            field = fields.get(name)
+            yield _encoder.encode(field.alias if field is not None else name)
+            yield ": "
+            yield from json_chunks(field_value)
+        yield "}"
+    elif isinstance(value, (list, tuple)):
+        yield "["
+        for i, item in enumerate(value):
+            if i:
+                yield ", "
+            yield from json_chunks(item)
+        yield "]"
+    elif isinstance(value, dict):
+        try:
+            yield _encoder.encode(value)
+        except TypeError:
+            # models nested in plain data
+            yield from _dict_chunks(value)
+    else:
+        yield _encoder.encode(value)
+
+
+def _dict_chunks(value: dict[str, Any]) -> Iterator[str]:
+    yield "{"
+    for i, (key, item) in enumerate(value.items()):
+        if i:
+            yield ", "
+        yield _encoder.encode(str(key))
+        yield ": "
+        yield from json_chunks(item)
+    yield "}"
+
+
+def spec_hash(value: Any) -> str:
+    m: Final = hashlib.sha256()
+    buffer: list[str] = []
+    size = 0
+    for chunk in json_chunks(value):
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= BUFFER_SIZE:
+            m.update("".join(buffer).encode())
+            buffer.clear()
+            size = 0
+    m.update("".join(buffer).encode())
+    return m.hexdigest()
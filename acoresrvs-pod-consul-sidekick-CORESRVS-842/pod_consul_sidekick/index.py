@@ -0,0 +1,114 @@
+import hashlib
+import itertools
+import sys
+from functools import cached_property
+from typing import Final, Iterable, Iterator, Mapping
+
+
+class Names(dict[str, str]):
+    # prefix + account/system name for every account and system of an index, built in one go on first use and then
+    # shared by everything generating these names; other names are built on the fly
+    def __init__(self, prefix: str, names: Iterable[str]) -> None:
+        super().__init__({name: prefix + name for name in names})
+        self.prefix = prefix
+
+    def __missing__(self, name: str) -> str:
+        return self.prefix + name
+
+
+class AccountIndex(Mapping[str, frozenset[str]]):
+    # Immutable accounts -> systems map with interned names, sorted once. Indexes compare by a digest of their
+    # content, and the prefixed name tables are shared with the views of the subsets reconciled incrementally.
+    def __init__(self, accounts: Mapping[str, Iterable[str]]) -> None:
+        self._sorted: Final[dict[str, tuple[str, ...]]] = {
+            sys.intern(account): tuple(sorted(map(sys.intern, systems)))
+            for account, systems in sorted(accounts.items())
+        }
+        self._sets: Final[dict[str, frozenset[str]]] = {}
+        # views share the name tables of the index they were taken from, which cover all of its names
+        self._root: AccountIndex = self
+        self._tables: Final[dict[str, Names]] = {}
+
+    @classmethod
+    def of(cls, accounts: Mapping[str, Iterable[str]]) -> "AccountIndex":
+        return accounts if isinstance(accounts, AccountIndex) else cls(accounts)
+
+    def __getitem__(self, account: str) -> frozenset[str]:
+        systems = self._sets.get(account)
+        if systems is None:
+            systems = self._sets[account] = frozenset(self._sorted[account])
+        return systems
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._sorted)
+
+    def __len__(self) -> int:
+        return len(self._sorted)
+
+    def __contains__(self, account: object) -> bool:
+        return account in self._sorted
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, AccountIndex):
+            return self is other or self.digest == other.digest
+        return super().__eq__(other)
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __repr__(self) -> str:
+        return f"AccountIndex({len(self)} accounts, {sum(map(len, self._sorted.values()))} systems)"
+
+    @cached_property
+    def digest(self) -> str:
+        # stable across processes, unlike hash()
+        content: Final = hashlib.blake2b(digest_size=16)
+        for account, systems in self._sorted.items():
+            content.update(account.encode())
+            content.update(b"\x1f")
+            content.update("\x1e".join(systems).encode())
+            content.update(b"\x1d")
+        return content.hexdigest()
+
+    @cached_property
+    def systems(self) -> tuple[str, ...]:
+        # all systems, sorted; a system found in several accounts is there once per account
+        return tuple(sorted(itertools.chain.from_iterable(self._sorted.values())))
+
+    @cached_property
+    def _owners(self) -> dict[str, tuple[str, ...]]:
+        owners: Final[dict[str, list[str]]] = {}
+        for account, systems in self._sorted.items():
+            for system in systems:
+                owners.setdefault(system, []).append(account)
+        return {system: tuple(accounts) for system, accounts in owners.items()}
+
+    def accounts_of(self, system: str) -> tuple[str, ...]:
+        # every account listing the system, sorted
+        return self._owners.get(system, ())
+
+    def ordered(self, account: str) -> tuple[str, ...]:
+        return self._sorted[account]
+
+    def ordered_items(self) -> Iterator[tuple[str, tuple[str, ...]]]:
+        return iter(self._sorted.items())
+
+    def names(self, prefix: str) -> Names:
+        tables: Final = self._root._tables
+        table = tables.get(prefix)
+        if table is None:
+            table = tables[prefix] = Names(prefix, itertools.chain(self._root, self._root.systems))
+        return table
+
+    def select(self, accounts: Iterable[str]) -> "AccountIndex":
+        # a view of some of the accounts, sharing their systems and the name tables
+        view: Final = AccountIndex({})
+        view._sorted.update((account, self._sorted[account]) for account in sorted(accounts))
+        view._root = self._root
+        return view
+
+    def view(self, accounts: Mapping[str, Iterable[str]]) -> "AccountIndex":
+        # an index of other (sub)sets of systems, e.g. the ones a diff added, sharing the name tables
+        view: Final = AccountIndex(accounts)
+        view._root = self._root
+        return view
@@ -1,19 +1,52 @@
+import asyncio
 import hashlib
+import itertools
+import json
 import logging
 import pprint
-from typing import Final, Mapping, NamedTuple, Optional, Sequence, Type
-
+import re
+import threading
+import time
+from functools import partial
+from typing import Any, Callable, ClassVar, Final, Iterable, Iterator, Mapping, NamedTuple, Optional, Sequence, Type
+from urllib.parse import quote
+
+import aiohttp
 import kubernetes
 from kubernetes.client import ApiException
 
+from .apply import ApplyEngine, ApplyOutcome, ApplySummary, Operation
 from .config import Service
 from .crds import DefaultCRD
+from .discovery import AccountsDiff
+from .hashing import spec_hash
+from .index import AccountIndex
+from .k8s_client import PARTIAL_METADATA, PARTIAL_METADATA_LIST, KubernetesClient, custom_objects_path
+from .metrics import CRD_OBJECTS, PATCH_BYTES_SAVED, STAGE_SECONDS
 from .models import ConsulRouterSpec, KubernetesResource, KubernetesResourceMetadata
+from .patching import AppliedSpec, applied_spec, metadata_operations, spec_operations
 
 log: Final = logging.getLogger(__name__)
 
 HASH_ANNOTATION: Final = "hash"
+SHARDS_ANNOTATION: Final = "shards"
+# per shard hash prefix kept in the shards annotation
+SHARD_HASH_LENGTH: Final = 16
 DYNAMIC_LABEL: Final = "pod-consul-sidekick"
+FIELD_MANAGER: Final = "pod-consul-sidekick"
+ACCOUNT_LABEL: Final = f"{DYNAMIC_LABEL}/account"
+LABEL_VALUE: Final = re.compile(r"^(?:[A-Za-z0-9](?:[-A-Za-z0-9_.]{0,61}[A-Za-z0-9])?)?$")
+WATCH_TIMEOUT_SECONDS: Final = 5 * 60
+WATCH_RETRY_SECONDS: Final = 5.0
+SECRET_RETRY_SECONDS: Final = 0.5
+SECRET_MAX_RETRY_SECONDS: Final = 30.0
+
+
+def account_label(account: str) -> str:
+    # label values are limited to 63 alphanumerics, '-', '_' and '.'; other account names are replaced by a digest
+    if LABEL_VALUE.match(account):
+        return account
+    return f"sha256-{hashlib.sha256(account.encode()).hexdigest()[:40]}"
 
 
 class CRDGroup(NamedTuple):
@@ -27,8 +60,312 @@ class CRDResourceKind(NamedTuple):
     plural: str
 
 
+def labeled_hash(digest: str, labels: Optional[Mapping[str, str]]) -> str:
+    if not labels:
+        return digest
+    # labels are desired state too, e.g. the account label of a system that moved to another account
+    return hashlib.sha256(json.dumps([digest, sorted(labels.items())]).encode()).hexdigest()
+
+
+def crd_body(
+    group: CRDGroup,
+    kind: CRDResourceKind,
+    name: str,
+    spec: Any,
+    annotations: dict[str, str],
+    labels: Optional[dict[str, str]] = None,
+) -> dict[str, Any]:
+    body: Final = KubernetesResource(
+        apiVersion=f"{group.group}/{group.version}",
+        kind=kind.kind,
+        metadata=KubernetesResourceMetadata(
+            namespace=kind.namespace,
+            name=name,
+            annotations=annotations,
+        ),
+        spec=spec,
+    )
+
+    if labels:
+        body.metadata.labels = labels
+
+    return body.dict(by_alias=True, exclude_unset=True)
+
+
+class AppliedCRD(NamedTuple):
+    # what we last wrote to a CRD: its hash, the resourceVersion the write produced and the spec
+    hash: str
+    resource_version: str
+    spec: AppliedSpec
+
+
+def resource_version_test(resource_version: str) -> dict[str, Any]:
+    # fails the JSON patch (422) if anyone wrote the object since, even without touching the hash annotation
+    return {"op": "test", "path": "/metadata/resourceVersion", "value": resource_version}
+
+
+def patch_operations(previous: AppliedCRD, body: Mapping[str, Any], applied: AppliedSpec) -> list[dict[str, Any]]:
+    # JSON patch turning the object of our last write into `body`; fails on the server if the object was changed since
+    metadata: Final = body["metadata"]
+    return [
+        resource_version_test(previous.resource_version),
+        {"op": "test", "path": f"/metadata/annotations/{HASH_ANNOTATION}", "value": previous.hash},
+        *spec_operations(previous.spec, body["spec"], applied),
+        *metadata_operations("annotations", metadata.get("annotations") or {}),
+        *metadata_operations("labels", metadata.get("labels") or {}),
+    ]
+
+
+class CachedCRD(NamedTuple):
+    name: str
+    hash: Optional[str]
+    resource_version: str
+    shards: Optional[str] = None
+    # ACCOUNT_LABEL value
+    account: Optional[str] = None
+
+
+class CRDCache:
+    # informer-style index of CRDs matching a selector: listed once, then kept current by a resourceVersion watch
+
+    _caches: ClassVar[dict[tuple[CRDGroup, CRDResourceKind, Optional[str], Optional[str]], "CRDCache"]] = {}
+    _caches_lock: ClassVar = threading.Lock()
+    # state restored from a snapshot, consumed when the matching cache starts
+    _primed: ClassVar[dict[str, Mapping[str, Any]]] = {}
+
+    def __init__(
+        self,
+        group: CRDGroup,
+        kind: CRDResourceKind,
+        *,
+        label_selector: Optional[str] = None,
+        field_selector: Optional[str] = None,
+    ) -> None:
+        self.group = group
+        self.kind = kind
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+
+        self._lock: Final = threading.Lock()
+        self._items: dict[str, CachedCRD] = {}
+        # our own last writes by name
+        self._applied: dict[str, AppliedCRD] = {}
+        self._resource_version: Optional[str] = None
+        self._task: Optional[asyncio.Task[None]] = None
+        self._synced: Final = asyncio.Event()
+
+    @classmethod
+    def get(
+        cls,
+        group: CRDGroup,
+        kind: CRDResourceKind,
+        *,
+        label_selector: Optional[str] = None,
+        field_selector: Optional[str] = None,
+    ) -> "CRDCache":
+        key: Final = (group, kind, label_selector, field_selector)
+        with cls._caches_lock:
+            cache = cls._caches.get(key)
+            if cache is None:
+                cache = cls(group, kind, label_selector=label_selector, field_selector=field_selector)
+                cache.start()
+                cls._caches[key] = cache
+        return cache
+
+    @property
+    def key(self) -> str:
+        return (
+            f"{self.group.group}/{self.group.version}/{self.kind.namespace}/{self.kind.plural}"
+            f"?{self.label_selector or ''}&{self.field_selector or ''}"
+        )
+
+    @classmethod
+    def prime(cls, states: Mapping[str, Mapping[str, Any]]) -> None:
+        cls._primed = dict(states)
+
+    @classmethod
+    def export(cls) -> dict[str, dict[str, Any]]:
+        with cls._caches_lock:
+            caches: Final = list(cls._caches.values())
+        return {cache.key: cache._export() for cache in caches}
+
+    def _export(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "resourceVersion": self._resource_version,
+                "items": sorted(
+                    [entry.name, entry.hash, entry.shards, entry.account] for entry in self._items.values()
+                ),
+            }
+
+    def _restore(self, state: Mapping[str, Any]) -> None:
+        if not state.get("resourceVersion"):
+            return
+        with self._lock:
+            self._items = {name: CachedCRD(name, hash_, "", *extra) for name, hash_, *extra in state["items"]}
+            self._resource_version = state["resourceVersion"]
+        log.info(
+            "Restored %d %s CRDs (%s) at resourceVersion %s",
+            len(self._items),
+            self.kind.kind,
+            self._describe(),
+            self._resource_version,
+        )
+
+    @staticmethod
+    def _entry(obj: Mapping[str, Any]) -> CachedCRD:
+        metadata: Final = obj["metadata"]
+        annotations: Final = metadata.get("annotations") or {}
+        return CachedCRD(
+            metadata["name"],
+            annotations.get(HASH_ANNOTATION),
+            metadata.get("resourceVersion", ""),
+            annotations.get(SHARDS_ANNOTATION),
+            (metadata.get("labels") or {}).get(ACCOUNT_LABEL),
+        )
+
+    def _selectors(self) -> list[tuple[str, str]]:
+        selectors: Final[list[tuple[str, str]]] = []
+        if self.label_selector:
+            selectors.append(("labelSelector", self.label_selector))
+        if self.field_selector:
+            selectors.append(("fieldSelector", self.field_selector))
+        return selectors
+
+    def _path(self) -> str:
+        return custom_objects_path(self.group.group, self.group.version, self.kind.namespace, self.kind.plural)
+
+    async def _list(self) -> None:
+        # the index only needs metadata; pages are reduced to entries as they arrive
+        items: Final[dict[str, CachedCRD]] = {}
+        resource_version: Optional[str] = None
+        async for page in CRDUpdater.api().pages(self._path(), params=self._selectors(), accept=PARTIAL_METADATA_LIST):
+            items.update((entry.name, entry) for entry in map(self._entry, page["items"]))
+            resource_version = page["metadata"]["resourceVersion"]
+        with self._lock:
+            self._items = items
+            self._resource_version = resource_version
+        log.info("Cached %d %s CRDs (%s)", len(items), self.kind.kind, self._describe())
+
+    def _describe(self) -> str:
+        return ", ".join(filter(None, [self.label_selector, self.field_selector])) or "all"
+
+    def _handle_event(self, event_type: str, obj: Mapping[str, Any]) -> None:
+        resource_version: Final = obj.get("metadata", {}).get("resourceVersion")
+        with self._lock:
+            if event_type in ("ADDED", "MODIFIED"):
+                entry = self._entry(obj)
+                self._items[entry.name] = entry
+            elif event_type == "DELETED":
+                self._items.pop(obj["metadata"]["name"], None)
+
+            if resource_version:
+                self._resource_version = resource_version
+
+    async def _watch(self) -> None:
+        while True:
+            try:
+                if self._resource_version is None:
+                    await self._list()
+                self._synced.set()
+
+                async for event in CRDUpdater.api().watch(
+                    self._path(),
+                    params=[
+                        *self._selectors(),
+                        ("resourceVersion", self._resource_version or ""),
+                        ("allowWatchBookmarks", "true"),
+                    ],
+                    timeout_seconds=WATCH_TIMEOUT_SECONDS,
+                    accept=PARTIAL_METADATA,
+                ):
+                    if event["type"] == "ERROR":
+                        raise ApiException(status=event["object"].get("code"), reason=event["object"].get("message"))
+                    self._handle_event(event["type"], event["object"])
+            except ApiException as e:
+                if e.status == 410:
+                    log.info("Watch of %s CRDs (%s) expired; relisting", self.kind.kind, self._describe())
+                    self._resource_version = None
+                    continue
+                log.warning("Watch of %s CRDs (%s) failed: %s", self.kind.kind, self._describe(), e)
+                await asyncio.sleep(WATCH_RETRY_SECONDS)
+            except Exception:
+                log.exception("Watch of %s CRDs (%s) failed", self.kind.kind, self._describe())
+                await asyncio.sleep(WATCH_RETRY_SECONDS)
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+
+        # a restored index is brought up to date by the watch (or relisted if its resourceVersion is too old)
+        self._restore(self._primed.pop(self.key, {}))
+        self._task = asyncio.get_running_loop().create_task(
+            self._watch(), name=f"watch-{self.kind.plural}-{self._describe()}"
+        )
+
+    async def synced(self) -> None:
+        # listed (or restored) at least once
+        await self._synced.wait()
+
+    def lookup(self, name: str) -> Optional[CachedCRD]:
+        with self._lock:
+            return self._items.get(name)
+
+    def names(self) -> frozenset[str]:
+        with self._lock:
+            return frozenset(self._items)
+
+    def entries(self) -> list[CachedCRD]:
+        with self._lock:
+            return list(self._items.values())
+
+    def record(
+        self,
+        name: str,
+        hash_: str,
+        shards: Optional[str] = None,
+        applied: Optional[AppliedSpec] = None,
+        account: Optional[str] = None,
+        resource_version: Optional[str] = None,
+    ) -> None:
+        # write-through after our own create/patch, so the next reconcile doesn't depend on watch latency
+        with self._lock:
+            current = self._items.get(name)
+            if resource_version is None:
+                resource_version = current.resource_version if current else ""
+            self._items[name] = CachedCRD(name, hash_, resource_version, shards, account)
+            # a spec is only patched against while the resourceVersion of the write is known to guard the patch with
+            if applied is not None and resource_version:
+                self._applied[name] = AppliedCRD(hash_, resource_version, applied)
+            else:
+                self._applied.pop(name, None)
+
+    def applied(self, name: str) -> Optional[AppliedCRD]:
+        # our last write, as long as the stored object is still the one it produced
+        with self._lock:
+            current = self._items.get(name)
+            applied = self._applied.get(name)
+        if (
+            current is None
+            or applied is None
+            or current.hash != applied.hash
+            or current.resource_version != applied.resource_version
+        ):
+            return None
+        return applied
+
+    def forget(self, name: str) -> None:
+        with self._lock:
+            self._items.pop(name, None)
+            self._applied.pop(name, None)
+
+
 class CRDUpdater:
     _initialized = False
+    # write with server-side apply instead of create/patch
+    server_side_apply = False
+    # every CRD request goes through this one client
+    client: ClassVar[Optional[KubernetesClient]] = None
 
     def __init__(
         self,
@@ -38,6 +375,7 @@ class CRDUpdater:
         *,
         labels: Optional[dict[str, str]] = None,
         dry_run: bool = False,
+        cache: Optional[CRDCache] = None,
     ) -> None:
         assert self._initialized, "You need to initialize the class by calling CRDUpdater.initialize() first"
 
@@ -46,98 +384,181 @@ class CRDUpdater:
         self.name = name
         self.labels = labels
         self.dry_run = dry_run
+        self.cache = cache
+        self._hashed: Optional[tuple[ConsulRouterSpec, str]] = None
 
     @classmethod
-    def initialize(cls) -> None:
+    def initialize(
+        cls,
+        *,
+        server_side_apply: bool = False,
+        connections: int = 32,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        list_page_size: int = 500,
+    ) -> None:
         try:
             kubernetes.config.load_incluster_config()
         except kubernetes.config.config_exception.ConfigException as e:
             log.warning("Unable to us incluster config; falling back to kube config: %s", e)
             kubernetes.config.load_kube_config()
 
+        cls.client = KubernetesClient(
+            kubernetes.client.Configuration.get_default_copy(),
+            connections=connections,
+            timeout=timeout,
+            connect_timeout=connect_timeout,
+            page_size=list_page_size,
+        )
+        cls.server_side_apply = server_side_apply
         cls._initialized = True
 
-    def _get_crd_hash(self) -> Optional[str]:
-        client = kubernetes.client.CustomObjectsApi()
+    @classmethod
+    def api(cls) -> KubernetesClient:
+        assert cls.client is not None, "You need to initialize the class by calling CRDUpdater.initialize() first"
+        return cls.client
+
+    def _path(self, name: Optional[str] = None) -> str:
+        return custom_objects_path(self.group.group, self.group.version, self.kind.namespace, self.kind.plural, name)
+
+    def _params(self, *, field_manager: bool = True) -> list[tuple[str, str]]:
+        params: Final = [("fieldManager", FIELD_MANAGER)] if field_manager else []
+        if self.dry_run:
+            params.append(("dryRun", "All"))
+        return params
+
+    async def _get_crd_hash(self) -> Optional[str]:
+        if self.cache is not None:
+            await self.cache.synced()
+            cached: Final = self.cache.lookup(self.name)
+            if cached is None:
+                return None
+            if cached.hash is None:
+                log.warning("No %s annotation for %s CRD", HASH_ANNOTATION, self.name)
+                return "invalid"
+            return cached.hash
 
         try:
-            result: Final = KubernetesResource.parse_obj(
-                client.get_namespaced_custom_object(
-                    self.group.group,
-                    self.group.version,
-                    self.kind.namespace,
-                    self.kind.plural,
-                    self.name,
-                )
+            result: Final = CRDCache._entry(
+                await self.api().request("GET", self._path(self.name), accept=PARTIAL_METADATA)
             )
         except ApiException as e:
             if e.status == 404:
                 return None
             raise
 
-        if result.metadata.annotations is None or HASH_ANNOTATION not in result.metadata.annotations:
+        if result.hash is None:
             log.warning("No %s annotation for %s CRD", HASH_ANNOTATION, self.name)
             return "invalid"
 
-        return result.metadata.annotations[HASH_ANNOTATION]
+        return result.hash
 
-    @staticmethod
-    def _compute_hash(spec: ConsulRouterSpec) -> str:
-        m: Final = hashlib.sha256()
-        m.update(spec.json(by_alias=True, exclude_unset=True).encode())
-        return m.hexdigest()
-
-    def _create_crd(self, body: KubernetesResource) -> None:
-        client: Final = kubernetes.client.CustomObjectsApi()
-        client.create_namespaced_custom_object(
-            self.group.group,
-            self.group.version,
-            self.kind.namespace,
-            self.kind.plural,
-            body.dict(by_alias=True, exclude_unset=True),
-            dry_run="All" if self.dry_run else None,
+    def _compute_hash(self, spec: ConsulRouterSpec) -> str:
+        # same digest as hashing spec.json(by_alias=True, exclude_unset=True), streamed; specs are never mutated, so
+        # the digest of the last one is kept, e.g. for a retried update
+        if self._hashed is None or self._hashed[0] is not spec:
+            self._hashed = spec, spec_hash(spec)
+        return self._hashed[1]
+
+    def _hash(self, spec: ConsulRouterSpec) -> str:
+        return labeled_hash(self._compute_hash(spec), self.labels)
+
+    async def _create_crd(self, body: dict[str, Any]) -> Any:
+        return await self.api().request("POST", self._path(), params=self._params(), body=body)
+
+    async def _patch_crd(self, body: dict[str, Any]) -> Any:
+        return await self._call_patch("application/merge-patch+json", body)
+
+    async def _call_patch(self, content_type: str, body: Any, **params: str) -> Any:
+        return await self.api().request(
+            "PATCH",
+            self._path(self.name),
+            params=[*self._params(), *params.items()],
+            body=body,
+            content_type=content_type,
         )
 
-    def _patch_crd(self, body: KubernetesResource) -> None:
-        client: Final = kubernetes.client.CustomObjectsApi()
-        client.patch_namespaced_custom_object(
-            self.group.group,
-            self.group.version,
-            self.kind.namespace,
-            self.kind.plural,
+    async def _json_patch_crd(self, operations: list[dict[str, Any]]) -> Any:
+        return await self._call_patch("application/json-patch+json", operations)
+
+    async def _apply_crd(self, body: dict[str, Any]) -> Any:
+        # creates or updates in one request; forced, so fields last written by another manager (e.g. a replica running
+        # an older version) are taken over instead of failing with a conflict
+        return await self._call_patch("application/apply-patch+yaml", body, force="true")
+
+    async def _try_json_patch_crd(self, operations: list[dict[str, Any]], body: dict[str, Any]) -> Optional[Any]:
+        # sends the JSON patch if it's smaller than the whole object and returns the patched object; None means the
+        # whole object still has to be sent
+        patch_size: Final = len(json.dumps(operations))
+        body_size: Final = len(json.dumps(body))
+        if patch_size >= body_size:
+            return None
+        try:
+            result: Final = await self._json_patch_crd(operations)
+        except ApiException as e:
+            if e.status not in (409, 422):
+                raise
+            # the stored object isn't what the patch was computed against any more
+            log.warning(
+                "Unable to JSON patch %s CRD %s (%s); sending the whole object", self.kind.kind, self.name, e.reason
+            )
+            return None
+        log.info(
+            "Patched %s CRD %s with %d operations (%d bytes instead of %d)",
+            self.kind.kind,
             self.name,
-            body=body.dict(by_alias=True, exclude_unset=True),
-            dry_run="All" if self.dry_run else None,
+            len(operations),
+            patch_size,
+            body_size,
         )
-
-    def update(self, spec: ConsulRouterSpec) -> None:
-        current_hash: Final = self._get_crd_hash()
-        new_hash: Final = self._compute_hash(spec)
-
-        body: Final = KubernetesResource(
-            apiVersion=f"{self.group.group}/{self.group.version}",
-            kind=self.kind.kind,
-            metadata=KubernetesResourceMetadata(
-                namespace=self.kind.namespace,
-                name=self.name,
-                annotations={HASH_ANNOTATION: self._compute_hash(spec)},
-            ),
-            spec=spec,
+        PATCH_BYTES_SAVED.inc(body_size - patch_size, kind=self.kind.kind)
+        return result
+
+    def _body(self, spec: ConsulRouterSpec, annotations: dict[str, str]) -> dict[str, Any]:
+        return crd_body(self.group, self.kind, self.name, spec, annotations, self.labels)
+
+    async def update(
+        self, spec: ConsulRouterSpec, *, hash_: Optional[str] = None, shards: Optional[str] = None
+    ) -> ApplyOutcome:
+        # server-side apply works whether the CRD exists or not, so without a cache there is nothing to read first
+        current_hash: Final = (
+            await self._get_crd_hash() if self.cache is not None or not self.server_side_apply else None
         )
-
-        if self.labels:
-            body.metadata.labels = self.labels
+        with STAGE_SECONDS.time(stage="hash"):
+            new_hash: Final = hash_ or self._hash(spec)
+        annotations: Final = {HASH_ANNOTATION: new_hash}
+        if shards is not None:
+            annotations[SHARDS_ANNOTATION] = shards
+
+        with STAGE_SECONDS.time(stage="serialize"):
+            body: Final = self._body(spec, annotations)
+            # only needed to patch the next change minimally, which server-side apply doesn't do
+            applied: Final = (
+                applied_spec(body["spec"])
+                if self.cache is not None and not self.dry_run and not self.server_side_apply
+                else None
+            )
 
         if self.dry_run:
             log.warning("Dry-run mode is on; not making changes")
-            log.info(
-                "Planning on using this CRD:\n%s",
-                pprint.pformat(body.dict(by_alias=True, exclude_unset=True)),
-            )
+            log.info("Planning on using this CRD:\n%s", pprint.pformat(body))
+
+        if self.server_side_apply:
+            return await self._apply(body, current_hash, new_hash, shards, applied)
 
         if current_hash is None:
             log.info("Creating new %s CRD %s", self.kind.kind, self.name)
-            self._create_crd(body)
+            try:
+                created: Final = await self._create_crd(body)
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+                # created behind our back (e.g. another replica, or the cache hasn't seen it yet)
+                log.info("%s CRD %s already exists; patching instead", self.kind.kind, self.name)
+                self._record(new_hash, shards, applied, await self._patch_crd(body))
+                return ApplyOutcome.patched
+            self._record(new_hash, shards, applied, created)
+            return ApplyOutcome.created
         elif new_hash != current_hash:
             log.info(
                 "Patching %s CRD %s (%s != %s)",
@@ -146,21 +567,182 @@ class CRDUpdater:
                 new_hash,
                 current_hash,
             )
-            self._patch_crd(body)
+            previous: Final = self.cache.applied(self.name) if self.cache is not None else None
+            operations: Final = (
+                patch_operations(previous, body, applied) if previous is not None and applied is not None else None
+            )
+            patched = await self._try_json_patch_crd(operations, body) if operations is not None else None
+            if patched is None:
+                patched = await self._patch_crd(body)
+            self._record(new_hash, shards, applied, patched)
+            return ApplyOutcome.patched
         else:
             log.info("Nothing to do for %s CRD %s", self.kind.kind, self.name)
+            return ApplyOutcome.unchanged
+
+    async def _apply(
+        self,
+        body: dict[str, Any],
+        current_hash: Optional[str],
+        new_hash: str,
+        shards: Optional[str],
+        applied: Optional[AppliedSpec],
+    ) -> ApplyOutcome:
+        # the hash annotation still saves the request when nothing changed
+        if current_hash == new_hash:
+            log.info("Nothing to do for %s CRD %s", self.kind.kind, self.name)
+            return ApplyOutcome.unchanged
 
-    def delete(self) -> None:
+        log.info("Applying %s CRD %s (%s != %s)", self.kind.kind, self.name, new_hash, current_hash)
+        self._record(new_hash, shards, applied, await self._apply_crd(body))
+        return ApplyOutcome.created if current_hash is None and self.cache is not None else ApplyOutcome.patched
+
+    def _record(
+        self,
+        new_hash: str,
+        shards: Optional[str] = None,
+        applied: Optional[AppliedSpec] = None,
+        written: Optional[Mapping[str, Any]] = None,
+    ) -> None:
+        # `written` is the object returned by the write, whose resourceVersion guards the next JSON patch
+        if self.cache is not None and not self.dry_run:
+            self.cache.record(
+                self.name,
+                new_hash,
+                shards,
+                applied,
+                (self.labels or {}).get(ACCOUNT_LABEL),
+                ((written or {}).get("metadata") or {}).get("resourceVersion"),
+            )
+
+    async def delete(self) -> ApplyOutcome:
         log.info("Deleting %s CRD %s", self.kind.kind, self.name)
-        client: Final = kubernetes.client.CustomObjectsApi()
-        client.delete_namespaced_custom_object(
-            self.group.group,
-            self.group.version,
-            self.kind.namespace,
-            self.kind.plural,
+        try:
+            await self.api().request("DELETE", self._path(self.name), params=self._params(field_manager=False))
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            log.info("%s CRD %s is already gone", self.kind.kind, self.name)
+        if self.cache is not None and not self.dry_run:
+            self.cache.forget(self.name)
+        return ApplyOutcome.deleted
+
+
+class ShardedRouterUpdater(CRDUpdater):
+    # The routes are written grouped by shard and the shards annotation lists the hash prefix and route count of each
+    # shard, so without a remembered spec (e.g. after a restart) a change is still sent as a JSON patch replacing only
+    # the routes of the shards that changed. The hash annotation is the hash of that list, which also tells whether
+    # the list still describes the stored routes.
+
+    @staticmethod
+    def _layout(shards: Sequence[ConsulRouterSpec]) -> str:
+        return ",".join(f"{spec_hash(shard)[:SHARD_HASH_LENGTH]}:{len(shard.routes)}" for shard in shards)
+
+    @staticmethod
+    def _layout_hash(layout: str) -> str:
+        return hashlib.sha256(layout.encode()).hexdigest()
+
+    @staticmethod
+    def _parse_layout(layout: str) -> list[tuple[str, int]]:
+        return [(shard_hash, int(count)) for shard_hash, count in (shard.split(":") for shard in layout.split(","))]
+
+    def _operations(
+        self, cached: CachedCRD, shards: Sequence[ConsulRouterSpec], layout: str, new_hash: str
+    ) -> Optional[list[dict[str, Any]]]:
+        if cached.shards is None or cached.hash != self._layout_hash(cached.shards):
+            return None
+        try:
+            old: Final = self._parse_layout(cached.shards)
+        except ValueError:
+            return None
+        new: Final = self._parse_layout(layout)
+        if len(old) != len(new):
+            return None
+
+        offsets: Final = list(itertools.accumulate((count for _, count in old), initial=0))
+        operations: Final[list[dict[str, Any]]] = [
+            # unknown for entries restored from a snapshot the watch hasn't updated yet
+            *([resource_version_test(cached.resource_version)] if cached.resource_version else []),
+            {"op": "test", "path": f"/metadata/annotations/{HASH_ANNOTATION}", "value": cached.hash},
+        ]
+        # from the last shard backwards, so the offsets of the shards before are not moved yet
+        for index in reversed(range(len(new))):
+            if old[index][0] == new[index][0]:
+                continue
+            routes = shards[index].routes
+            offset, old_count = offsets[index], old[index][1]
+            operations.extend(
+                {"op": "replace", "path": f"/spec/routes/{offset + i}", "value": route}
+                for i, route in enumerate(routes[:old_count])
+            )
+            operations.extend(
+                {"op": "remove", "path": f"/spec/routes/{offset + len(routes)}"} for _ in range(old_count - len(routes))
+            )
+            operations.extend(
+                {"op": "add", "path": f"/spec/routes/{offset + i}", "value": routes[i]}
+                for i in range(old_count, len(routes))
+            )
+        operations.append({"op": "replace", "path": f"/metadata/annotations/{HASH_ANNOTATION}", "value": new_hash})
+        operations.append({"op": "replace", "path": f"/metadata/annotations/{SHARDS_ANNOTATION}", "value": layout})
+        return operations
+
+    async def update_shards(self, shards: Sequence[ConsulRouterSpec]) -> ApplyOutcome:
+        layout: Final = self._layout(shards)
+        new_hash: Final = self._layout_hash(layout)
+        spec: Final = ConsulRouterSpec.construct(routes=[route for shard in shards for route in shard.routes])
+
+        if self.cache is not None:
+            await self.cache.synced()
+        cached: Final = self.cache.lookup(self.name) if self.cache is not None else None
+        # with the previous spec at hand update() patches just the routes that changed
+        if self.cache is None or cached is None or cached.hash == new_hash or self.cache.applied(self.name):
+            return await self.update(spec, hash_=new_hash, shards=layout)
+        operations: Final = self._operations(cached, shards, layout, new_hash)
+        if operations is None:
+            return await self.update(spec, hash_=new_hash, shards=layout)
+
+        log.info(
+            "Patching %d of %d shards of %s CRD %s (%s != %s)",
+            sum(old != new for old, new in zip((cached.shards or "").split(","), layout.split(","))),
+            len(shards),
+            self.kind.kind,
             self.name,
-            dry_run="All" if self.dry_run else None,
+            new_hash,
+            cached.hash,
         )
+        body: Final = self._body(spec, {HASH_ANNOTATION: new_hash, SHARDS_ANNOTATION: layout})
+        patched: Final = await self._try_json_patch_crd(operations, body)
+        if patched is None:
+            return await self.update(spec, hash_=new_hash, shards=layout)
+        self._record(new_hash, layout, applied_spec(body["spec"]) if not self.dry_run else None, patched)
+        return ApplyOutcome.patched
+
+
+class Tombstones:
+    # Stale objects are only deleted once they were stale for `grace` seconds, so an account missing from one lookup
+    # keeps its objects when it is back with the next one instead of having them deleted and recreated. Names whose
+    # deletion failed are kept as well, to be retried by the next reconcile.
+    def __init__(self, grace: float = 0.0) -> None:
+        self.grace = grace
+        self._since: dict[str, float] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self._since)
+
+    def names(self) -> frozenset[str]:
+        return frozenset(self._since)
+
+    def sweep(self, stale: frozenset[str]) -> frozenset[str]:
+        # the stale names due for deletion; the others are kept, and whatever isn't stale anymore is forgotten
+        now: Final = time.monotonic()
+        self._since = {name: self._since.get(name, now) for name in stale}
+        due: Final = frozenset(name for name, since in self._since.items() if now - since >= self.grace)
+        for name in due:
+            del self._since[name]
+        return due
+
+    def retry(self, names: Iterable[str]) -> None:
+        self._since.update(dict.fromkeys(names, float("-inf")))
 
 
 class CRDManager:
@@ -173,6 +755,9 @@ class CRDManager:
         crd_def: Type[DefaultCRD],
         *,
         dry_run: bool = False,
+        engine: Optional[ApplyEngine] = None,
+        owns: Optional[Callable[[Optional[str]], bool]] = None,
+        grace: float = 0.0,
     ) -> None:
         self.group = group
         self.kind = kind
@@ -180,46 +765,168 @@ class CRDManager:
         self.services = services
         self.crd_def = crd_def
         self.dry_run = dry_run
+        self.engine = engine or ApplyEngine()
+        # decides by account label (None when unlabeled) which CRDs this replica reconciles; all of them by default
+        self.owns = owns
+        self.tombstones: Final = Tombstones(grace)
+        # accounts of which objects failed to apply, retried by the next update
+        self._failed: frozenset[str] = frozenset()
 
         self.crd_def_inst = crd_def(self.pod_id, self.services)
+        self.cache = CRDCache.get(group, kind, label_selector=f"{DYNAMIC_LABEL}={self.crd_def.tag}")
+
+    def _owned(self, account: Optional[str]) -> bool:
+        return self.owns is None or self.owns(account)
 
     def _get_crds(self) -> frozenset[str]:
-        client: Final = kubernetes.client.CustomObjectsApi()
-        items = map(
-            KubernetesResource.parse_obj,
-            client.list_namespaced_custom_object(
-                self.group.group,
-                self.group.version,
-                self.kind.namespace,
-                self.kind.plural,
-                label_selector=f"{DYNAMIC_LABEL}={self.crd_def.tag}",
-            )["items"],
-        )
-        return frozenset(item.metadata.name for item in items)
-
-    def delete_old(self, accounts: Mapping[str, Sequence[str]]) -> None:
-        current_services = self._get_crds()
-        expected_services = self.crd_def_inst.names(accounts)
-        for name in current_services - expected_services:
-            crd_updater = CRDUpdater(self.group, self.kind, name, dry_run=self.dry_run)
-            crd_updater.delete()
-
-    def update(self, accounts: Mapping[str, Sequence[str]]) -> None:
-        for name, spec in self.crd_def_inst.specs(accounts):
-            updater = CRDUpdater(
-                self.group,
-                self.kind,
-                name,
-                labels={DYNAMIC_LABEL: self.crd_def.tag},
-                dry_run=self.dry_run,
+        return frozenset(entry.name for entry in self.cache.entries() if self._owned(entry.account))
+
+    async def delete_old(
+        self, accounts: Mapping[str, Sequence[str]], diff: Optional[AccountsDiff] = None
+    ) -> ApplySummary:
+        await self.cache.synced()
+        current_services: Final = self._get_crds()
+        if diff is None:
+            stale_services = current_services - self.crd_def_inst.names(accounts)
+        else:
+            stale_services = current_services & self.crd_def_inst.stale_names(accounts, diff)
+            if self.tombstones:
+                # kept from earlier reconciles, unless this diff brings them back
+                revived = self.crd_def_inst.names(self.crd_def_inst.affected(accounts, diff))
+                stale_services |= current_services & (self.tombstones.names() - revived)
+        due: Final = self.tombstones.sweep(stale_services)
+        if len(due) < len(stale_services):
+            log.info(
+                "%s: keeping %d stale CRDs for up to %.0fs",
+                self.crd_def.tag,
+                len(stale_services) - len(due),
+                self.tombstones.grace,
             )
-            updater.update(spec)
 
-def get_secret(secret_name, namespace):
-        client: Final = kubernetes.client.CoreV1Api()
-        secret = client.read_namespaced_secret(secret_name, namespace)
-        data = {
-            key: value for key, value in secret.data.items()
+        collections: Final = self._collections(accounts, due)
+        collected: Final = {f"account {label}": names for label, names in collections.items()}
+        summary: Final = await self.engine.run_all(
+            f"{self.crd_def.tag} cleanup",
+            itertools.chain(
+                (
+                    (f"account {label}", partial(self._delete_collection, label, names))
+                    for label, names in sorted(collections.items())
+                ),
+                (
+                    (name, CRDUpdater(self.group, self.kind, name, dry_run=self.dry_run, cache=self.cache).delete)
+                    for name in sorted(due.difference(*collections.values()))
+                ),
+            ),
+            {operation: len(names) for operation, names in collected.items()},
+        )
+        self.tombstones.retry(name for failed in summary.failures for name in collected.get(failed, (failed,)))
+        self._count(summary)
+        return summary
+
+    def _collections(self, accounts: Mapping[str, Sequence[str]], due: frozenset[str]) -> dict[str, list[str]]:
+        # accounts (by label) of which every object is due for deletion, which takes one request per account
+        by_label: Final[dict[str, list[str]]] = {}
+        complete: Final[dict[str, bool]] = {}
+        for entry in self.cache.entries():
+            if entry.account is None or not self._owned(entry.account):
+                continue
+            if entry.name in due:
+                by_label.setdefault(entry.account, []).append(entry.name)
+            else:
+                complete[entry.account] = False
+        if not by_label:
+            return {}
+        # a digest label may be shared by accounts that still exist
+        current: Final = set(map(account_label, accounts))
+        return {
+            label: sorted(names)
+            for label, names in by_label.items()
+            if len(names) > 1 and complete.get(label, True) and label not in current
         }
-        log.info(data)
-        return data['data']
+
+    async def _delete_collection(self, label: str, names: Sequence[str]) -> ApplyOutcome:
+        log.info("Deleting %d %s CRDs of account %s", len(names), self.kind.kind, label)
+        params: Final = [("labelSelector", f"{DYNAMIC_LABEL}={self.crd_def.tag},{ACCOUNT_LABEL}={label}")]
+        if self.dry_run:
+            params.append(("dryRun", "All"))
+        await CRDUpdater.api().request(
+            "DELETE",
+            custom_objects_path(self.group.group, self.group.version, self.kind.namespace, self.kind.plural),
+            params=params,
+        )
+        if not self.dry_run:
+            for name in names:
+                self.cache.forget(name)
+        return ApplyOutcome.deleted
+
+    async def update(self, accounts: Mapping[str, Sequence[str]], diff: Optional[AccountsDiff] = None) -> ApplySummary:
+        index: Final = AccountIndex.of(accounts)
+        affected = index if diff is None else self.crd_def_inst.affected(accounts, diff)
+        if diff is not None and self._failed:
+            # accounts with objects that failed to apply are regenerated whole until they went through
+            retried: Final = index.select(account for account in self._failed if account in index)
+            affected = index.view({**affected, **retried})
+        owners: Final[dict[str, str]] = {}
+
+        def operations() -> Iterator[tuple[str, Operation]]:
+            for account in affected:
+                if self._owned(account_label(account)):
+                    for name, spec in self.crd_def_inst.specs(affected.select((account,))):
+                        owners[name] = account
+                        yield name, partial(self._updater(name, account).update, spec)
+
+        summary: Final = await self.engine.run_all(self.crd_def.tag, operations())
+        self._failed = frozenset(owners[name] for name in summary.failures)
+        self._count(summary)
+        return summary
+
+    def _count(self, summary: ApplySummary) -> None:
+        for outcome, count in summary.outcomes.items():
+            CRD_OBJECTS.inc(count, manager=self.crd_def.tag, outcome=outcome)
+
+    def _updater(self, name: str, account: str) -> CRDUpdater:
+        return CRDUpdater(
+            self.group,
+            self.kind,
+            name,
+            labels={DYNAMIC_LABEL: self.crd_def.tag, ACCOUNT_LABEL: account_label(account)},
+            dry_run=self.dry_run,
+            cache=self.cache,
+        )
+
+
+async def get_secret(secret_name: str, namespace: str, key: str = "data", *, timeout: Optional[float] = None) -> str:
+    # Consul writes the peering token some time after the acceptor was created: the secret is read, and watched until
+    # it has the key, retrying with backoff on errors
+    path: Final = f"/api/v1/namespaces/{quote(namespace, safe='')}/secrets"
+    delay = SECRET_RETRY_SECONDS
+
+    async def wait() -> str:
+        nonlocal delay
+        while True:
+            try:
+                try:
+                    secret = await CRDUpdater.api().request("GET", f"{path}/{quote(secret_name, safe='')}")
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
+                else:
+                    if key in (secret.get("data") or {}):
+                        return secret["data"][key]
+                log.info("Waiting for %s in secret %s", key, secret_name)
+                async for event in CRDUpdater.api().watch(
+                    path,
+                    params=[("fieldSelector", f"metadata.name={secret_name}")],
+                    timeout_seconds=WATCH_TIMEOUT_SECONDS,
+                ):
+                    if event["type"] in ("ADDED", "MODIFIED") and key in (event["object"].get("data") or {}):
+                        return event["object"]["data"][key]
+                    if event["type"] == "ERROR":
+                        raise ApiException(status=event["object"].get("code"), reason=event["object"].get("message"))
+                delay = SECRET_RETRY_SECONDS
+            except (ApiException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.warning("Unable to read secret %s, retrying in %.1fs: %s", secret_name, delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, SECRET_MAX_RETRY_SECONDS)
+
+    return await asyncio.wait_for(wait(), timeout)
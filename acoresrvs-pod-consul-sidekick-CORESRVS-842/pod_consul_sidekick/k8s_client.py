@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import ssl
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Final, Optional, Sequence
+from urllib.parse import quote
+
+import aiohttp
+import kubernetes
+from kubernetes.client import ApiException
+
+from .metrics import API_CALLS, API_CONNECTIONS, API_SECONDS
+
+log: Final = logging.getLogger(__name__)
+
+JSON: Final = "application/json"
+# metadata only (no specs to download and decode), falling back to whole objects where an API can't do that
+PARTIAL_METADATA: Final = f"{JSON};as=PartialObjectMetadata;g=meta.k8s.io;v=v1,{JSON}"
+PARTIAL_METADATA_LIST: Final = f"{JSON};as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,{JSON}"
+# a watch ends on its own after timeoutSeconds; reads may take that long in between events
+WATCH_READ_MARGIN: Final = 30.0
+
+Params = Sequence[tuple[str, str]]
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    # request level tracing: every request is logged at debug level and counted per verb and outcome, and every
+    # connection as reused or newly created
+    async def on_request_start(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceRequestStartParams
+    ) -> None:
+        context.start = time.monotonic()
+        context.verb = (context.trace_request_ctx or {}).get("verb", params.method)
+
+    async def on_request_end(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceRequestEndParams
+    ) -> None:
+        duration: Final = time.monotonic() - context.start
+        API_CALLS.inc(verb=context.verb, outcome=str(params.response.status))
+        API_SECONDS.observe(duration, verb=context.verb)
+        log.debug("%s %s: %d in %.3fs", params.method, params.url.path_qs, params.response.status, duration)
+
+    async def on_request_exception(
+        session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceRequestExceptionParams
+    ) -> None:
+        duration: Final = time.monotonic() - context.start
+        API_CALLS.inc(verb=context.verb, outcome="error")
+        API_SECONDS.observe(duration, verb=context.verb)
+        log.debug("%s %s: %r after %.3fs", params.method, params.url.path_qs, params.exception, duration)
+
+    async def on_connection_create_end(session: aiohttp.ClientSession, context: SimpleNamespace, params: Any) -> None:
+        API_CONNECTIONS.inc(connection="created")
+
+    async def on_connection_reuseconn(session: aiohttp.ClientSession, context: SimpleNamespace, params: Any) -> None:
+        API_CONNECTIONS.inc(connection="reused")
+
+    trace_config: Final = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
+
+
+def api_client() -> kubernetes.client.ApiClient:
+    # for what still uses the generated client (leases, snapshots): every generated API method (and call_api()) ends up
+    # in the request() of its ApiClient, which is timed and counted like the requests of KubernetesClient; other
+    # ApiClients in the process are left alone
+    client: Final = kubernetes.client.ApiClient()
+    request: Final = client.request
+
+    def instrumented(method: str, url: str, query_params: Any = None, *args: Any, **kwargs: Any) -> Any:
+        verb: Final = "WATCH" if method == "GET" and ("watch", True) in (query_params or ()) else method
+        start: Final = time.monotonic()
+        outcome = "error"
+        try:
+            response = request(method, url, query_params, *args, **kwargs)
+            outcome = str(response.status)
+            return response
+        except ApiException as e:
+            outcome = str(e.status)
+            raise
+        finally:
+            API_CALLS.inc(verb=verb, outcome=outcome)
+            API_SECONDS.observe(time.monotonic() - start, verb=verb)
+
+    client.request = instrumented  # type: ignore[method-assign]
+    return client
+
+
+def custom_objects_path(group: str, version: str, namespace: str, plural: str, name: Optional[str] = None) -> str:
+    path: Final = f"/apis/{group}/{version}/namespaces/{namespace}/{plural}"
+    return f"{path}/{quote(name, safe='')}" if name is not None else path
+
+
+class KubernetesClient:
+    # One keep-alive connection pool for all API requests, and one more for the long running watches so they never
+    # take up a connection requests are waiting for. The address and credentials are those kubernetes.config loaded,
+    # including refreshed service account tokens. Errors are raised as the generated client's ApiException.
+    def __init__(
+        self,
+        configuration: kubernetes.client.Configuration,
+        *,
+        connections: int = 32,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        page_size: int = 500,
+    ) -> None:
+        self.configuration = configuration
+        self.connections = connections
+        self.page_size = page_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self.connect_timeout = connect_timeout
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._watch_session: Optional[aiohttp.ClientSession] = None
+
+    def _ssl(self) -> Optional[ssl.SSLContext]:
+        if not self.configuration.host.startswith("https"):
+            return None
+        context: Final = ssl.create_default_context(cafile=self.configuration.ssl_ca_cert)
+        if self.configuration.cert_file:
+            context.load_cert_chain(self.configuration.cert_file, self.configuration.key_file)
+        if not self.configuration.verify_ssl:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def _new_session(self, limit: int) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit, ssl=self._ssl() or False),
+            trace_configs=[_trace_config()],
+        )
+
+    def _sessions(self) -> tuple[aiohttp.ClientSession, aiohttp.ClientSession]:
+        # created on first use, on the running loop
+        if self._session is None or self._session.closed:
+            self._session = self._new_session(self.connections)
+        if self._watch_session is None or self._watch_session.closed:
+            self._watch_session = self._new_session(0)
+        return self._session, self._watch_session
+
+    def _url(self, path: str) -> str:
+        # the host may come with a path, e.g. behind an API proxy
+        return self.configuration.host.rstrip("/") + path
+
+    def _headers(self, content_type: Optional[str], accept: str = JSON) -> dict[str, str]:
+        headers: Final = {"Accept": accept}
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        # evaluated per request: refreshes an expiring service account token
+        for auth in self.configuration.auth_settings().values():
+            if auth["in"] == "header" and auth["value"]:
+                headers[auth["key"]] = auth["value"]
+        return headers
+
+    @staticmethod
+    async def _raise_for_status(response: aiohttp.ClientResponse) -> None:
+        if response.status < 400:
+            return
+        error: Final = ApiException(status=response.status, reason=response.reason)
+        error.body = await response.text()
+        error.headers = dict(response.headers)
+        raise error
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        params: Params = (),
+        body: Any = None,
+        content_type: str = JSON,
+        accept: str = JSON,
+    ) -> Any:
+        session, _ = self._sessions()
+        async with session.request(
+            method,
+            self._url(path),
+            params=list(params),
+            data=None if body is None else json.dumps(body),
+            headers=self._headers(content_type if body is not None else None, accept),
+            timeout=self.timeout,
+            proxy=self.configuration.proxy,
+        ) as response:
+            await self._raise_for_status(response)
+            content: Final = await response.read()
+        return json.loads(content) if content else None
+
+    async def pages(self, path: str, *, params: Params = (), accept: str = JSON) -> AsyncIterator[dict[str, Any]]:
+        # a list, page_size items at a time so only one page is held in memory; all pages are of the same
+        # resourceVersion, and an expired continue token fails with a 410 like an expired watch
+        continue_ = ""
+        while True:
+            page = await self.request(
+                "GET",
+                path,
+                params=[*params, ("limit", str(self.page_size)), *([("continue", continue_)] if continue_ else [])],
+                accept=accept,
+            )
+            yield page
+            continue_ = page["metadata"].get("continue")
+            if not continue_:
+                return
+
+    async def watch(
+        self, path: str, *, params: Params = (), timeout_seconds: int, accept: str = JSON
+    ) -> AsyncIterator[dict[str, Any]]:
+        # the events of a watch request, one JSON object per line
+        _, session = self._sessions()
+        async with session.get(
+            self._url(path),
+            params=[*params, ("watch", "true"), ("timeoutSeconds", str(timeout_seconds))],
+            headers=self._headers(None, accept),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=self.connect_timeout, sock_read=timeout_seconds + WATCH_READ_MARGIN
+            ),
+            proxy=self.configuration.proxy,
+            trace_request_ctx={"verb": "WATCH"},
+        ) as response:
+            await self._raise_for_status(response)
+            # events (e.g. of a large router) can be far longer than what StreamReader.readline() accepts
+            pending: Final = bytearray()
+            async for chunk in response.content.iter_any():
+                searched = len(pending)
+                pending += chunk
+                while (end := pending.find(b"\n", searched)) >= 0:
+                    line = bytes(pending[:end])
+                    del pending[: end + 1]
+                    searched = 0
+                    if line.strip():
+                        yield json.loads(line)
+
+    async def close(self) -> None:
+        for session in (self._session, self._watch_session):
+            if session is not None:
+                await session.close()
+        self._session = self._watch_session = None
+        # lets the SSL transports finish closing
+        await asyncio.sleep(0)
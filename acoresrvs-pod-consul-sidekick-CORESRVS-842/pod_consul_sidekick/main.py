@@ -1,18 +1,54 @@
+import argparse
 import asyncio
+import json
 import logging
-from typing import Final
+import socket
+import sys
+import time
+from functools import partial
+from typing import Final, Optional, Type, TypeVar
 
-from . import config
+from . import config, plan
 from .accounts import Accounts
+from .apply import ApplyEngine
 from .azure_accounts import AzureAccounts
-from .crd_utils import construct_intent, generate_routes, generate_peeringacceptorspec
+from .azure_library import AsyncClientAssertionCredential
+from .change_sources import (
+    AzureStorageQueue,
+    ChangeSource,
+    EventSource,
+    SQSQueue,
+    is_aws_tag_event,
+    is_azure_resource_event,
+)
+from .coordination import Coordinator
+from .crd_utils import construct_intent, generate_peeringacceptorspec, generate_route_shards, generate_routes
 from .crds import SharedServicesCRD, TenantServicesIntentCRD
-from .k8s import CRDGroup, CRDManager, CRDResourceKind, CRDUpdater, get_secret
+from .discovery import AccountsDiff
+from .index import AccountIndex
+from .k8s import (
+    DYNAMIC_LABEL,
+    CRDCache,
+    CRDGroup,
+    CRDManager,
+    CRDResourceKind,
+    CRDUpdater,
+    ShardedRouterUpdater,
+    get_secret,
+)
+from .metrics import ACCOUNTS, STAGE_SECONDS, STARTUP_SECONDS, SYSTEMS, serve
+from .profiling import SamplingProfiler
+from .scheduler import ReconcileScheduler
+from .snapshot import ConfigMapSnapshotStore, FileSnapshotStore, SnapshotStore, fingerprint
+from .startup import Startup
 
 log: Final = logging.getLogger(__name__)
 
+U = TypeVar("U", bound=CRDUpdater)
+
 
 async def main() -> None:
+    started: Final = time.monotonic()
     logging.basicConfig(level=logging.INFO)
 
     settings: Final = config.Settings()
@@ -38,10 +74,65 @@ async def main() -> None:
     )
     log.info("POD services: %s", ", ".join(pod_services))
 
-    CRDUpdater.initialize()
+    if settings.METRICS_PORT is not None:
+        await serve(settings.METRICS_PORT)
+    profiler: Final = (
+        SamplingProfiler(settings.PROFILE_THRESHOLD, settings.PROFILE_DIR, interval=settings.PROFILE_INTERVAL)
+        if settings.PROFILE_THRESHOLD is not None
+        else None
+    )
+    if profiler is not None:
+        profiler.start()
 
+    # the first lookup only needs the cloud credentials, so it runs while the rest of the startup goes on
+    startup: Final = Startup(started)
     accounts_checker: Final = get_account(settings)
-    pod_peering_token_crd_updater = CRDUpdater(
+    first_lookup: Final = startup.step("first lookup", accounts_checker.lookup())
+    await startup.step(
+        "kubernetes client",
+        asyncio.to_thread(
+            partial(
+                CRDUpdater.initialize,
+                server_side_apply=settings.SERVER_SIDE_APPLY,
+                connections=settings.K8S_CONNECTIONS,
+                timeout=settings.K8S_TIMEOUT,
+                connect_timeout=settings.K8S_CONNECT_TIMEOUT,
+                list_page_size=settings.K8S_LIST_PAGE_SIZE,
+            )
+        ),
+    )
+
+    snapshot_store: Final = get_snapshot_store(settings)
+    loading: Final = startup.step("snapshot", asyncio.to_thread(snapshot_store.load)) if snapshot_store else None
+
+    engine: Final = ApplyEngine(settings.APPLY_CONCURRENCY, settings.APPLY_RETRIES, settings.APPLY_BACKOFF)
+
+    # with several replicas the leader takes care of the pod level CRDs and per account CRDs are spread over all
+    coordinator: Final = (
+        Coordinator(
+            f"{settings.POD_ID}-{DYNAMIC_LABEL}",
+            settings.NAMESPACE,
+            settings.REPLICA_ID or socket.gethostname(),
+            lease_duration=settings.LEASE_DURATION,
+        )
+        if settings.LEADER_ELECTION
+        else None
+    )
+    electing: Final = startup.step("leader election", coordinator.start()) if coordinator is not None else None
+
+    snapshot: Final = await loading if loading is not None else None
+    config_fingerprint: Final = fingerprint(settings.POD_ID, settings.SERVICES)
+    if snapshot is not None:
+        CRDCache.prime(snapshot.crds)
+        if snapshot.fingerprint != config_fingerprint:
+            log.info("Configuration changed since the snapshot was taken; reconciling everything")
+    initial_accounts: Final = (
+        AccountIndex(snapshot.accounts) if snapshot is not None and snapshot.fingerprint == config_fingerprint else None
+    )
+
+    owns: Final = coordinator.owns if coordinator is not None else None
+
+    pod_peering_token_crd_updater = cached_updater(
         CRDGroup(settings.RESOURCE_GROUP, settings.RESOURCE_VERSION),
         CRDResourceKind(
             settings.NAMESPACE,
@@ -51,7 +142,7 @@ async def main() -> None:
         peering_token_name,
         dry_run=settings.dry_run
     )
-    pod_level_crd_updater = CRDUpdater(
+    pod_level_crd_updater = cached_updater(
         CRDGroup(settings.RESOURCE_GROUP, settings.RESOURCE_VERSION),
         CRDResourceKind(
             settings.NAMESPACE,
@@ -60,8 +151,9 @@ async def main() -> None:
         ),
         router_name,
         dry_run=settings.dry_run,
+        updater=ShardedRouterUpdater,
     )
-    main_intent_crd_updater = CRDUpdater(
+    main_intent_crd_updater = cached_updater(
         CRDGroup(settings.RESOURCE_GROUP, settings.RESOURCE_VERSION),
         CRDResourceKind(
             settings.NAMESPACE,
@@ -82,6 +174,9 @@ async def main() -> None:
         shared_services,
         SharedServicesCRD,
         dry_run=settings.dry_run,
+        engine=engine,
+        owns=owns,
+        grace=settings.GC_GRACE,
     )
     tenant_services_intent_manager = CRDManager(
         CRDGroup(settings.RESOURCE_GROUP, settings.RESOURCE_VERSION),
@@ -94,43 +189,235 @@ async def main() -> None:
         settings.SERVICES,
         TenantServicesIntentCRD,
         dry_run=settings.dry_run,
+        engine=engine,
+        owns=owns,
+        grace=settings.GC_GRACE,
     )
 
     # peering acceptor token for pod
     peering_token_spec = generate_peeringacceptorspec(secret_name = f"peering-token-{settings.POD_ID}")
-    pod_peering_token_crd_updater.update(peering_token_spec)
-    peering_token = get_secret(f"peering-token-{settings.POD_ID}", settings.NAMESPACE)
-    log.info("peering token generated")
-    log.info(peering_token)
 
-    async for accounts in accounts_checker.monitor(
-        settings.SLEEP, settings.SLEEP_SPLAY
-    ):
+    async def set_up_peering() -> None:
+        await engine.run(peering_token_name, partial(pod_peering_token_crd_updater.update, peering_token_spec))
+        try:
+            await get_secret(
+                f"peering-token-{settings.POD_ID}", settings.NAMESPACE, timeout=settings.PEERING_SECRET_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            # reconciling goes on regardless, it doesn't need the token
+            log.error(
+                "Peering token secret peering-token-%s not written within %.0fs",
+                settings.POD_ID,
+                settings.PEERING_SECRET_TIMEOUT,
+            )
+            return
+        # the token itself is a credential and stays out of the logs
+        log.info("Peering token secret peering-token-%s found", settings.POD_ID)
 
-        # router for POD services ([pod id]-tenant-services)
-        router_spec = generate_routes(accounts, settings.SERVICES)
-        pod_level_crd_updater.update(router_spec)
+    # the caches are listing by now
+    if electing is not None:
+        await electing
+    # nothing reconciled depends on the token, so the first reconcile doesn't wait for it
+    peering: Final = [startup.step("peering", set_up_peering())] if coordinator is None or coordinator.is_leader else []
 
-        # intents for POD services ([pod id]-tenant-services)
-        intent_spec = construct_intent(router_name, pod_services)
-        main_intent_crd_updater.update(intent_spec)
+    async def reconcile_router(accounts: AccountIndex) -> None:
+        # router for POD services ([pod id]-tenant-services), generated off the event loop while the managers run
+        if settings.ROUTER_SHARDS:
+            with STAGE_SECONDS.time(stage="generate_routes"):
+                router_shards = await asyncio.to_thread(
+                    generate_route_shards, accounts, settings.SERVICES, settings.ROUTER_SHARDS
+                )
+            with STAGE_SECONDS.time(stage="router"):
+                await engine.run(router_name, partial(pod_level_crd_updater.update_shards, router_shards))
+        else:
+            with STAGE_SECONDS.time(stage="generate_routes"):
+                router_spec = await asyncio.to_thread(generate_routes, accounts, settings.SERVICES)
+            with STAGE_SECONDS.time(stage="router"):
+                await engine.run(router_name, partial(pod_level_crd_updater.update, router_spec))
 
-        # routers for shared services (tenant) (shared-[service]-[account])
-        shared_services_manager.delete_old(accounts)
-        shared_services_manager.update(accounts)
+    async def reconcile_manager(
+        manager: CRDManager, accounts: AccountIndex, diff: Optional[AccountsDiff], incomplete: bool
+    ) -> None:
+        # stale objects go first, the other managers' objects don't depend on them; with accounts missing from the
+        # lookup, their objects can't be told from stale ones
+        if not incomplete:
+            with STAGE_SECONDS.time(stage=f"{manager.crd_def.tag} cleanup"):
+                await manager.delete_old(accounts, diff)
+        with STAGE_SECONDS.time(stage=manager.crd_def.tag):
+            await manager.update(accounts, diff)
 
+    # intents for POD services ([pod id]-tenant-services) don't depend on the accounts
+    intent_spec: Final = construct_intent(router_name, pod_services)
+    first_reconcile = True
+
+    async def reconcile(accounts: AccountIndex, diff: Optional[AccountsDiff], incomplete: bool) -> None:
+        nonlocal first_reconcile
+        reconcile_started: Final = time.monotonic()
+        ACCOUNTS.set(len(accounts))
+        SYSTEMS.set(sum(map(len, accounts.values())))
+
+        # routers for shared services (tenant) (shared-[service]-[account])
         # intents for tenant services ([service]-[system/account])
-        tenant_services_intent_manager.delete_old(accounts)
-        tenant_services_intent_manager.update(accounts)
+        stages: Final = [
+            reconcile_manager(shared_services_manager, accounts, diff, incomplete),
+            reconcile_manager(tenant_services_intent_manager, accounts, diff, incomplete),
+        ]
+        is_leader: Final = coordinator is None or coordinator.is_leader
+        if is_leader:
+            # the router would lose the routes of the missing accounts
+            if incomplete:
+                log.warning("Not updating the router while accounts are missing")
+            else:
+                stages.append(reconcile_router(accounts))
+            stages.append(engine.run(router_name, partial(main_intent_crd_updater.update, intent_spec)))
+            if coordinator is not None:
+                # leadership may have moved here since startup; a no-op as long as the peering acceptor is unchanged
+                stages.append(
+                    engine.run(peering_token_name, partial(pod_peering_token_crd_updater.update, peering_token_spec))
+                )
+        await asyncio.gather(*stages)
+
+        # replicas would overwrite each other's snapshot in a shared ConfigMap; a dry run wrote nothing, so its
+        # snapshot would make a later real run skip the accounts it never created CRDs for, as would an incomplete one
+        if snapshot_store is not None and is_leader and not settings.dry_run and not incomplete:
+            with STAGE_SECONDS.time(stage="snapshot"):
+                await asyncio.to_thread(snapshot_store.save, config_fingerprint, accounts, CRDCache.export())
+
+        STAGE_SECONDS.observe(time.monotonic() - reconcile_started, stage="reconcile")
+        if profiler is not None:
+            profiler.cycle_finished(reconcile_started)
+
+        if first_reconcile:
+            first_reconcile = False
+            startup_seconds = time.monotonic() - started
+            STARTUP_SECONDS.set(startup_seconds, warm=str(initial_accounts is not None).lower())
+            log.info("First reconcile finished %.2fs after startup", startup_seconds)
+
+    # lookups carry on while a reconcile runs; the scheduler only ever reconciles the newest state they found
+    scheduler: Final = ReconcileScheduler(
+        reconcile,
+        debounce=settings.RECONCILE_DEBOUNCE,
+        max_delay=settings.RECONCILE_MAX_DELAY,
+        full_resync=settings.DRIFT_CORRECTION,
+        initial=initial_accounts,
+    )
+
+    async def discover() -> None:
+        change_sources: Final = get_change_sources(settings)
+        sleep_time: Final = settings.RESYNC if change_sources else settings.SLEEP
+        async for update in accounts_checker.monitor(
+            sleep_time,
+            settings.SLEEP_SPLAY,
+            max_sleep_time=max(sleep_time, settings.SLEEP_MAX),
+            sources=[*change_sources, coordinator] if coordinator is not None else change_sources,
+            debounce=settings.EVENT_DEBOUNCE,
+            initial=initial_accounts,
+            first_lookup=first_lookup,
+        ):
+            scheduler.publish(update)
+
+    await asyncio.gather(discover(), scheduler.run(), *peering)
+
+
+def cached_updater(
+    group: CRDGroup, kind: CRDResourceKind, name: str, *, dry_run: bool, updater: Type[U] = CRDUpdater
+) -> U:
+    # pod level CRDs are not labeled, so each one gets a cache watching just its own name
+    cache: Final = CRDCache.get(group, kind, field_selector=f"metadata.name={name}")
+    return updater(group, kind, name, dry_run=dry_run, cache=cache)
 
 
 def get_account(settings):
     return (
-        AzureAccounts(settings.POD_ID, settings.SUBSCRIPTION_ID)
+        AzureAccounts(
+            settings.POD_ID,
+            settings.SUBSCRIPTION_ID,
+            subscription_ids=settings.SUBSCRIPTION_IDS,
+            fan_out=settings.AZURE_FAN_OUT,
+        )
         if settings.CLOUD == "AZURE"
-        else Accounts(settings.POD_ID)
+        else Accounts(
+            settings.POD_ID,
+            regions=settings.AWS_REGIONS,
+            role_arns=settings.AWS_ROLE_ARNS,
+            concurrency=settings.AWS_CONCURRENCY,
+            shard_timeout=settings.AWS_SHARD_TIMEOUT,
+        )
     )
 
 
+def get_snapshot_store(settings) -> Optional[SnapshotStore]:
+    if settings.SNAPSHOT_CONFIGMAP:
+        return ConfigMapSnapshotStore(settings.SNAPSHOT_CONFIGMAP, settings.NAMESPACE)
+    if settings.SNAPSHOT_PATH:
+        return FileSnapshotStore(settings.SNAPSHOT_PATH)
+    return None
+
+
+def get_change_sources(settings) -> list[ChangeSource]:
+    if not settings.EVENT_QUEUE_URL:
+        return []
+    if settings.CLOUD == "AZURE":
+        queue = AzureStorageQueue(settings.EVENT_QUEUE_URL, AsyncClientAssertionCredential())
+        return [EventSource(queue, is_azure_resource_event)]
+    return [EventSource(SQSQueue(settings.EVENT_QUEUE_URL), is_aws_tag_event)]
+
+
+async def run_plan(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    settings: Final = config.Settings()
+
+    if args.accounts:
+        accounts = plan.load_accounts(args.accounts)
+    else:
+        discovery: Final = get_account(settings)
+        try:
+            accounts = await discovery.lookup()
+        finally:
+            await discovery.close()
+
+    if args.state:
+        state = plan.load_state(settings, args.state)
+    else:
+        CRDUpdater.initialize(
+            connections=settings.K8S_CONNECTIONS,
+            timeout=settings.K8S_TIMEOUT,
+            connect_timeout=settings.K8S_CONNECT_TIMEOUT,
+            list_page_size=settings.K8S_LIST_PAGE_SIZE,
+        )
+        try:
+            state = await plan.list_state(settings, CRDUpdater.api())
+        finally:
+            await CRDUpdater.api().close()
+
+    result: Final = plan.plan(settings, accounts, state)
+    if args.json:
+        json.dump(
+            {"changes": [change._asdict() for change in result.changes], "unchanged": result.unchanged}, sys.stdout
+        )
+        print()
+    else:
+        print(plan.render(result))
+
+
 def cli() -> None:
-    asyncio.run(main())
+    parser: Final = argparse.ArgumentParser(prog="pod-consul-sidekick")
+    commands: Final = parser.add_subparsers(dest="command")
+    plan_parser: Final = commands.add_parser(
+        "plan", help="show what a reconcile would create, patch and delete, without changing anything"
+    )
+    plan_parser.add_argument(
+        "--state",
+        action="append",
+        help="kubectl get -o json output of the CRDs, instead of listing them from the cluster (repeatable)",
+    )
+    plan_parser.add_argument(
+        "--accounts", help="{account: [systems]} JSON or a snapshot file, instead of looking the accounts up"
+    )
+    plan_parser.add_argument("--json", action="store_true", help="print the changes as JSON")
+    args: Final = parser.parse_args()
+
+    if args.command == "plan":
+        asyncio.run(run_plan(args))
+    else:
+        asyncio.run(main())
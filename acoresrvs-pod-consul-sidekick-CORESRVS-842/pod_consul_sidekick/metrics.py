@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import ClassVar, Final, Iterable, Iterator
+
+log: Final = logging.getLogger(__name__)
+
+PREFIX: Final = "pod_consul_sidekick"
+# seconds, from a quick API call up to a reconcile of a large pod
+DEFAULT_BUCKETS: Final = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+REQUEST_TIMEOUT: Final = 10.0
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs: Final = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = "untyped"
+    registry: ClassVar[list["Metric"]] = []
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = f"{PREFIX}_{name}"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._lock: Final = threading.Lock()
+        self._values: dict[tuple[str, ...], float] = {}
+        self.registry.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values: Final = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_labels(self.labelnames, key)} {value:g}"
+
+    def render(self) -> str:
+        return "\n".join(
+            [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}", *self.samples()]
+        )
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key: Final = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets: Final = tuple(sorted(buckets))
+        # per label values: observations per bucket (not cumulative, the last one is +Inf) and their sum
+        self._histograms: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key: Final = self._key(labels)
+        index: Final = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts, total = self._histograms.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._histograms[key] = counts, total + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start: Final = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            histogram = self._histograms.get(self._key(labels))
+        return sum(histogram[0]) if histogram else 0
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            histograms: Final = sorted(
+                (key, (list(counts), total)) for key, (counts, total) in self._histograms.items()
+            )
+        names: Final = (*self.labelnames, "le")
+        for key, (counts, total) in histograms:
+            cumulative = 0
+            for bound, count in zip((*map(str, self.buckets), "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(names, (*key, bound))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {total:g}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}"
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in Metric.registry) + "\n"
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line: Final = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+        # the headers don't matter, but are read so the client doesn't see a reset connection
+        while (await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)).strip():
+            pass
+        method, path, *_ = request_line.decode("latin-1").split() or ["", ""]
+        if method == "GET" and path.partition("?")[0] in ("/", "/metrics"):
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, ValueError) as e:
+        log.debug("Metrics request failed: %r", e)
+    finally:
+        writer.close()
+
+
+async def serve(port: int, host: str = "0.0.0.0") -> asyncio.AbstractServer:
+    # Prometheus text format on the event loop; rendering is cheap enough not to need a thread
+    server: Final = await asyncio.start_server(_handle, host, port)
+    log.info("Serving metrics on port %d", port)
+    return server
+
+
+STARTUP_SECONDS: Final = Gauge(
+    "startup_seconds", "Seconds from process start until the first account lookup was reconciled", ["warm"]
+)
+STARTUP_STEP_SECONDS: Final = Gauge("startup_step_seconds", "Seconds each startup step took", ["step"])
+PATCH_BYTES_SAVED: Final = Counter(
+    "patch_bytes_saved_total", "Request bytes saved by sending JSON patches instead of whole CRDs", ["kind"]
+)
+STAGE_SECONDS: Final = Histogram("stage_seconds", "Seconds spent per reconcile stage", ["stage"])
+API_CALLS: Final = Counter("api_calls_total", "Kubernetes API calls by verb and response status", ["verb", "outcome"])
+API_SECONDS: Final = Histogram("api_call_seconds", "Seconds until the Kubernetes API responded", ["verb"])
+API_CONNECTIONS: Final = Counter(
+    "api_connections_total", "Kubernetes API requests by whether their connection was created or reused", ["connection"]
+)
+CRD_OBJECTS: Final = Counter("crd_objects_total", "CRDs reconciled per manager by outcome", ["manager", "outcome"])
+ACCOUNTS: Final = Gauge("accounts", "Accounts found by the last lookup")
+SYSTEMS: Final = Gauge("systems", "Systems found by the last lookup")
+LOOKUP_PAGES: Final = Counter("lookup_pages_total", "Result pages fetched while looking up accounts", ["cloud"])
+LOOKUP_ITEMS: Final = Counter(
+    "lookup_items_total", "Items received while looking up accounts: resources (AWS), accounts (Azure)", ["cloud"]
+)
+LOOKUP_BYTES: Final = Counter(
+    "lookup_response_bytes_total", "Response bytes received while looking up accounts", ["cloud"]
+)
+LOOKUP_SHARD_SECONDS: Final = Histogram(
+    "lookup_shard_seconds", "Seconds per account lookup shard (region/role)", ["shard"]
+)
+LOOKUP_SHARD_ERRORS: Final = Counter("lookup_shard_errors_total", "Failed lookups per account lookup shard", ["shard"])
+LOOKUP_SHARD_STALE: Final = Gauge(
+    "lookup_shard_stale", "1 while a shard's accounts come from an earlier lookup or are missing altogether", ["shard"]
+)
@@ -0,0 +1,68 @@
+import difflib
+from json import JSONEncoder
+from typing import Any, Final, Mapping, Union
+
+_encoder: Final = JSONEncoder(separators=(",", ":"))
+
+# what is remembered of an applied spec: its top level fields encoded as JSON, list fields as one string per item so
+# they can be compared item by item
+AppliedSpec = dict[str, Union[str, list[str]]]
+
+
+def applied_spec(spec: Mapping[str, Any]) -> AppliedSpec:
+    return {
+        key: [_encoder.encode(item) for item in value] if isinstance(value, list) else _encoder.encode(value)
+        for key, value in spec.items()
+    }
+
+
+def _escape(token: str) -> str:
+    return token.replace("~", "~0").replace("/", "~1")
+
+
+def _list_operations(path: str, old: list[str], new: list[str], values: list[Any]) -> list[dict[str, Any]]:
+    # the common prefix and suffix are cut off first, so the matcher only sees the part that changed
+    start = 0
+    while start < len(old) and start < len(new) and old[start] == new[start]:
+        start += 1
+    old_end, new_end = len(old), len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+
+    matcher: Final = difflib.SequenceMatcher(None, old[start:old_end], new[start:new_end], autojunk=False)
+    operations: Final[list[dict[str, Any]]] = []
+    # from the end backwards, so the indexes of the earlier changes are not moved yet
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == "equal":
+            continue
+        i1, i2, j1, j2 = i1 + start, i2 + start, j1 + start, j2 + start
+        common = min(i2 - i1, j2 - j1)
+        operations.extend({"op": "replace", "path": f"{path}/{i1 + i}", "value": values[j1 + i]} for i in range(common))
+        operations.extend({"op": "remove", "path": f"{path}/{i1 + common}"} for _ in range(i2 - i1 - common))
+        operations.extend(
+            {"op": "add", "path": f"{path}/{i1 + i}", "value": values[j1 + i]} for i in range(common, j2 - j1)
+        )
+    return operations
+
+
+def spec_operations(old: AppliedSpec, spec: Mapping[str, Any], new: AppliedSpec) -> list[dict[str, Any]]:
+    # RFC 6902 operations turning the spec `old` was taken from into `spec` (with `new` = applied_spec(spec))
+    operations: Final[list[dict[str, Any]]] = [
+        {"op": "remove", "path": f"/spec/{_escape(key)}"} for key in sorted(old.keys() - spec.keys())
+    ]
+    for key, value in spec.items():
+        path = f"/spec/{_escape(key)}"
+        previous, current = old.get(key), new[key]
+        if previous is None:
+            operations.append({"op": "add", "path": path, "value": value})
+        elif isinstance(previous, list) and isinstance(current, list):
+            operations.extend(_list_operations(path, previous, current, value))
+        elif previous != current:
+            operations.append({"op": "replace", "path": path, "value": value})
+    return operations
+
+
+def metadata_operations(field: str, values: Mapping[str, str]) -> list[dict[str, Any]]:
+    # sets annotations or labels; "add" replaces an existing member too
+    return [{"op": "add", "path": f"/metadata/{field}/{_escape(key)}", "value": value} for key, value in values.items()]
@@ -0,0 +1,226 @@
+import asyncio
+import json
+from typing import Any, Final, Iterable, Iterator, Mapping, NamedTuple, Optional
+
+from .config import ServiceType, Settings
+from .crd_utils import construct_intent, generate_peeringacceptorspec, generate_route_shards, generate_routes
+from .crds import SharedServicesCRD, TenantServicesIntentCRD
+from .hashing import spec_hash
+from .index import AccountIndex
+from .k8s import (
+    ACCOUNT_LABEL,
+    DYNAMIC_LABEL,
+    HASH_ANNOTATION,
+    SHARDS_ANNOTATION,
+    AppliedCRD,
+    CRDGroup,
+    CRDResourceKind,
+    ShardedRouterUpdater,
+    account_label,
+    crd_body,
+    labeled_hash,
+    patch_operations,
+)
+from .k8s_client import KubernetesClient, custom_objects_path
+from .models import ConsulRouterSpec
+from .patching import applied_spec
+from .snapshot import Snapshot
+
+GZIP_MAGIC: Final = b"\x1f\x8b"
+
+# plural -> name -> object
+ClusterState = dict[str, dict[str, dict[str, Any]]]
+
+
+class DesiredCRD(NamedTuple):
+    kind: CRDResourceKind
+    name: str
+    spec: Any
+    hash: str
+    annotations: dict[str, str]
+    labels: Optional[dict[str, str]] = None
+
+
+class PlannedChange(NamedTuple):
+    action: str
+    kind: str
+    name: str
+    # bytes sent: the whole object to create, the JSON patch to patch
+    size: int = 0
+    operations: int = 0
+    # bytes of the whole object, which a patch falls back to
+    full_size: int = 0
+
+
+class Plan(NamedTuple):
+    changes: list[PlannedChange]
+    unchanged: int
+
+    def counts(self) -> dict[str, int]:
+        counts: Final = {"create": 0, "patch": 0, "delete": 0}
+        for change in self.changes:
+            counts[change.action] += 1
+        return counts
+
+
+def _kinds(settings: Settings) -> tuple[CRDResourceKind, CRDResourceKind, CRDResourceKind]:
+    return (
+        CRDResourceKind(settings.NAMESPACE, settings.ROUTER_RESOURCE_KIND, settings.ROUTER_RESOURCE_PLURAL),
+        CRDResourceKind(settings.NAMESPACE, settings.INTENT_RESOURCE_KIND, settings.INTENT_RESOURCE_PLURAL),
+        CRDResourceKind(
+            settings.NAMESPACE, settings.PEERINGACCEPTOR_RESOURCE_KIND, settings.PEERINGACCEPTOR_RESOURCE_PLURAL
+        ),
+    )
+
+
+def desired_crds(settings: Settings, accounts: Mapping[str, set[str]]) -> Iterator[DesiredCRD]:
+    # the same objects main() reconciles, for the whole pod regardless of leader election
+    index: Final = AccountIndex.of(accounts)
+    router_kind, intent_kind, peering_kind = _kinds(settings)
+    router_name: Final = f"{settings.POD_ID}-{settings.ROUTER_NAME_SUFFIX}"
+
+    peering_spec: Final = generate_peeringacceptorspec(secret_name=f"peering-token-{settings.POD_ID}")
+    peering_hash: Final = spec_hash(peering_spec)
+    yield DesiredCRD(
+        peering_kind,
+        f"{settings.POD_ID}-{settings.PEERING_TOKEN_NAME_SUFFIX}",
+        peering_spec,
+        peering_hash,
+        {HASH_ANNOTATION: peering_hash},
+    )
+
+    if settings.ROUTER_SHARDS:
+        shards: Final = generate_route_shards(index, settings.SERVICES, settings.ROUTER_SHARDS)
+        layout: Final = ShardedRouterUpdater._layout(shards)
+        layout_hash: Final = ShardedRouterUpdater._layout_hash(layout)
+        yield DesiredCRD(
+            router_kind,
+            router_name,
+            ConsulRouterSpec.construct(routes=[route for shard in shards for route in shard.routes]),
+            layout_hash,
+            {HASH_ANNOTATION: layout_hash, SHARDS_ANNOTATION: layout},
+        )
+    else:
+        router_spec: Final = generate_routes(index, settings.SERVICES)
+        router_hash: Final = spec_hash(router_spec)
+        yield DesiredCRD(router_kind, router_name, router_spec, router_hash, {HASH_ANNOTATION: router_hash})
+
+    pod_services: Final = {
+        name: service for name, service in settings.SERVICES.items() if service.type is ServiceType.pod
+    }
+    intent_spec: Final = construct_intent(router_name, pod_services)
+    intent_hash: Final = spec_hash(intent_spec)
+    yield DesiredCRD(intent_kind, router_name, intent_spec, intent_hash, {HASH_ANNOTATION: intent_hash})
+
+    shared_services: Final = {
+        name: service for name, service in settings.SERVICES.items() if service.type is ServiceType.shared
+    }
+    for crd, kind in (
+        (SharedServicesCRD(settings.POD_ID, shared_services), router_kind),
+        (TenantServicesIntentCRD(settings.POD_ID, settings.SERVICES), intent_kind),
+    ):
+        for account in index:
+            labels = {DYNAMIC_LABEL: crd.tag, ACCOUNT_LABEL: account_label(account)}
+            for name, spec in crd.specs(index.select((account,))):
+                hash_ = labeled_hash(spec_hash(spec), labels)
+                yield DesiredCRD(kind, name, spec, hash_, {HASH_ANNOTATION: hash_}, labels)
+
+
+def plan(settings: Settings, accounts: Mapping[str, set[str]], state: ClusterState) -> Plan:
+    group: Final = CRDGroup(settings.RESOURCE_GROUP, settings.RESOURCE_VERSION)
+    changes: Final[list[PlannedChange]] = []
+    desired_names: Final[set[tuple[str, str]]] = set()
+    unchanged = 0
+    for desired in desired_crds(settings, accounts):
+        desired_names.add((desired.kind.plural, desired.name))
+        current = state.get(desired.kind.plural, {}).get(desired.name)
+        current_hash = ((current or {}).get("metadata", {}).get("annotations") or {}).get(HASH_ANNOTATION)
+        if current is not None and current_hash == desired.hash:
+            unchanged += 1
+            continue
+
+        # bodies are only built for the objects that change
+        body = crd_body(group, desired.kind, desired.name, desired.spec, desired.annotations, desired.labels)
+        full_size = len(json.dumps(body))
+        if current is None:
+            changes.append(PlannedChange("create", desired.kind.kind, desired.name, full_size, 0, full_size))
+            continue
+        previous = AppliedCRD(
+            current_hash or "",
+            current.get("metadata", {}).get("resourceVersion", ""),
+            applied_spec(current.get("spec") or {}),
+        )
+        operations = patch_operations(previous, body, applied_spec(body["spec"]))
+        changes.append(
+            PlannedChange(
+                "patch", desired.kind.kind, desired.name, len(json.dumps(operations)), len(operations), full_size
+            )
+        )
+
+    # only what the sidekick labeled as its own is ever deleted
+    router_kind, intent_kind, _ = _kinds(settings)
+    for kind, tag in ((router_kind, SharedServicesCRD.tag), (intent_kind, TenantServicesIntentCRD.tag)):
+        for name, obj in sorted(state.get(kind.plural, {}).items()):
+            labels = obj.get("metadata", {}).get("labels") or {}
+            if labels.get(DYNAMIC_LABEL) == tag and (kind.plural, name) not in desired_names:
+                changes.append(PlannedChange("delete", kind.kind, name))
+
+    return Plan(changes, unchanged)
+
+
+def load_state(settings: Settings, paths: Iterable[str]) -> ClusterState:
+    # `kubectl get servicerouters,serviceintentions,peeringacceptors -o json` output, one or more files
+    plurals: Final = {kind.kind: kind.plural for kind in _kinds(settings)}
+    state: Final[ClusterState] = {plural: {} for plural in plurals.values()}
+    for path in paths:
+        with open(path) as f:
+            content = json.load(f)
+        for document in content if isinstance(content, list) else [content]:
+            for obj in document.get("items", [document]):
+                plural = plurals.get(obj.get("kind", ""))
+                metadata = obj.get("metadata", {})
+                if plural is not None and metadata.get("namespace", settings.NAMESPACE) == settings.NAMESPACE:
+                    state[plural][metadata["name"]] = obj
+    return state
+
+
+async def list_state(settings: Settings, client: KubernetesClient) -> ClusterState:
+    # one paginated list per kind instead of a request per object
+    async def list_kind(kind: CRDResourceKind) -> dict[str, dict[str, Any]]:
+        path: Final = custom_objects_path(
+            settings.RESOURCE_GROUP, settings.RESOURCE_VERSION, kind.namespace, kind.plural
+        )
+        return {obj["metadata"]["name"]: obj async for page in client.pages(path) for obj in page["items"]}
+
+    kinds: Final = _kinds(settings)
+    return {kind.plural: objects for kind, objects in zip(kinds, await asyncio.gather(*map(list_kind, kinds)))}
+
+
+def load_accounts(path: str) -> dict[str, set[str]]:
+    # a {account: [systems]} JSON file, or a snapshot (SNAPSHOT_PATH)
+    with open(path, "rb") as f:
+        data: Final = f.read()
+    if data[:2] == GZIP_MAGIC:
+        snapshot: Final = Snapshot.decode(data)
+        if snapshot is None:
+            raise ValueError(f"{path}: unsupported snapshot format")
+        return snapshot.accounts
+    return {account: set(systems) for account, systems in json.loads(data).items()}
+
+
+def render(result: Plan) -> str:
+    counts: Final = result.counts()
+    lines: Final = [
+        f"{counts['create']} to create, {counts['patch']} to patch, {counts['delete']} to delete, "
+        f"{result.unchanged} unchanged"
+    ]
+    order: Final = {"create": 0, "patch": 1, "delete": 2}
+    for change in sorted(result.changes, key=lambda change: (order[change.action], change.kind, change.name)):
+        if change.action == "create":
+            detail = f"{change.size} bytes"
+        elif change.action == "patch":
+            detail = f"{change.operations} operations, {change.size} bytes ({change.full_size} bytes in full)"
+        else:
+            detail = ""
+        lines.append(f"  {change.action:<6} {change.kind} {change.name} {detail}".rstrip())
+    return "\n".join(lines)
@@ -0,0 +1,99 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from functools import lru_cache
+from types import CodeType, FrameType
+from typing import Final, Optional
+
+log: Final = logging.getLogger(__name__)
+
+# innermost frames of threads with nothing to do: idle pool workers and the event loop waiting for I/O
+IDLE_FRAMES: Final = frozenset({("threading.py", "wait"), ("thread.py", "_worker"), ("selectors.py", "select")})
+# samples are counted per stack in buckets of this many seconds
+BUCKET_SECONDS: Final = 1.0
+
+
+@lru_cache(maxsize=4096)
+def _frame(code: CodeType) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    # Samples the stacks of all threads from a background thread and keeps how often each (interned) stack was seen in
+    # every second of the last `window` seconds. After a reconcile cycle slower than the threshold, the counts of the
+    # seconds of the cycle are written as folded stacks (one "thread;outer;...;inner count" line per stack), which
+    # flamegraph.pl, inferno or speedscope turn into a flamegraph.
+    def __init__(self, threshold: float, directory: str, *, interval: float = 0.05, window: float = 15 * 60) -> None:
+        self.threshold = threshold
+        self.directory = directory
+        self.interval = interval
+
+        self._lock: Final = threading.Lock()
+        # (start, stack counts) per bucket
+        self._buckets: deque[tuple[float, Counter[str]]] = deque(maxlen=max(1, int(window / BUCKET_SECONDS)))
+        self._stop: Final = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _stacks(self) -> list[str]:
+        names: Final = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks: Final[list[str]] = []
+        for ident, frame in sys._current_frames().items():
+            if ident == threading.get_ident():
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            frames = []
+            current: Optional[FrameType] = frame
+            while current is not None:
+                frames.append(_frame(current.f_code))
+                current = current.f_back
+            frames.append(names.get(ident, str(ident)))
+            stacks.append(sys.intern(";".join(reversed(frames))))
+        return stacks
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            taken = time.monotonic()
+            stacks = self._stacks()
+            with self._lock:
+                if not self._buckets or taken - self._buckets[-1][0] >= BUCKET_SECONDS:
+                    self._buckets.append((taken, Counter()))
+                self._buckets[-1][1].update(stacks)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def cycle_finished(self, started: float) -> Optional[str]:
+        # writes the profile of the cycle that started at `started` (time.monotonic()) if it was too slow
+        duration: Final = time.monotonic() - started
+        if duration < self.threshold:
+            return None
+
+        stacks: Final[Counter[str]] = Counter()
+        with self._lock:
+            # to the bucket: up to a second before the cycle is included
+            for bucket_started, counts in self._buckets:
+                if bucket_started + BUCKET_SECONDS > started:
+                    stacks.update(counts)
+        now: Final = time.time()
+        path: Final = os.path.join(
+            self.directory,
+            f"reconcile-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}.{int(now * 1000) % 1000:03d}.folded",
+        )
+        try:
+            with open(path, "w") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+        except OSError as e:
+            log.warning("Unable to write profile of a %.2fs cycle: %s", duration, e)
+            return None
+        log.info("Reconcile cycle took %.2fs; wrote %d samples to %s", duration, stacks.total(), path)
+        return path
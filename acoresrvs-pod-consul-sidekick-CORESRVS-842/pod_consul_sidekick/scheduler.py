@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Final, Optional
+
+from .discovery import AccountsDiff, AccountsUpdate
+from .index import AccountIndex
+
+log: Final = logging.getLogger(__name__)
+
+# accounts, the diff against the last reconciled ones (None: reconcile everything), whether accounts may be missing
+Reconcile = Callable[[AccountIndex, Optional[AccountsDiff], bool], Awaitable[None]]
+
+
+class ReconcileScheduler:
+    # Discovery publishes every new state into a single slot, replacing the one that wasn't picked up yet, so lookups
+    # never wait for a reconcile. The reconciler lets a burst settle, then works on the newest state with a diff
+    # against what it reconciled last, so intermediate states are never applied. A full reconcile every `full_resync`
+    # seconds corrects drift, e.g. objects changed or removed behind the sidekick's back.
+    def __init__(
+        self,
+        reconcile: Reconcile,
+        *,
+        debounce: float = 0.0,
+        max_delay: Optional[float] = None,
+        full_resync: float = 0.0,
+        initial: Optional[AccountIndex] = None,
+    ) -> None:
+        self.reconcile = reconcile
+        self.debounce = debounce
+        self.max_delay = max(debounce, max_delay or debounce)
+        self.full_resync = full_resync
+
+        self._latest: Optional[AccountIndex] = None
+        self._partial = False
+        # set when an update asked for a full reconcile, until one happened
+        self._full = False
+        self._published: Final = asyncio.Event()
+        self._reconciled: Optional[AccountIndex] = initial
+        self._last_full = time.monotonic()
+
+    def publish(self, update: AccountsUpdate) -> None:
+        self._latest = update.accounts
+        self._partial = update.partial
+        self._full = self._full or update.diff is None
+        self._published.set()
+
+    async def _next(self, first: bool) -> bool:
+        # waits for a new state; False when the periodic full reconcile is due instead
+        timeout: Final = (
+            max(0.0, self._last_full + self.full_resync - time.monotonic())
+            if self.full_resync and self._latest is not None
+            else None
+        )
+        try:
+            await asyncio.wait_for(self._published.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._published.clear()
+
+        if not first and self.debounce:
+            # every new state restarts the wait, up to max_delay after the first one
+            deadline: Final = time.monotonic() + self.max_delay
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    await asyncio.wait_for(self._published.wait(), min(self.debounce, remaining))
+                except asyncio.TimeoutError:
+                    break
+                self._published.clear()
+        return True
+
+    async def run(self) -> None:
+        first = True
+        while True:
+            if not await self._next(first):
+                log.info("Reconciling everything to correct drift")
+                self._full = True
+
+            accounts, partial = self._latest, self._partial
+            if accounts is None:
+                continue
+            full = self._full or self._reconciled is None
+            diff = None if full else AccountsDiff.between(self._reconciled, accounts)
+            if diff is not None and not diff and not first:
+                # the burst ended where it started
+                log.info("Nothing to reconcile")
+                continue
+
+            if diff is not None:
+                log.info("Reconciling: %s", diff)
+            self._full = False
+            try:
+                await self.reconcile(accounts, diff, partial)
+            except Exception:
+                # what was applied is unknown, so the next reconcile doesn't diff against the last one that went through
+                log.exception("Reconcile failed")
+                self._full = True
+                continue
+            self._reconciled = accounts
+            if full:
+                self._last_full = time.monotonic()
+            first = False
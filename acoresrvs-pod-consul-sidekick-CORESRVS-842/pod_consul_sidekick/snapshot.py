@@ -0,0 +1,162 @@
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from abc import ABCMeta, abstractmethod
+from typing import Any, Final, Mapping, NamedTuple, Optional, Set
+
+import kubernetes
+from kubernetes.client import ApiException
+
+from .k8s_client import api_client
+
+log: Final = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT: Final = 1
+CONFIGMAP_KEY: Final = "snapshot.json.gz"
+
+
+class Snapshot(NamedTuple):
+    # identifies the configuration the accounts were reconciled with
+    fingerprint: str
+    accounts: dict[str, set[str]]
+    # CRDCache.export() output
+    crds: dict[str, Any]
+    saved_at: float
+
+    def encode(self) -> bytes:
+        return gzip.compress(
+            json.dumps(
+                {
+                    "format": SNAPSHOT_FORMAT,
+                    "fingerprint": self.fingerprint,
+                    "accounts": {account: sorted(systems) for account, systems in sorted(self.accounts.items())},
+                    "crds": self.crds,
+                    "saved_at": self.saved_at,
+                },
+                separators=(",", ":"),
+            ).encode()
+        )
+
+    @classmethod
+    def decode(cls, data: bytes) -> Optional["Snapshot"]:
+        content: Final = json.loads(gzip.decompress(data))
+        if content.get("format") != SNAPSHOT_FORMAT:
+            log.warning("Ignoring snapshot in unsupported format %s", content.get("format"))
+            return None
+        return cls(
+            content["fingerprint"],
+            {account: set(systems) for account, systems in content["accounts"].items()},
+            content["crds"],
+            content["saved_at"],
+        )
+
+
+def fingerprint(pod_id: str, services: Mapping[str, Any]) -> str:
+    m: Final = hashlib.sha256()
+    m.update(pod_id.encode())
+    m.update(json.dumps({name: service.dict() for name, service in sorted(services.items())}, default=sorted).encode())
+    return m.hexdigest()
+
+
+class SnapshotStore(metaclass=ABCMeta):
+    @abstractmethod
+    def _read(self) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def _write(self, data: bytes) -> None:
+        ...
+
+    def load(self) -> Optional[Snapshot]:
+        try:
+            data: Final = self._read()
+            snapshot: Final = Snapshot.decode(data) if data else None
+        except Exception:
+            log.exception("Unable to load snapshot from %s", self)
+            return None
+
+        if snapshot is not None:
+            log.info(
+                "Loaded snapshot of %d accounts from %s (%.0fs old)",
+                len(snapshot.accounts),
+                self,
+                time.time() - snapshot.saved_at,
+            )
+        return snapshot
+
+    def save(self, fingerprint_: str, accounts: Mapping[str, Set[str]], crds: dict[str, Any]) -> None:
+        snapshot: Final = Snapshot(fingerprint_, {a: set(s) for a, s in accounts.items()}, crds, time.time())
+        try:
+            data: Final = snapshot.encode()
+            self._write(data)
+        except Exception:
+            # losing a snapshot only costs a slower restart
+            log.exception("Unable to save snapshot to %s", self)
+            return
+        log.info("Saved snapshot of %d accounts to %s (%d bytes)", len(accounts), self, len(data))
+
+
+class FileSnapshotStore(SnapshotStore):
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def __str__(self) -> str:
+        return self.path
+
+    def _read(self) -> Optional[bytes]:
+        try:
+            with open(self.path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, data: bytes) -> None:
+        # write to a temporary file first so a crash never leaves a truncated snapshot behind
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix=".snapshot-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class ConfigMapSnapshotStore(SnapshotStore):
+    def __init__(self, name: str, namespace: str) -> None:
+        self.name = name
+        self.namespace = namespace
+
+    def __str__(self) -> str:
+        return f"configmap {self.namespace}/{self.name}"
+
+    def _read(self) -> Optional[bytes]:
+        client: Final = kubernetes.client.CoreV1Api(api_client())
+        try:
+            configmap: Final = client.read_namespaced_config_map(self.name, self.namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+        data: Final = (configmap.binary_data or {}).get(CONFIGMAP_KEY)
+        return base64.b64decode(data) if data else None
+
+    def _write(self, data: bytes) -> None:
+        client: Final = kubernetes.client.CoreV1Api(api_client())
+        body: Final = {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {"name": self.name, "namespace": self.namespace},
+            "binaryData": {CONFIGMAP_KEY: base64.b64encode(data).decode()},
+        }
+        try:
+            client.replace_namespaced_config_map(self.name, self.namespace, body)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            client.create_namespaced_config_map(self.namespace, body)
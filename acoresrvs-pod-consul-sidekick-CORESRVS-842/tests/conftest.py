@@ -0,0 +1,50 @@
+import asyncio
+import os
+from typing import Any, Callable, Coroutine, Iterator
+
+import kubernetes
+import pytest
+from benchmarks.fake_apiserver import FakeApiServer
+
+# crd_utils reads the settings on import
+os.environ.setdefault("POD_ID", "pod1")
+os.environ.setdefault(
+    "SERVICES",
+    '{"a": {"upstreams": ["b", "s"]}, "b": {}, "p": {"type": "pod"}, "s": {"type": "shared", "upstreams": ["a"]}}',
+)
+
+from pod_consul_sidekick.k8s import CRDCache, CRDUpdater  # noqa: E402
+from pod_consul_sidekick.k8s_client import KubernetesClient  # noqa: E402
+
+
+@pytest.fixture
+def api() -> Iterator[FakeApiServer]:
+    # CRDUpdater talking to a fresh fake API server, as CRDUpdater.initialize() would set it up without a kubeconfig
+    server: FakeApiServer = FakeApiServer().start(configure_client=False)
+    configuration = kubernetes.client.Configuration()
+    configuration.host = server.host
+    CRDUpdater.client = KubernetesClient(configuration, page_size=2)
+    CRDUpdater.server_side_apply = False
+    CRDUpdater._initialized = True
+    try:
+        yield server
+    finally:
+        # the caches' watches belonged to the loop of the test
+        CRDCache._caches.clear()
+        CRDUpdater.client = None
+        CRDUpdater._initialized = False
+        server.stop()
+
+
+@pytest.fixture
+def run(api: FakeApiServer) -> Callable[[Coroutine[Any, Any, Any]], Any]:
+    def run_(coroutine: Coroutine[Any, Any, Any]) -> Any:
+        async def main() -> Any:
+            try:
+                return await coroutine
+            finally:
+                await CRDUpdater.api().close()
+
+        return asyncio.run(main())
+
+    return run_
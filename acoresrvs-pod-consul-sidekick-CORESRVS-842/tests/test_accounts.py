@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from pod_consul_sidekick.accounts import Accounts, Shard, ShardError
+from pod_consul_sidekick.change_sources import EventSource, LocalQueue, is_aws_tag_event
+from pod_consul_sidekick.metrics import LOOKUP_SHARD_ERRORS, LOOKUP_SHARD_SECONDS, LOOKUP_SHARD_STALE
+
+from .test_change_sources import TAG_CHANGE, Updates
+
+
+class FakeAccounts(Accounts):
+    # shards answer from `results`, or fail while they are listed in `failing`
+    def __init__(self, results: dict[str, dict[str, set[str]]]) -> None:
+        super().__init__("pod1", regions=list(results))
+        self.results = results
+        self.failing: set[str] = set()
+
+    async def _lookup_shard(self, shard: Shard) -> dict[str, set[str]]:
+        if shard.region in self.failing:
+            raise ConnectionError(shard.region)
+        return {account: set(systems) for account, systems in self.results[shard.region].items()}
+
+
+def test_cold_start_returns_the_shards_that_answered() -> None:
+    discovery = FakeAccounts({"cold-ok": {"acc1": {"sys1"}}, "cold-down": {"acc2": {"sys2"}}})
+    discovery.failing = {"cold-down"}
+    down = Shard("cold-down", None)
+
+    assert asyncio.run(discovery.lookup()) == {"acc1": {"sys1"}}
+    assert discovery.partial
+    assert discovery.stats[down].stale and not discovery.stats[Shard("cold-ok", None)].stale
+    assert LOOKUP_SHARD_ERRORS.get(shard=str(down)) == 1
+    assert LOOKUP_SHARD_STALE.get(shard=str(down)) == 1
+    assert LOOKUP_SHARD_SECONDS.count(shard=str(down)) == 1
+
+    discovery.failing = set()
+    assert asyncio.run(discovery.lookup()) == {"acc1": {"sys1"}, "acc2": {"sys2"}}
+    assert not discovery.partial
+    assert not discovery.stats[down].stale
+    assert LOOKUP_SHARD_STALE.get(shard=str(down)) == 0
+
+
+def test_failing_shard_reuses_its_previous_result() -> None:
+    discovery = FakeAccounts({"warm-ok": {"acc1": {"sys1"}}, "warm-down": {"acc2": {"sys2"}}})
+    asyncio.run(discovery.lookup())
+
+    discovery.failing = {"warm-down"}
+    assert asyncio.run(discovery.lookup()) == {"acc1": {"sys1"}, "acc2": {"sys2"}}
+    assert not discovery.partial
+    assert discovery.stats[Shard("warm-down", None)].stale
+
+
+def test_lookup_fails_when_no_shard_answered() -> None:
+    discovery = FakeAccounts({"all-down-1": {}, "all-down-2": {}})
+    discovery.failing = {"all-down-1", "all-down-2"}
+
+    with pytest.raises(ShardError):
+        asyncio.run(discovery.lookup())
+
+
+def test_partial_lookup_is_followed_by_a_full_update() -> None:
+    async def scenario() -> None:
+        queue = LocalQueue()
+        discovery = FakeAccounts({"monitor-ok": {"acc1": {"sys1"}}, "monitor-down": {"acc2": {"sys2"}}})
+        discovery.failing = {"monitor-down"}
+        updates = Updates(discovery.monitor(3600, 0, sources=[EventSource(queue, is_aws_tag_event)]))
+        try:
+            update = await updates.next()
+            assert update is not None and update.partial and update.diff is None
+            assert dict(update.accounts) == {"acc1": {"sys1"}}
+
+            # still partial: nothing is diffed against a view missing accounts
+            queue.put(TAG_CHANGE)
+            update = await updates.next()
+            assert update is not None and update.partial and update.diff is None
+
+            discovery.failing = set()
+            queue.put(TAG_CHANGE)
+            update = await updates.next()
+            assert update is not None and not update.partial and update.diff is None
+            assert dict(update.accounts) == {"acc1": {"sys1"}, "acc2": {"sys2"}}
+        finally:
+            await updates.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+from typing import Any, Iterator
+
+import pytest
+
+from pod_consul_sidekick import azure_library
+from pod_consul_sidekick.azure_library import AsyncClientAssertionCredential, ClientAssertionCredential
+
+SCOPE = "https://management.azure.com/.default"
+
+
+class BlockingApp:
+    # stands in for msal's ConfidentialClientApplication; token requests block until released
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def acquire_token_for_client(self, scopes: list[str]) -> dict[str, Any]:
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        return {"access_token": f"token{self.calls}", "expires_in": 3600}
+
+
+@pytest.fixture
+def credential(monkeypatch: pytest.MonkeyPatch) -> Iterator[ClientAssertionCredential]:
+    monkeypatch.setattr(azure_library, "ConfidentialClientApplication", BlockingApp)
+    credential = ClientAssertionCredential()
+    yield credential
+    credential.close()
+
+
+def test_concurrent_requests_share_one_token_request(credential: ClientAssertionCredential) -> None:
+    tokens: list[Any] = []
+    threads = [threading.Thread(target=lambda: tokens.append(credential.get_token(SCOPE))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    assert credential.app.started.wait(5)
+
+    # looking at the cache doesn't wait for the request in flight
+    started = time.monotonic()
+    assert credential.cached_token(SCOPE) is None
+    assert time.monotonic() - started < 0.5
+
+    credential.app.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert credential.app.calls == 1
+    assert {token.token for token in tokens} == {"token1"}
+    assert credential.cached_token(SCOPE).token == "token1"
+
+
+def test_failed_request_is_raised_to_every_waiter(credential: ClientAssertionCredential) -> None:
+    def fail(scopes: list[str]) -> dict[str, Any]:
+        credential.app.started.set()
+        credential.app.release.wait(5)
+        return {"error": "invalid_client", "error_description": "no luck"}
+
+    credential.app.acquire_token_for_client = fail
+    errors: list[Exception] = []
+
+    def get_token() -> None:
+        try:
+            credential.get_token(SCOPE)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=get_token) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    assert credential.app.started.wait(5)
+    credential.app.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert [str(e) for e in errors] == ["no luck"] * 3
+
+
+def test_async_credential_keeps_the_loop_running(credential: ClientAssertionCredential) -> None:
+    async def scenario() -> None:
+        async_credential = AsyncClientAssertionCredential(credential)
+        getting = asyncio.create_task(async_credential.get_token(SCOPE))
+        await asyncio.to_thread(credential.app.started.wait, 5)
+        # the loop keeps running (and looking at the cache) while the token is requested
+        started = time.monotonic()
+        await asyncio.sleep(0.01)
+        assert async_credential.credential.cached_token(SCOPE) is None
+        assert time.monotonic() - started < 0.5
+        credential.app.release.set()
+        assert (await getting).token == "token1"
+        assert (await async_credential.get_token(SCOPE)).token == "token1"
+        assert credential.app.calls == 1
+
+    asyncio.run(scenario())
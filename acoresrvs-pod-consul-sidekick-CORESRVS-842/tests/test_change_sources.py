@@ -0,0 +1,152 @@
+import asyncio
+from typing import AsyncGenerator, Optional
+
+from pod_consul_sidekick.change_sources import (
+    EventSource,
+    LocalQueue,
+    QueueMessage,
+    decode_event,
+    is_aws_tag_event,
+    is_azure_resource_event,
+)
+from pod_consul_sidekick.discovery import AccountsUpdate, Discovery
+
+TAG_CHANGE = {"detail-type": "Tag Change on Resource", "detail": {"changed-tag-keys": ["teracloud:system"]}}
+OTHER_TAG_CHANGE = {"detail-type": "Tag Change on Resource", "detail": {"changed-tag-keys": ["owner"]}}
+
+
+class StaticDiscovery(Discovery):
+    def __init__(self, accounts: dict[str, set[str]]) -> None:
+        self.accounts = accounts
+        self.lookups = 0
+
+    async def lookup(self) -> dict[str, set[str]]:
+        self.lookups += 1
+        return {account: set(systems) for account, systems in self.accounts.items()}
+
+
+class Updates:
+    # the monitor's updates as they come; cancelling a pending anext() would close the generator, so it is kept
+    def __init__(self, updates: AsyncGenerator[AccountsUpdate, None]) -> None:
+        self.updates = updates
+        self.pending: Optional[asyncio.Task[AccountsUpdate]] = None
+
+    async def next(self, timeout: float = 0.5) -> Optional[AccountsUpdate]:
+        # None if the monitor is still waiting for a trigger
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(anext(self.updates))
+        done, _ = await asyncio.wait({self.pending}, timeout=timeout)
+        if not done:
+            return None
+        update, self.pending = self.pending.result(), None
+        return update
+
+    async def close(self) -> None:
+        if self.pending is not None:
+            self.pending.cancel()
+            await asyncio.gather(self.pending, return_exceptions=True)
+
+
+def test_events_trigger_lookups() -> None:
+    async def scenario() -> None:
+        queue = LocalQueue()
+        discovery = StaticDiscovery({"acc1": {"sys1"}})
+        # polling never comes around during the test
+        updates = Updates(discovery.monitor(3600, 0, sources=[EventSource(queue, is_aws_tag_event)]))
+        try:
+            initial = await updates.next()
+            assert initial is not None and initial.diff is None and dict(initial.accounts) == {"acc1": {"sys1"}}
+
+            # irrelevant and undecodable events are acknowledged without a lookup
+            queue.put(OTHER_TAG_CHANGE)
+            queue.put("not json")
+            assert await updates.next() is None
+            assert discovery.lookups == 1
+            assert len(queue.acked) == 2
+
+            discovery.accounts = {"acc1": {"sys1", "sys2"}, "acc2": {"sys3"}}
+            queue.put(TAG_CHANGE)
+            changed = await updates.next()
+            assert changed is not None and changed.diff is not None
+            assert changed.diff.added == {"acc2"}
+            assert changed.diff.added_systems == {"acc1": {"sys2"}, "acc2": {"sys3"}}
+            assert discovery.lookups == 2
+            assert len(queue.acked) == 3
+
+            # a relevant event without a change looks up again, but yields nothing
+            queue.put(TAG_CHANGE)
+            assert await updates.next() is None
+            assert discovery.lookups == 3
+        finally:
+            await updates.close()
+
+    asyncio.run(scenario())
+
+
+def test_burst_of_events_is_one_lookup() -> None:
+    async def scenario() -> None:
+        queue = LocalQueue()
+        discovery = StaticDiscovery({})
+        updates = Updates(discovery.monitor(3600, 0, sources=[EventSource(queue, is_aws_tag_event)]))
+        try:
+            await updates.next()
+            discovery.accounts = {"acc1": {"sys1"}}
+            for _ in range(10):
+                queue.put(TAG_CHANGE)
+            assert await updates.next() is not None
+            assert await updates.next() is None
+            assert discovery.lookups == 2
+            assert len(queue.acked) == 10
+        finally:
+            await updates.close()
+
+    asyncio.run(scenario())
+
+
+class FlakyAckQueue(LocalQueue):
+    def __init__(self, failures: int) -> None:
+        super().__init__()
+        self.failures = failures
+
+    async def ack(self, messages: list[QueueMessage]) -> None:
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("delete failed")
+        await super().ack(messages)
+
+
+def test_ack_failure_does_not_end_the_source() -> None:
+    async def scenario() -> None:
+        queue = FlakyAckQueue(failures=1)
+        source = EventSource(queue, is_aws_tag_event)
+        queue.put(TAG_CHANGE)
+        assert await asyncio.wait_for(source.wait(), 1) == "1 change event(s)"
+        assert queue.acked == []
+
+        queue.put(TAG_CHANGE)
+        assert await asyncio.wait_for(source.wait(), 1) == "1 change event(s)"
+        assert len(queue.acked) == 1
+
+    asyncio.run(scenario())
+
+
+def test_json_that_is_not_an_event_is_undecodable() -> None:
+    for body in ('"x"', "[1]", "1234", "null", '[{"eventType": "x"}, 1]'):
+        assert decode_event(body) is None, body
+    assert decode_event("[]") == {"events": []}
+
+    async def scenario() -> None:
+        queue = LocalQueue()
+        source = EventSource(queue, is_azure_resource_event)
+        for body in ('"x"', "[1]"):
+            queue.put(body)
+        queue.put(
+            {
+                "eventType": "Microsoft.Resources.ResourceWriteSuccess",
+                "subject": "/subscriptions/s/providers/Microsoft.Compute/virtualMachines/vm1",
+            }
+        )
+        assert await asyncio.wait_for(source.wait(), 1) == "1 change event(s)"
+        assert len(queue.acked) == 3
+
+    asyncio.run(scenario())
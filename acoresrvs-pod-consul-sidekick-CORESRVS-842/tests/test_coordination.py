@@ -0,0 +1,75 @@
+import asyncio
+
+import kubernetes
+import pytest
+from benchmarks.fake_apiserver import FakeApiServer
+
+from pod_consul_sidekick.coordination import Coordinator, HashRing
+
+KEYS = [f"acc{i}" for i in range(1000)]
+
+
+@pytest.fixture
+def leases(api: FakeApiServer, monkeypatch: pytest.MonkeyPatch) -> FakeApiServer:
+    # the Leases go through the generated client
+    configuration = kubernetes.client.Configuration()
+    configuration.host = api.host
+    monkeypatch.setattr(kubernetes.client.Configuration, "_default", configuration)
+    return api
+
+
+def owners(ring: HashRing) -> dict[str, str]:
+    return {key: ring.owner(key) for key in KEYS}
+
+
+def test_hash_ring_moves_only_the_keys_of_a_joining_or_leaving_member() -> None:
+    ring = owners(HashRing(["r1", "r2", "r3"]))
+    assert owners(HashRing(["r3", "r1", "r2", "r1"])) == ring
+    assert set(ring.values()) == {"r1", "r2", "r3"}
+
+    joined = owners(HashRing(["r1", "r2", "r3", "r4"]))
+    moved = {key for key in KEYS if joined[key] != ring[key]}
+    assert moved and all(joined[key] == "r4" for key in moved)
+
+    left = owners(HashRing(["r1", "r3"]))
+    assert all(left[key] == ring[key] for key in KEYS if ring[key] != "r2")
+
+    assert HashRing([]).owner("acc1") is None
+
+
+def test_accounts_are_spread_and_the_rest_belongs_to_the_leader(leases: FakeApiServer) -> None:
+    first, second = Coordinator("sidekick", "default", "r1"), Coordinator("sidekick", "default", "r2")
+    asyncio.run(first._update())
+    asyncio.run(second._update())
+    # the first one only sees the second member with its next renewal
+    assert first.ring.members == ("r1",)
+    asyncio.run(first._update())
+
+    assert first.ring.members == second.ring.members == ("r1", "r2")
+    assert first.is_leader and not second.is_leader
+    assert first.owns(None) and not second.owns(None)
+    assert all(first.owns(key) != second.owns(key) for key in KEYS)
+    assert any(second.owns(key) for key in KEYS)
+
+
+def test_leadership_passes_on_when_the_leader_stops_renewing(leases: FakeApiServer) -> None:
+    first, second = Coordinator("sidekick", "default", "r1"), Coordinator("sidekick", "default", "r2")
+    for coordinator in (first, second, first):
+        asyncio.run(coordinator._update())
+    second._changed.clear()
+
+    # r1 went away long enough ago for its leases to have expired
+    with leases.condition:
+        for name in ("sidekick-leader", "sidekick-r1"):
+            leases.objects["leases", "default", name]["spec"]["renewTime"] = "2020-01-01T00:00:00.000000Z"
+
+    asyncio.run(second._update())
+    assert second.is_leader and second.owns(None)
+    assert second.ring.members == ("r2",)
+    assert all(second.owns(key) for key in KEYS)
+    assert asyncio.run(second.wait()) == "leader of 1 member(s)"
+    leader = leases.objects["leases", "default", "sidekick-leader"]["spec"]
+    assert (leader["holderIdentity"], leader["leaseTransitions"]) == ("r2", 1)
+    # the departed member's lease is cleaned up by the new leader, from its next renewal on
+    asyncio.run(second._update())
+    assert ("leases", "default", "sidekick-r1") not in leases.objects
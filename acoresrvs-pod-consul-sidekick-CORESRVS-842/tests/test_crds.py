@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+from pod_consul_sidekick.config import Service, ServiceType, Settings
+from pod_consul_sidekick.crds import DefaultCRD, SharedServicesCRD, TenantServicesIntentCRD
+from pod_consul_sidekick.discovery import AccountsDiff
+from pod_consul_sidekick.index import AccountIndex
+
+settings = Settings()
+# x and y both call d, and the shared s
+SAME_DESTINATION = {
+    "x": Service(upstreams={"d", "s"}),
+    "y": Service(upstreams={"d", "s"}),
+    "d": Service(),
+    "s": Service(type=ServiceType.shared),
+}
+
+
+@pytest.fixture(params=[SharedServicesCRD, TenantServicesIntentCRD])
+def crd(request: pytest.FixtureRequest) -> DefaultCRD:
+    return request.param(settings.POD_ID, settings.SERVICES)
+
+
+def full_stale_names(crd: DefaultCRD, old: dict[str, set[str]], new: dict[str, set[str]]) -> frozenset[str]:
+    return crd.names(AccountIndex(old)) - crd.names(AccountIndex(new))
+
+
+def test_stale_names_keeps_system_shared_with_untouched_account(crd: DefaultCRD) -> None:
+    old = {"B": {"s2", "s3"}, "D": {"s2"}}
+    new = {"B": {"s4", "s5"}, "D": {"s2"}}
+    stale = crd.stale_names(AccountIndex(new), AccountsDiff.between(AccountIndex(old), AccountIndex(new)))
+    assert stale == full_stale_names(crd, old, new)
+    assert not any(name.endswith("-s2") for name in stale)
+
+
+def test_stale_names_keeps_system_moved_between_accounts(crd: DefaultCRD) -> None:
+    old = {"B": {"s2"}, "D": {"s3"}}
+    new = {"D": {"s2", "s3"}}
+    stale = crd.stale_names(AccountIndex(new), AccountsDiff.between(AccountIndex(old), AccountIndex(new)))
+    assert stale == full_stale_names(crd, old, new)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_stale_names_match_full_reconcile(crd: DefaultCRD, seed: int) -> None:
+    rng = random.Random(seed)
+    accounts = [f"acc{i}" for i in range(6)]
+    systems = [f"s{i}" for i in range(8)]
+
+    old = {account: set(rng.sample(systems, rng.randint(1, 3))) for account in accounts if rng.random() < 0.7}
+    # most accounts are left alone, as in a real incremental update
+    new = {account: set(listed) for account, listed in old.items()}
+    for account in rng.sample(accounts, 2):
+        if rng.random() < 0.3:
+            new.pop(account, None)
+        else:
+            new[account] = set(rng.sample(systems, rng.randint(1, 3)))
+
+    stale = crd.stale_names(AccountIndex(new), AccountsDiff.between(AccountIndex(old), AccountIndex(new)))
+    assert stale == full_stale_names(crd, old, new)
+
+
+def test_accounts_of() -> None:
+    index = AccountIndex({"B": {"s2", "s3"}, "D": {"s2"}, "A": {"s2"}})
+    assert index.accounts_of("s2") == ("A", "B", "D")
+    assert index.accounts_of("s3") == ("B",)
+    assert index.accounts_of("s9") == ()
+
+
+def test_sources_of_the_same_destination_are_merged() -> None:
+    crd = TenantServicesIntentCRD(settings.POD_ID, SAME_DESTINATION)
+    specs = {
+        name: [source["name"] for source in spec.sources] for name, spec in crd.specs(AccountIndex({"A": {"s1", "s2"}}))
+    }
+    assert specs == {
+        "d-s1": ["x-s1", "y-s1"],
+        "d-s2": ["x-s2", "y-s2"],
+        "s-A": ["x-s1", "x-s2", "y-s1", "y-s2"],
+    }
+
+
+def test_merged_intentions_are_stale_with_the_last_system_they_are_named_after() -> None:
+    crd = TenantServicesIntentCRD(settings.POD_ID, SAME_DESTINATION)
+    old = {"A": {"s1", "s2"}, "B": {"s1"}}
+    for new, stale in [
+        ({"A": {"s1", "s2"}}, {"s-B"}),
+        ({"A": {"s2"}, "B": {"s1"}}, set()),
+        ({"A": {"s1"}}, {"d-s2", "s-B"}),
+        ({}, {"d-s1", "d-s2", "s-A", "s-B"}),
+    ]:
+        assert crd.stale_names(AccountIndex(new), AccountsDiff.between(AccountIndex(old), AccountIndex(new))) == stale
+        assert stale == full_stale_names(crd, old, new)
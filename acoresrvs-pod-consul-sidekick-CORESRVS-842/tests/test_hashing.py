@@ -0,0 +1,45 @@
+import hashlib
+
+import pytest
+
+from pod_consul_sidekick import k8s
+from pod_consul_sidekick.config import Settings
+from pod_consul_sidekick.crd_utils import construct_intent, generate_peeringacceptorspec, generate_routes
+from pod_consul_sidekick.hashing import spec_hash
+from pod_consul_sidekick.k8s import CRDGroup, CRDResourceKind, CRDUpdater
+
+settings = Settings()
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        generate_routes({"acc1": {"sys1", "sys2"}, "acc2": {"sys3"}}, settings.SERVICES),
+        generate_routes({}, settings.SERVICES),
+        construct_intent("a-sys1", ["b-sys1", "s-acc1"]),
+        generate_peeringacceptorspec("peering-token-pod1"),
+    ],
+)
+def test_spec_hash_is_the_hash_of_the_json(spec: object) -> None:
+    expected = hashlib.sha256(spec.json(by_alias=True, exclude_unset=True).encode()).hexdigest()  # type: ignore
+    assert spec_hash(spec) == expected
+
+
+def test_updater_remembers_the_hash_of_the_last_spec(monkeypatch: pytest.MonkeyPatch) -> None:
+    hashed: list[object] = []
+
+    def counting_spec_hash(spec: object) -> str:
+        hashed.append(spec)
+        return spec_hash(spec)
+
+    monkeypatch.setattr(k8s, "spec_hash", counting_spec_hash)
+    monkeypatch.setattr(CRDUpdater, "_initialized", True)
+    updater = CRDUpdater(CRDGroup("group", "v1"), CRDResourceKind("default", "Kind", "kinds"), "name")
+    first = generate_routes({"acc1": {"sys1"}}, settings.SERVICES)
+    second = generate_routes({"acc1": {"sys1"}}, settings.SERVICES)
+
+    digest = updater._hash(first)
+    # a retry with the same spec isn't hashed again, an equal spec is
+    assert updater._hash(first) == digest
+    assert updater._hash(second) == digest
+    assert hashed == [first, second]
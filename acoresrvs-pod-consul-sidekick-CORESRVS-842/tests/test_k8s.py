@@ -0,0 +1,358 @@
+import asyncio
+import hashlib
+import json
+import threading
+from typing import Any, AsyncIterator, Callable, Coroutine
+
+import kubernetes
+import pytest
+from benchmarks.fake_apiserver import FakeApiServer
+from kubernetes.client import ApiException
+
+from pod_consul_sidekick.apply import ApplyEngine, ApplyOutcome
+from pod_consul_sidekick.config import Settings
+from pod_consul_sidekick.crd_utils import generate_route_shards, generate_routes, router_shard
+from pod_consul_sidekick.crds import SharedServicesCRD
+from pod_consul_sidekick.discovery import AccountsDiff
+from pod_consul_sidekick.index import AccountIndex
+from pod_consul_sidekick.k8s import (
+    ACCOUNT_LABEL,
+    FIELD_MANAGER,
+    HASH_ANNOTATION,
+    SHARDS_ANNOTATION,
+    CRDCache,
+    CRDGroup,
+    CRDManager,
+    CRDResourceKind,
+    CRDUpdater,
+    ShardedRouterUpdater,
+    get_secret,
+)
+from pod_consul_sidekick.k8s_client import api_client
+from pod_consul_sidekick.metrics import API_CALLS
+from pod_consul_sidekick.models import ConsulRouterSpec
+
+Run = Callable[[Coroutine[Any, Any, Any]], Any]
+
+settings = Settings()
+GROUP = CRDGroup("consul.hashicorp.com", "v1alpha1")
+ROUTERS = CRDResourceKind("default", "ServiceRouter", "servicerouters")
+JSON_PATCH = "PATCH servicerouters application/json-patch+json"
+MERGE_PATCH = "PATCH servicerouters application/merge-patch+json"
+APPLY_PATCH = "PATCH servicerouters application/apply-patch+yaml"
+
+
+def routes(systems: int) -> ConsulRouterSpec:
+    return generate_routes({"acc": {f"sys{i}" for i in range(systems)}}, settings.SERVICES)
+
+
+def cached_updater(name: str = "router") -> CRDUpdater:
+    return CRDUpdater(GROUP, ROUTERS, name, cache=CRDCache.get(GROUP, ROUTERS, field_selector=f"metadata.name={name}"))
+
+
+def stored_routes(api: FakeApiServer, name: str = "router") -> Any:
+    return api.objects["servicerouters", "default", name]["spec"]["routes"]
+
+
+async def eventually(condition: Callable[[], bool], timeout: float = 5.0) -> None:
+    async def wait() -> None:
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(wait(), timeout)
+
+
+def as_json(spec: ConsulRouterSpec) -> Any:
+    return json.loads(spec.json(by_alias=True, exclude_unset=True))["routes"]
+
+
+def sharded_accounts(changed: str = "") -> dict[str, set[str]]:
+    # one more system for account `changed`
+    return {f"acc{i}": {f"sys{i}", *(["new"] if f"acc{i}" == changed else [])} for i in range(12)}
+
+
+def restarted_updater(name: str = "router") -> ShardedRouterUpdater:
+    # a cache of its own, without the specs remembered by the shared one, as after a restart
+    cache = CRDCache(GROUP, ROUTERS, field_selector=f"metadata.name={name}")
+    cache.start()
+    return ShardedRouterUpdater(GROUP, ROUTERS, name, cache=cache)
+
+
+def test_create_then_unchanged(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        updater = CRDUpdater(GROUP, ROUTERS, "router")
+        assert await updater.update(routes(3)) == ApplyOutcome.created
+        assert await updater.update(routes(3)) == ApplyOutcome.unchanged
+
+        stored = api.objects["servicerouters", "default", "router"]
+        assert stored["metadata"]["annotations"][HASH_ANNOTATION] == updater._hash(routes(3))
+        assert stored_routes(api) == as_json(routes(3))
+        assert api.calls["POST servicerouters"] == 1
+        # without a cache the hash is read from the object
+        assert api.calls["GET servicerouters"] == 2
+
+    run(scenario())
+
+
+def test_create_conflict_falls_back_to_patch(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        updater = cached_updater()
+        await updater.cache.synced()
+        # created by someone else, and not seen by the cache yet
+        with api.condition:
+            api.objects["servicerouters", "default", "router"] = {
+                "metadata": {"name": "router", "namespace": "default", "resourceVersion": "1"},
+                "spec": {"routes": []},
+            }
+
+        assert await updater.update(routes(3)) == ApplyOutcome.patched
+        assert api.calls["POST servicerouters"] == 1
+        assert api.calls[MERGE_PATCH] == 1
+        assert stored_routes(api) == as_json(routes(3))
+
+    run(scenario())
+
+
+def test_json_patch_for_small_changes_merge_patch_for_large_ones(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        updater = cached_updater()
+        await updater.update(routes(20))
+
+        # one more system: a few operations instead of the whole object
+        assert await updater.update(routes(21)) == ApplyOutcome.patched
+        assert (api.calls[JSON_PATCH], api.calls[MERGE_PATCH]) == (1, 0)
+        assert stored_routes(api) == as_json(routes(21))
+
+        # every route changed: the JSON patch would be larger than the object
+        other = generate_routes({"acc": {f"other{i}" for i in range(21)}}, settings.SERVICES)
+        assert await updater.update(other) == ApplyOutcome.patched
+        assert (api.calls[JSON_PATCH], api.calls[MERGE_PATCH]) == (1, 1)
+        assert stored_routes(api) == as_json(other)
+
+    run(scenario())
+
+
+def test_server_side_apply(api: FakeApiServer, run: Run, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(CRDUpdater, "server_side_apply", True)
+
+    async def scenario() -> None:
+        updater = cached_updater()
+        assert await updater.update(routes(3)) == ApplyOutcome.created
+        assert await updater.update(routes(3)) == ApplyOutcome.unchanged
+        assert await updater.update(routes(4)) == ApplyOutcome.patched
+
+        # created and updated by the same kind of request, which needs no read first
+        assert api.calls[APPLY_PATCH] == 2
+        assert api.calls["POST servicerouters"] == api.calls["GET servicerouters"] == 0
+        stored = api.objects["servicerouters", "default", "router"]
+        assert stored["metadata"]["managedFields"][0]["manager"] == FIELD_MANAGER
+        assert stored_routes(api) == as_json(routes(4))
+
+    run(scenario())
+
+
+def test_removed_accounts_are_deleted_by_label(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        manager = CRDManager(GROUP, ROUTERS, settings.POD_ID, settings.SERVICES, SharedServicesCRD)
+        old = AccountIndex({"acc1": {"sys1"}, "acc2": {"sys2"}, "acc3": {"sys3"}})
+        await manager.update(old)
+        # one object per account and service
+        assert len(api.objects) == 3 * len(settings.SERVICES)
+
+        new = AccountIndex({"acc2": {"sys2"}})
+        summary = await manager.delete_old(new, AccountsDiff.between(old, new))
+        assert summary.outcomes == {ApplyOutcome.deleted: 2 * len(settings.SERVICES)}
+        # one request per removed account
+        assert api.calls["DELETECOLLECTION servicerouters"] == 2
+        assert api.calls["DELETE servicerouters"] == 0
+        assert {obj["metadata"]["labels"][ACCOUNT_LABEL] for obj in api.objects.values()} == {"acc2"}
+        assert manager.cache.names() == {obj["metadata"]["name"] for obj in api.objects.values()}
+
+    run(scenario())
+
+
+def test_failed_account_deletion_is_retried_by_the_next_cleanup(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        manager = CRDManager(
+            GROUP, ROUTERS, settings.POD_ID, settings.SERVICES, SharedServicesCRD, engine=ApplyEngine(retries=0)
+        )
+        old = AccountIndex({"acc1": {"sys1"}, "acc2": {"sys2"}})
+        await manager.update(old)
+
+        new = AccountIndex({"acc2": {"sys2"}})
+        api.failing["DELETECOLLECTION servicerouters"] = 1
+        summary = await manager.delete_old(new, AccountsDiff.between(old, new))
+        # reported, not raised, for every object of the account, which are all still there
+        assert summary.outcomes[ApplyOutcome.failed] == len(settings.SERVICES) and len(summary.failures) == 1
+        assert len(api.objects) == 2 * len(settings.SERVICES)
+
+        # the removal isn't part of the next diff, but the account is deleted anyway
+        summary = await manager.delete_old(new, AccountsDiff.between(new, new))
+        assert summary.outcomes == {ApplyOutcome.deleted: len(settings.SERVICES)}
+        assert api.calls["DELETECOLLECTION servicerouters"] == 2
+        assert {obj["metadata"]["labels"][ACCOUNT_LABEL] for obj in api.objects.values()} == {"acc2"}
+
+        summary = await manager.delete_old(new, AccountsDiff.between(new, new))
+        assert summary.outcomes == {}
+
+    run(scenario())
+
+
+def test_failed_objects_are_retried_by_the_next_update(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        manager = CRDManager(
+            GROUP, ROUTERS, settings.POD_ID, settings.SERVICES, SharedServicesCRD, engine=ApplyEngine(retries=0)
+        )
+        accounts = AccountIndex({"acc1": {"sys1"}, "acc2": {"sys2"}})
+        api.failing["POST servicerouters"] = 1
+        summary = await manager.update(accounts)
+        # reported, not raised
+        assert summary.outcomes[ApplyOutcome.failed] == 1 and len(summary.failures) == 1
+        assert len(api.objects) == 2 * len(settings.SERVICES) - 1
+
+        # nothing changed, but the account of the failed object is applied again
+        summary = await manager.update(accounts, AccountsDiff.between(accounts, accounts))
+        assert summary.outcomes[ApplyOutcome.created] == 1 and not summary.failures
+        assert len(api.objects) == 2 * len(settings.SERVICES)
+
+        summary = await manager.update(accounts, AccountsDiff.between(accounts, accounts))
+        assert summary.outcomes == {}
+
+    run(scenario())
+
+
+def test_json_patch_is_guarded_by_resource_version(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        updater = cached_updater()
+        assert await updater.update(routes(20)) == ApplyOutcome.created
+        assert await updater.update(routes(21)) == ApplyOutcome.patched
+        assert api.calls[JSON_PATCH] == 1
+
+        # someone else rewrote the routes without touching the hash annotation, and the watch hasn't told us yet
+        with api.condition:
+            stored = api.objects["servicerouters", "default", "router"]
+            stored["spec"]["routes"].reverse()
+            stored["metadata"]["resourceVersion"] = str(int(stored["metadata"]["resourceVersion"]) + 1000)
+
+        assert await updater.update(routes(22)) == ApplyOutcome.patched
+        # the JSON patch failed its resourceVersion test and the whole object was sent instead
+        assert api.calls[JSON_PATCH] == 2
+        assert api.calls[MERGE_PATCH] == 1
+        assert stored_routes(api) == as_json(routes(22))
+
+    run(scenario())
+
+
+def test_merge_patch_after_foreign_write_seen_by_watch(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        updater = cached_updater()
+        await updater.update(routes(20))
+        await CRDUpdater(GROUP, ROUTERS, "router")._patch_crd({"spec": {"routes": as_json(routes(5))}})
+        await eventually(lambda: updater.cache.applied("router") is None)
+
+        assert await updater.update(routes(21)) == ApplyOutcome.patched
+        # the spec we last wrote isn't the stored one any more, so there is nothing to JSON patch against
+        assert api.calls[JSON_PATCH] == 0
+        assert stored_routes(api) == as_json(routes(21))
+
+    run(scenario())
+
+
+def test_router_shards_are_listed_in_the_annotations(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        shards = generate_route_shards(sharded_accounts(), settings.SERVICES, 3)
+        updater = ShardedRouterUpdater(GROUP, ROUTERS, "router")
+        assert await updater.update_shards(shards) == ApplyOutcome.created
+
+        stored = api.objects["servicerouters", "default", "router"]
+        layout = stored["metadata"]["annotations"][SHARDS_ANNOTATION]
+        assert layout == ",".join(f"{updater._hash(shard)[:16]}:{len(shard.routes)}" for shard in shards)
+        assert stored["metadata"]["annotations"][HASH_ANNOTATION] == hashlib.sha256(layout.encode()).hexdigest()
+        assert stored_routes(api) == [route for shard in shards for route in as_json(shard)]
+
+        assert await updater.update_shards(shards) == ApplyOutcome.unchanged
+
+    run(scenario())
+
+
+def test_changed_shard_is_patched_without_the_previous_spec(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        old = generate_route_shards(sharded_accounts(), settings.SERVICES, 3)
+        await ShardedRouterUpdater(GROUP, ROUTERS, "router").update_shards(old)
+        size = api.request_bytes
+
+        new = generate_route_shards(sharded_accounts(changed="acc10"), settings.SERVICES, 3)
+        updater = restarted_updater()
+        assert await updater.update_shards(new) == ApplyOutcome.patched
+        assert (api.calls[JSON_PATCH], api.calls[MERGE_PATCH]) == (1, 0)
+        assert stored_routes(api) == [route for shard in new for route in as_json(shard)]
+        # only the shard of the changed account was sent
+        changed = router_shard("acc10", 3)
+        layout = api.objects["servicerouters", "default", "router"]["metadata"]["annotations"][SHARDS_ANNOTATION]
+        assert [before != after for before, after in zip(updater._layout(old).split(","), layout.split(","))] == [
+            index == changed for index in range(3)
+        ]
+        assert api.request_bytes - size < size / 2
+
+        assert await restarted_updater().update_shards(new) == ApplyOutcome.unchanged
+
+    run(scenario())
+
+
+def test_fewer_router_shards_replace_the_whole_router(api: FakeApiServer, run: Run) -> None:
+    async def scenario() -> None:
+        await ShardedRouterUpdater(GROUP, ROUTERS, "router").update_shards(
+            generate_route_shards(sharded_accounts(), settings.SERVICES, 3)
+        )
+
+        # ROUTER_SHARDS lowered from 3 to 2: the routes of the dropped shard move into the others
+        shards = generate_route_shards(sharded_accounts(), settings.SERVICES, 2)
+        assert await restarted_updater().update_shards(shards) == ApplyOutcome.patched
+        assert (api.calls[JSON_PATCH], api.calls[MERGE_PATCH]) == (0, 1)
+        annotations = api.objects["servicerouters", "default", "router"]["metadata"]["annotations"]
+        assert len(annotations[SHARDS_ANNOTATION].split(",")) == 2
+        assert stored_routes(api) == [route for shard in shards for route in as_json(shard)]
+
+    run(scenario())
+
+
+def test_api_client_counts_its_own_requests(api: FakeApiServer, monkeypatch: pytest.MonkeyPatch) -> None:
+    configuration = kubernetes.client.Configuration()
+    configuration.host = api.host
+    monkeypatch.setattr(kubernetes.client.Configuration, "_default", configuration)
+    api.add_secret("default", "token", {"data": "dG9rZW4="})
+    before = API_CALLS.get(verb="GET", outcome="200")
+
+    assert kubernetes.client.CoreV1Api(api_client()).read_namespaced_secret("token", "default").data == {
+        "data": "dG9rZW4="
+    }
+    assert API_CALLS.get(verb="GET", outcome="200") == before + 1
+    # other clients are left alone
+    kubernetes.client.CoreV1Api().read_namespaced_secret("token", "default")
+    assert API_CALLS.get(verb="GET", outcome="200") == before + 1
+
+
+def test_get_secret_waits_for_the_secret(api: FakeApiServer, run: Run) -> None:
+    threading.Timer(0.3, api.add_secret, ("default", "peering-token-pod1", {"data": "dG9rZW4="})).start()
+    assert run(get_secret("peering-token-pod1", "default", timeout=10)) == "dG9rZW4="
+
+
+def test_get_secret_backs_off_on_watch_errors(monkeypatch: pytest.MonkeyPatch) -> None:
+    class FailingWatch:
+        def __init__(self) -> None:
+            self.watches = 0
+
+        async def request(self, method: str, path: str, **kwargs: Any) -> Any:
+            await asyncio.sleep(0)
+            raise ApiException(status=404)
+
+        async def watch(self, path: str, **kwargs: Any) -> AsyncIterator[dict[str, Any]]:
+            self.watches += 1
+            yield {"type": "ERROR", "object": {"code": 500, "message": "etcd is unhappy"}}
+
+    client = FailingWatch()
+    monkeypatch.setattr(CRDUpdater, "client", client)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(get_secret("peering-token-pod1", "default", timeout=1.2))
+    # 0.5s, then 1s apart
+    assert client.watches <= 3
@@ -0,0 +1,135 @@
+import json
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from pod_consul_sidekick import plan
+from pod_consul_sidekick.config import Settings
+from pod_consul_sidekick.k8s import DYNAMIC_LABEL, CRDGroup, crd_body
+
+settings = Settings()
+ACCOUNTS = {"acc1": {"sys1"}, "acc2": {"sys2", "sys3"}}
+ROUTER = "pod1-tenant-services"
+
+
+def cluster(accounts: dict[str, set[str]]) -> plan.ClusterState:
+    # the objects a reconcile of `accounts` leaves behind
+    group = CRDGroup(settings.RESOURCE_GROUP, settings.RESOURCE_VERSION)
+    state: plan.ClusterState = {}
+    for desired in plan.desired_crds(settings, accounts):
+        state.setdefault(desired.kind.plural, {})[desired.name] = crd_body(
+            group, desired.kind, desired.name, desired.spec, desired.annotations, desired.labels
+        )
+    return state
+
+
+def foreign(name: str, **labels: str) -> dict[str, Any]:
+    return {"kind": "ServiceRouter", "metadata": {"name": name, "namespace": "default", "labels": labels}}
+
+
+@pytest.mark.parametrize(
+    "accounts, changes, unchanged",
+    [
+        (ACCOUNTS, [], 13),
+        (
+            {**ACCOUNTS, "acc3": {"sys4"}},
+            [
+                ("patch", ROUTER),
+                ("create", "shared-s-acc3"),
+                ("create", "a-sys4"),
+                ("create", "b-sys4"),
+                ("create", "s-acc3"),
+            ],
+            12,
+        ),
+        (
+            {"acc1": {"sys1", "sys5"}, "acc2": {"sys2", "sys3"}},
+            [
+                ("patch", ROUTER),
+                ("patch", "shared-s-acc1"),
+                ("create", "a-sys5"),
+                ("create", "b-sys5"),
+                ("patch", "s-acc1"),
+            ],
+            10,
+        ),
+        (
+            {"acc1": {"sys1"}},
+            [
+                ("patch", ROUTER),
+                ("delete", "shared-s-acc2"),
+                ("delete", "a-sys2"),
+                ("delete", "a-sys3"),
+                ("delete", "b-sys2"),
+                ("delete", "b-sys3"),
+                ("delete", "s-acc2"),
+            ],
+            6,
+        ),
+    ],
+)
+def test_plan(accounts: dict[str, set[str]], changes: list[tuple[str, str]], unchanged: int) -> None:
+    state = cluster(ACCOUNTS)
+    # not labeled as one of the sidekick's dynamic objects, so never deleted
+    state["servicerouters"].update(
+        {"manual": foreign("manual"), "other": foreign("other", **{DYNAMIC_LABEL: "something-else"})}
+    )
+
+    result = plan.plan(settings, accounts, state)
+    assert [(change.action, change.name) for change in result.changes] == changes
+    assert result.unchanged == unchanged
+    for change in result.changes:
+        if change.action == "create":
+            assert change.size == change.full_size > 0 and change.operations == 0
+        elif change.action == "patch":
+            assert change.size > 0 and change.operations > 0
+
+
+def test_plan_without_objects_creates_everything() -> None:
+    result = plan.plan(settings, ACCOUNTS, {})
+    assert result.counts() == {"create": 13, "patch": 0, "delete": 0}
+    assert result.unchanged == 0
+
+
+def test_load_state_reads_lists_and_single_objects(tmp_path: Path) -> None:
+    state = cluster(ACCOUNTS)
+    routers, intents = list(state["servicerouters"].values()), list(state["serviceintentions"].values())
+    peering = state["peeringacceptors"]["pod1-peering"]
+    elsewhere = {**routers[0], "metadata": {**routers[0]["metadata"], "namespace": "other"}}
+    files = {
+        # kubectl get servicerouters,serviceintentions -o json
+        "list.json": {"apiVersion": "v1", "kind": "List", "items": [*routers[1:], *intents, elsewhere]},
+        # kubectl get peeringacceptor pod1-peering -o json
+        "single.json": peering,
+        # several documents in one file, and kinds that aren't planned for
+        "documents.json": [routers[0], {"kind": "ConfigMap", "metadata": {"name": "cm", "namespace": "default"}}],
+    }
+    for name, content in files.items():
+        (tmp_path / name).write_text(json.dumps(content))
+
+    loaded = plan.load_state(settings, [str(tmp_path / name) for name in files])
+    assert loaded == state
+    assert plan.plan(settings, ACCOUNTS, loaded) == plan.Plan([], 13)
+
+    assert plan.load_state(settings, []) == {"servicerouters": {}, "serviceintentions": {}, "peeringacceptors": {}}
+
+
+def test_render() -> None:
+    result = plan.Plan(
+        [
+            plan.PlannedChange("delete", "ServiceRouter", "shared-s-acc2"),
+            plan.PlannedChange("patch", "ServiceRouter", ROUTER, 547, 8, 794),
+            plan.PlannedChange("create", "ServiceIntentions", "b-sys4", 414, 0, 414),
+            plan.PlannedChange("create", "ServiceIntentions", "a-sys4", 414, 0, 414),
+        ],
+        6,
+    )
+    assert plan.render(result).splitlines() == [
+        "2 to create, 1 to patch, 1 to delete, 6 unchanged",
+        "  create ServiceIntentions a-sys4 414 bytes",
+        "  create ServiceIntentions b-sys4 414 bytes",
+        f"  patch  ServiceRouter {ROUTER} 8 operations, 547 bytes (794 bytes in full)",
+        "  delete ServiceRouter shared-s-acc2",
+    ]
+    assert plan.render(plan.Plan([], 0)) == "0 to create, 0 to patch, 0 to delete, 0 unchanged"
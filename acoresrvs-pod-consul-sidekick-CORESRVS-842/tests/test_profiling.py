@@ -0,0 +1,38 @@
+import threading
+import time
+from pathlib import Path
+
+from pod_consul_sidekick.profiling import SamplingProfiler
+
+
+def spin(seconds: float) -> None:
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+def test_slow_cycle_is_written_as_folded_stacks(tmp_path: Path) -> None:
+    profiler = SamplingProfiler(0.1, str(tmp_path), interval=0.005)
+    profiler.start()
+    try:
+        started = time.monotonic()
+        worker = threading.Thread(target=spin, args=(0.3,), name="worker")
+        worker.start()
+        worker.join()
+        path = profiler.cycle_finished(started)
+    finally:
+        profiler.stop()
+
+    assert path is not None
+    lines = Path(path).read_text().splitlines()
+    spinning = [line for line in lines if line.startswith("worker;") and ";spin (" in line]
+    assert spinning
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in spinning) > 10
+    # samples are folded into counts per second, not kept one by one
+    assert len(profiler._buckets) <= 2
+
+
+def test_fast_cycle_is_not_written(tmp_path: Path) -> None:
+    profiler = SamplingProfiler(10, str(tmp_path))
+    assert profiler.cycle_finished(time.monotonic()) is None
+    assert not list(tmp_path.iterdir())
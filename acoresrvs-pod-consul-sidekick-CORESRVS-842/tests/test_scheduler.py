@@ -0,0 +1,50 @@
+import asyncio
+from typing import Optional
+
+from pod_consul_sidekick.discovery import AccountsDiff, AccountsUpdate
+from pod_consul_sidekick.index import AccountIndex
+from pod_consul_sidekick.scheduler import ReconcileScheduler
+
+
+def test_failed_reconcile_is_followed_by_a_full_one() -> None:
+    async def scenario() -> None:
+        calls: list[tuple[AccountIndex, Optional[AccountsDiff]]] = []
+        reconciled = asyncio.Queue[None]()
+
+        async def reconcile(accounts: AccountIndex, diff: Optional[AccountsDiff], partial: bool) -> None:
+            calls.append((accounts, diff))
+            reconciled.put_nowait(None)
+            if len(calls) == 2:
+                raise ConnectionError("API server unavailable")
+
+        scheduler = ReconcileScheduler(reconcile)
+        task = asyncio.create_task(scheduler.run())
+        try:
+            first = AccountIndex({"acc1": {"sys1"}})
+            scheduler.publish(AccountsUpdate(first, None))
+            await asyncio.wait_for(reconciled.get(), 5)
+
+            second = AccountIndex({"acc1": {"sys1", "sys2"}})
+            scheduler.publish(AccountsUpdate(second, AccountsDiff.between(first, second)))
+            await asyncio.wait_for(reconciled.get(), 5)
+            # the failure didn't end the scheduler
+            assert not task.done()
+
+            third = AccountIndex({"acc1": {"sys1", "sys2"}, "acc2": {"sys3"}})
+            scheduler.publish(AccountsUpdate(third, AccountsDiff.between(second, third)))
+            await asyncio.wait_for(reconciled.get(), 5)
+
+            fourth = AccountIndex({"acc2": {"sys3"}})
+            scheduler.publish(AccountsUpdate(fourth, AccountsDiff.between(third, fourth)))
+            await asyncio.wait_for(reconciled.get(), 5)
+        finally:
+            task.cancel()
+
+        assert [accounts for accounts, _ in calls] == [first, second, third, fourth]
+        assert calls[1][1] is not None
+        # everything, rather than the changes since the reconcile that failed
+        assert calls[2][1] is None
+        # and back to diffs against the last reconciled accounts
+        assert calls[3][1] == AccountsDiff.between(third, fourth)
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+import gzip
+import json
+import os
+from pathlib import Path
+
+import kubernetes
+import pytest
+from benchmarks.fake_apiserver import FakeApiServer
+
+from pod_consul_sidekick import plan
+from pod_consul_sidekick.config import Service, ServiceType
+from pod_consul_sidekick.snapshot import CONFIGMAP_KEY, ConfigMapSnapshotStore, FileSnapshotStore, Snapshot, fingerprint
+
+ACCOUNTS = {"acc1": {"sys1", "sys2"}, "acc2": set()}
+CRDS = {"servicerouters": {"shared-a-acc1": ["0123abcd", "42"]}}
+
+
+def encoded(content: dict) -> bytes:
+    return gzip.compress(json.dumps(content).encode())
+
+
+def test_round_trip() -> None:
+    snapshot = Snapshot("fp", ACCOUNTS, CRDS, 1700000000.5)
+    assert Snapshot.decode(snapshot.encode()) == snapshot
+
+
+@pytest.mark.parametrize("format_", [None, 0, 2, "1"])
+def test_unsupported_formats_are_ignored(format_: object) -> None:
+    content = {"fingerprint": "fp", "accounts": {}, "crds": {}, "saved_at": 0}
+    if format_ is not None:
+        content["format"] = format_
+    assert Snapshot.decode(encoded(content)) is None
+
+
+def test_plan_loads_accounts_from_snapshots_only_in_known_formats(tmp_path: Path) -> None:
+    path = tmp_path / "snapshot"
+    path.write_bytes(Snapshot("fp", ACCOUNTS, CRDS, 0).encode())
+    assert plan.load_accounts(str(path)) == ACCOUNTS
+
+    path.write_bytes(encoded({"format": 2, "accounts": {}}))
+    with pytest.raises(ValueError, match="unsupported snapshot format"):
+        plan.load_accounts(str(path))
+
+
+def test_fingerprint_follows_the_configuration() -> None:
+    services = {"a": Service(upstreams={"b", "c"}), "b": Service()}
+    assert fingerprint("pod1", services) == fingerprint("pod1", {"b": Service(), "a": Service(upstreams={"c", "b"})})
+    assert fingerprint("pod1", services) != fingerprint("pod2", services)
+    assert fingerprint("pod1", services) != fingerprint("pod1", {**services, "b": Service(type=ServiceType.shared)})
+
+
+def test_file_store(tmp_path: Path) -> None:
+    store = FileSnapshotStore(str(tmp_path / "snapshot"))
+    assert store.load() is None
+
+    store.save("fp", ACCOUNTS, CRDS)
+    store.save("fp2", {"acc3": {"sys3"}}, {})
+    loaded = store.load()
+    assert loaded is not None and (loaded.fingerprint, loaded.accounts, loaded.crds) == ("fp2", {"acc3": {"sys3"}}, {})
+    # written through a temporary file that is gone afterwards
+    assert os.listdir(tmp_path) == ["snapshot"]
+
+    (tmp_path / "snapshot").write_bytes(b"not a snapshot")
+    assert store.load() is None
+
+
+def test_configmap_store(api: FakeApiServer, monkeypatch: pytest.MonkeyPatch) -> None:
+    configuration = kubernetes.client.Configuration()
+    configuration.host = api.host
+    monkeypatch.setattr(kubernetes.client.Configuration, "_default", configuration)
+    store = ConfigMapSnapshotStore("sidekick-snapshot", "default")
+    assert store.load() is None
+
+    store.save("fp", ACCOUNTS, CRDS)
+    store.save("fp2", {"acc3": {"sys3"}}, {})
+    # replaced, after the first save found nothing to replace and created it
+    assert (api.calls["POST configmaps"], api.calls["PUT configmaps"]) == (1, 2)
+    configmap = api.objects["configmaps", "default", "sidekick-snapshot"]
+    assert list(configmap["binaryData"]) == [CONFIGMAP_KEY]
+    loaded = store.load()
+    assert loaded is not None and (loaded.fingerprint, loaded.accounts) == ("fp2", {"acc3": {"sys3"}})